@@ -2,28 +2,70 @@ import os
 import io
 import re
 import json
+import marshal
+import math
 import time
 import base64
+import bisect
+import cProfile
+import contextvars
+import csv
+import functools
+import pickle
 import random
 import hashlib
+import mmap
+import multiprocessing
+import platform
+import pstats
+import secrets
+import shutil
+import stat
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+import weakref
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple, Union
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import yaml  # PyYAML
+import pandas as pd
+import altair as alt
 import httpx  # font download
 
+try:  # libyaml bindings are several times faster on large specs
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader as YamlSafeLoader
+
+try:
+    import orjson  # optional JSON fast path
+except ImportError:  # pragma: no cover
+    orjson = None
+
 # PDF engines
 from fpdf import FPDF  # fpdf2
 from pypdf import PdfReader, PdfWriter  # pypdf
+from pypdf.generic import ArrayObject, BooleanObject, DecodedStreamObject, DictionaryObject, FloatObject, NameObject, StreamObject
 
 # ReportLab
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4, LETTER
 from reportlab.lib.units import mm as RL_MM
-from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase import pdfdoc, pdfmetrics
+from reportlab.pdfbase.acroform import PDFFromString
 from reportlab.pdfbase.ttfonts import TTFont
 
 
@@ -48,6 +90,27 @@ I18N = {
         "nav_form": "Form → Dynamic PDF",
         "nav_pipeline": "Agent Pipeline",
         "nav_spec": "PDF Build Spec → Dynamic PDF",
+        "nav_bench": "Performance Lab",
+        "dash_memory": "Session memory",
+        "dash_memory_session": "This session (RAM)",
+        "dash_memory_budget": "Budget",
+        "dash_memory_offloaded": "Offloaded to disk",
+        "dash_memory_sessions": "Live sessions · RAM",
+        "dash_memory_disk": "Disk store · size",
+        "dash_memory_top": "Largest session values",
+        "dash_memory_shared": "Shared artifacts",
+        "dash_memory_saved": "saved by deduplication",
+        "dash_memory_evicted": "Offloaded on the last run",
+        "dash_memory_preview": "Preview memo",
+        "dash_metrics": "Process metrics (all sessions)",
+        "dash_metrics_endpoint": "Prometheus endpoint",
+        "dash_metrics_empty": "No samples recorded in this process yet.",
+        "dash_traces": "Spec → PDF traces",
+        "dash_no_traces": "Validate or generate a spec to record a trace.",
+        "dash_trace_pick": "Trace",
+        "dash_trace_spans": "Spans",
+        "dash_trace_download": "Download trace (OTLP JSON)",
+        "dash_trace_file": "Exported to",
         "nav_notes": "AI Note Keeper",
         "nav_settings": "Settings & API Keys",
         "nav_history": "History / Versions",
@@ -84,6 +147,10 @@ I18N = {
         "form_loaded": "Loaded content",
         "form_preview": "Preview",
         "form_next": "Proceed to pipeline",
+        "form_auto_layout": "Auto-layout PDF spec (no LLM)",
+        "pipeline_auto_layout": "Deterministic layout (no LLM)",
+        "layout_done": "Auto layout",
+        "layout_ambiguous": "Lines the layout rules could not place; consider the PDF spec agent:",
         "pipeline_title": "Agent Pipeline (Step-by-step, editable)",
         "pipeline_model": "Model",
         "pipeline_max_tokens": "Max tokens",
@@ -95,6 +162,22 @@ I18N = {
         "pipeline_reset_output": "Reset to generated",
         "pipeline_view_text": "Text",
         "pipeline_view_md": "Markdown",
+        "pipeline_autoroute": "Auto-route (failover + hedging)",
+        "pipeline_hedge_ms": "Hedge after (ms)",
+        "pipeline_served_by": "Served by",
+        "pipeline_route_health": "Route health (rolling)",
+        "pipeline_max_repairs": "Max spec repair rounds",
+        "pipeline_spec_valid": "Spec output validated",
+        "pipeline_spec_invalid": "Spec output still invalid",
+        "batch_title": "Batch / offline mode",
+        "batch_agents": "Agents",
+        "batch_upload": "Submissions (.txt, .md)",
+        "batch_include_form": "Include current form content",
+        "batch_submit": "Submit batch",
+        "batch_refresh": "Refresh status",
+        "batch_jobs": "Batch jobs",
+        "batch_download_jsonl": "Download request JSONL",
+        "batch_placeholders_help": "Each prompt placeholder gets its own input: the submission document, or the fixed value typed here.",
         "notes_title": "AI Note Keeper",
         "notes_paste": "Paste a note (txt / markdown)",
         "notes_transform": "Transform to organized Markdown",
@@ -135,10 +218,77 @@ I18N = {
         "spec_upload_pdf": "Upload modified PDF",
         "spec_reconcile": "Reconcile uploaded PDF vs spec",
         "spec_render_log": "Render log",
+        "spec_profile": "Profile generation",
+        "spec_optimize": "Output optimization",
+        "spec_optimize_help": "Higher levels compress harder and pack objects into object/xref streams; they take longer to write.",
+        "spec_optimize_no_rewriter": "Neither pikepdf nor qpdf is installed here, so every level only compresses and deduplicates; object/xref streams are skipped.",
+        "spec_optimize_off": "Off",
+        "spec_optimize_fast": "Fast",
+        "spec_optimize_balanced": "Balanced",
+        "spec_optimize_max": "Smallest",
+        "spec_linearize": "Linearize (fast web view)",
+        "spec_linearize_help": "Reorders the file so viewers can show page 1 before the rest has downloaded. Applied last.",
+        "spec_linearize_off": "Linearizing needs pikepdf or the qpdf CLI; neither is installed here.",
+        "ttfp_title": "Estimated time to first page (linearized vs plain)",
+        "ttfp_estimate_note": "Estimate, not a measured page load: transfer time is the bytes needed for page 1 × 8 / link speed, and render time is a local pdftoppm run. The in-app preview is a data: URI, which always loads the whole file, so it cannot show progressive loading.",
+        "ttfp_need_spec": "Validate or generate a spec on the PDF Spec page first.",
+        "ttfp_run": "Run",
+        "ttfp_no_linearizer": "Linearized variant skipped",
+        "ttfp_no_poppler": "pdftoppm (poppler) not found: render times omitted, transfer estimates only.",
+        "spec_profile_title": "Profile",
+        "spec_profile_pstats": "Download .pstats",
+        "spec_profile_allocs": "Download top allocations",
         "spec_validation": "Validation report",
         "spec_reconcile_report": "Reconciliation report",
         "spec_no_pdf": "No PDF generated yet.",
         "spec_save_version": "Save version (spec + artifact)",
+        "spec_bulk": "Bulk: every spec in the editor (fenced blocks, --- documents, JSONL)",
+        "spec_bulk_separate": "One PDF per spec (zip)",
+        "spec_bulk_merge": "Merge into one PDF",
+        "spec_bulk_generate": "Generate all",
+        "spec_bulk_download": "Download bulk output",
+        "fill_title": "Fill engine: one filled PDF per record",
+        "fill_records": "Records (.csv, .json, .jsonl) keyed by field name",
+        "fill_flatten": "Flatten",
+        "fill_workers": "Workers",
+        "fill_name_field": "File name column (optional)",
+        "fill_run": "Fill generated PDF",
+        "fill_download": "Download filled PDFs (zip)",
+        "bench_title": "Engine parity and render benchmarks",
+        "bench_use_defaults": "Built-in specs",
+        "bench_use_editor": "Specs in the editor",
+        "bench_repeats": "Repeats",
+        "bench_tolerance": "Rect tolerance (pt)",
+        "bench_baseline": "Baseline report (.json)",
+        "bench_run": "Run benchmark",
+        "bench_parity": "Widget parity",
+        "bench_regressions": "Regressions vs baseline",
+        "bench_download": "Download report (JSON)",
+        "bench_set_baseline": "Use this run as baseline",
+        "bench_use_synth": "Synthetic spec (sweep settings)",
+        "sweep_title": "Synthetic corpus and scaling sweep",
+        "sweep_seed": "Seed",
+        "sweep_pages": "Pages",
+        "sweep_elements": "Rows per page",
+        "sweep_cjk": "CJK ratio",
+        "sweep_options": "Dropdown options",
+        "sweep_dimension": "Sweep dimension",
+        "sweep_values": "Values (comma-separated)",
+        "sweep_run": "Run sweep",
+        "sweep_download_spec": "Download synthetic spec",
+        "sweep_download": "Download sweep (CSV)",
+        "recon_bulk_title": "Bulk reconcile: many returned PDFs against the spec",
+        "recon_bulk_files": "Returned PDFs or zip archives",
+        "recon_bulk_folder": "Server folder of PDFs (optional)",
+        "recon_bulk_folder_help": "Path relative to {root}; folders outside it are rejected.",
+        "recon_bulk_folder_off": "Disabled: the server has no WOW_PDF_FOLDER_ROOT configured.",
+        "recon_bulk_run": "Reconcile all",
+        "recon_bulk_csv": "Download report (CSV)",
+        "recon_bulk_json": "Download report (JSON)",
+        "extract_title": "Extract filled values into a table",
+        "extract_format": "Output format",
+        "extract_run": "Extract values",
+        "extract_download": "Download table",
         # Engine + download format
         "engine": "PDF engine",
         "engine_fpdf2": "fpdf2",
@@ -148,6 +298,13 @@ I18N = {
         "download_py": "PY (generator script)",
         "download_js": "JS (jsPDF script)",
         "download_artifact": "Download artifact",
+        "spec_compiled": "Reuse compiled static layer (labels rendered once per layout)",
+        "spec_flatten": "Flatten (bake values into page content)",
+        "spec_appearances": "Pre-generate field appearances",
+        "spec_label_fit": "Label overflow",
+        "spec_label_fit_none": "Report only",
+        "spec_label_fit_wrap": "Wrap",
+        "spec_label_fit_shrink": "Shrink to fit",
         # Fonts
         "font_status": "Unicode fonts",
         "font_ready": "Ready",
@@ -161,6 +318,27 @@ I18N = {
         "nav_form": "表單 → 動態 PDF",
         "nav_pipeline": "代理流程",
         "nav_spec": "PDF 建置規格 → 動態 PDF",
+        "nav_bench": "效能實驗室",
+        "dash_memory": "工作階段記憶體",
+        "dash_memory_session": "本工作階段（RAM）",
+        "dash_memory_budget": "預算",
+        "dash_memory_offloaded": "已卸載至磁碟",
+        "dash_memory_sessions": "活躍工作階段 · RAM",
+        "dash_memory_disk": "磁碟儲存 · 大小",
+        "dash_memory_top": "最大的工作階段值",
+        "dash_memory_shared": "共用產物",
+        "dash_memory_saved": "因去重複而節省",
+        "dash_memory_evicted": "上次執行卸載的項目",
+        "dash_memory_preview": "預覽快取",
+        "dash_metrics": "程序指標（所有工作階段）",
+        "dash_metrics_endpoint": "Prometheus 端點",
+        "dash_metrics_empty": "此程序尚未記錄任何樣本。",
+        "dash_traces": "規格 → PDF 追蹤",
+        "dash_no_traces": "驗證或生成規格後即會記錄追蹤。",
+        "dash_trace_pick": "追蹤",
+        "dash_trace_spans": "區段",
+        "dash_trace_download": "下載追蹤（OTLP JSON）",
+        "dash_trace_file": "匯出位置",
         "nav_notes": "AI 筆記管家",
         "nav_settings": "設定與 API 金鑰",
         "nav_history": "歷史 / 版本",
@@ -197,6 +375,10 @@ I18N = {
         "form_loaded": "已載入內容",
         "form_preview": "預覽",
         "form_next": "前往代理流程",
+        "form_auto_layout": "自動版面配置 PDF 規格（不使用 LLM）",
+        "pipeline_auto_layout": "確定性版面配置（不使用 LLM）",
+        "layout_done": "自動版面配置",
+        "layout_ambiguous": "以下內容無法由版面規則配置，建議改用 PDF 規格代理：",
         "pipeline_title": "代理流程（逐步執行、可編輯）",
         "pipeline_model": "模型",
         "pipeline_max_tokens": "Max tokens",
@@ -208,6 +390,22 @@ I18N = {
         "pipeline_reset_output": "重置為生成結果",
         "pipeline_view_text": "文字",
         "pipeline_view_md": "Markdown",
+        "pipeline_autoroute": "自動路由（容錯切換 + 對沖請求）",
+        "pipeline_hedge_ms": "對沖等待時間（ms）",
+        "pipeline_served_by": "實際服務路由",
+        "pipeline_route_health": "路由健康度（滾動統計）",
+        "pipeline_max_repairs": "規格修復次數上限",
+        "pipeline_spec_valid": "規格輸出已通過驗證",
+        "pipeline_spec_invalid": "規格輸出仍未通過驗證",
+        "batch_title": "批次 / 離線模式",
+        "batch_agents": "代理",
+        "batch_upload": "送件資料（.txt, .md）",
+        "batch_include_form": "包含目前表單內容",
+        "batch_submit": "送出批次",
+        "batch_refresh": "更新狀態",
+        "batch_jobs": "批次工作",
+        "batch_download_jsonl": "下載請求 JSONL",
+        "batch_placeholders_help": "每個提示佔位符各自對應輸入：送件文件，或此處輸入的固定值。",
         "notes_title": "AI 筆記管家",
         "notes_paste": "貼上筆記（txt / markdown）",
         "notes_transform": "轉為有組織的 Markdown",
@@ -248,10 +446,77 @@ I18N = {
         "spec_upload_pdf": "上傳已修改的 PDF",
         "spec_reconcile": "比對：上傳 PDF vs 規格",
         "spec_render_log": "渲染記錄",
+        "spec_profile": "剖析生成過程",
+        "spec_optimize": "輸出最佳化",
+        "spec_optimize_help": "等級越高壓縮越強，並將物件打包為物件／交互參照串流；寫入時間也較長。",
+        "spec_optimize_no_rewriter": "此環境未安裝 pikepdf 或 qpdf，各等級僅做壓縮與去重，略過物件／交互參照串流。",
+        "spec_optimize_off": "關閉",
+        "spec_optimize_fast": "快速",
+        "spec_optimize_balanced": "平衡",
+        "spec_optimize_max": "最小",
+        "spec_linearize": "線性化（快速網頁檢視）",
+        "spec_linearize_help": "重新排列檔案，讓檢視器在其餘內容下載前即可顯示第 1 頁。最後套用。",
+        "spec_linearize_off": "線性化需要 pikepdf 或 qpdf 命令列工具；此環境皆未安裝。",
+        "ttfp_title": "首頁顯示時間估計（線性化 vs 一般）",
+        "ttfp_estimate_note": "此為估計值而非實測頁面載入：傳輸時間為第 1 頁所需位元組 × 8 ÷ 連線速度，渲染時間為本機 pdftoppm 執行結果。App 內預覽使用 data: URI，一律載入整個檔案，無法呈現漸進式載入。",
+        "ttfp_need_spec": "請先在 PDF 規格頁驗證或生成規格。",
+        "ttfp_run": "執行",
+        "ttfp_no_linearizer": "已略過線性化版本",
+        "ttfp_no_poppler": "找不到 pdftoppm（poppler）：省略渲染時間，僅提供傳輸估計。",
+        "spec_profile_title": "效能剖析",
+        "spec_profile_pstats": "下載 .pstats",
+        "spec_profile_allocs": "下載主要記憶體配置",
         "spec_validation": "驗證報告",
         "spec_reconcile_report": "比對報告",
         "spec_no_pdf": "尚未生成 PDF。",
         "spec_save_version": "儲存版本（規格 + 產出物）",
+        "spec_bulk": "批次：編輯器中的所有規格（程式碼區塊、--- 文件、JSONL）",
+        "spec_bulk_separate": "每份規格各一個 PDF（zip）",
+        "spec_bulk_merge": "合併為單一 PDF",
+        "spec_bulk_generate": "全部生成",
+        "spec_bulk_download": "下載批次產出",
+        "fill_title": "填寫引擎：每筆資料產生一份已填寫 PDF",
+        "fill_records": "資料（.csv, .json, .jsonl），以欄位名稱為鍵",
+        "fill_flatten": "平面化",
+        "fill_workers": "工作程序數",
+        "fill_name_field": "檔名欄位（選填）",
+        "fill_run": "填寫已生成的 PDF",
+        "fill_download": "下載已填寫 PDF（zip）",
+        "bench_title": "引擎一致性與渲染效能測試",
+        "bench_use_defaults": "內建規格",
+        "bench_use_editor": "編輯器中的規格",
+        "bench_repeats": "重複次數",
+        "bench_tolerance": "矩形容差（pt）",
+        "bench_baseline": "基準報告（.json）",
+        "bench_run": "執行效能測試",
+        "bench_parity": "欄位一致性",
+        "bench_regressions": "相對基準的效能退化",
+        "bench_download": "下載報告（JSON）",
+        "bench_set_baseline": "以本次結果作為基準",
+        "bench_use_synth": "合成規格（依掃描設定）",
+        "sweep_title": "合成語料與擴展性掃描",
+        "sweep_seed": "亂數種子",
+        "sweep_pages": "頁數",
+        "sweep_elements": "每頁列數",
+        "sweep_cjk": "中日韓文字比例",
+        "sweep_options": "下拉選項數",
+        "sweep_dimension": "掃描維度",
+        "sweep_values": "數值（以逗號分隔）",
+        "sweep_run": "執行掃描",
+        "sweep_download_spec": "下載合成規格",
+        "sweep_download": "下載掃描結果（CSV）",
+        "recon_bulk_title": "批次比對：多份回傳 PDF 與規格比對",
+        "recon_bulk_files": "回傳的 PDF 或 zip 壓縮檔",
+        "recon_bulk_folder": "伺服器上的 PDF 資料夾（選填）",
+        "recon_bulk_folder_help": "相對於 {root} 的路徑；此目錄以外的資料夾會被拒絕。",
+        "recon_bulk_folder_off": "已停用：伺服器未設定 WOW_PDF_FOLDER_ROOT。",
+        "recon_bulk_run": "全部比對",
+        "recon_bulk_csv": "下載報告（CSV）",
+        "recon_bulk_json": "下載報告（JSON）",
+        "extract_title": "擷取已填寫的值為表格",
+        "extract_format": "輸出格式",
+        "extract_run": "擷取欄位值",
+        "extract_download": "下載表格",
         # Engine + download format
         "engine": "PDF 引擎",
         "engine_fpdf2": "fpdf2",
@@ -261,6 +526,13 @@ I18N = {
         "download_py": "PY（產生器腳本）",
         "download_js": "JS（jsPDF 腳本）",
         "download_artifact": "下載產出物",
+        "spec_compiled": "重用已編譯的靜態圖層（每個版面只渲染一次標籤）",
+        "spec_flatten": "平面化（將欄位值寫入頁面內容）",
+        "spec_appearances": "預先產生欄位外觀串流",
+        "spec_label_fit": "標籤溢出處理",
+        "spec_label_fit_none": "僅回報",
+        "spec_label_fit_wrap": "自動換行",
+        "spec_label_fit_shrink": "縮小字級",
         # Fonts
         "font_status": "Unicode 字型",
         "font_ready": "可用",
@@ -270,9 +542,19 @@ I18N = {
 }
 
 
+@st.cache_resource
+def i18n_tables() -> Dict[str, Dict[str, str]]:
+    # Every language table carries the English strings underneath, so t() is a single dict
+    # hit per call. Flattened once per process: the script (and any module-level value) is
+    # re-executed on every rerun, only cache_resource survives. Edits to I18N need a restart.
+    return {lang: {**I18N["en"], **table} for lang, table in I18N.items()}
+
+
+I18N_TABLES = i18n_tables()
+
+
 def t(key: str) -> str:
-    lang = st.session_state.get("lang", "en")
-    return I18N.get(lang, I18N["en"]).get(key, key)
+    return I18N_TABLES.get(st.session_state.get("lang", "en"), I18N_TABLES["en"]).get(key, key)
 
 
 # ----------------------------
@@ -523,14 +805,19 @@ def download_font_if_missing(font_key: str, timeout_s: float = 30.0) -> bool:
     if path.exists() and path.stat().st_size > 100_000:
         return True
     url = meta["url"]
+    metrics = get_metrics()
+    start = time.time()
     try:
         with httpx.stream("GET", url, timeout=timeout_s, follow_redirects=True) as r:
             r.raise_for_status()
             data = b"".join(r.iter_bytes())
         path.write_bytes(data)
-        return True
+        ok = True
     except Exception:
-        return False
+        ok = False
+    metrics.observe("font_download_seconds", time.time() - start, font=font_key)
+    metrics.inc("font_downloads_total", font=font_key, outcome="ok" if ok else "error")
+    return ok
 
 
 def ensure_unicode_fonts() -> Dict[str, Any]:
@@ -561,6 +848,393 @@ def sanitize_to_latin1(text: str) -> str:
     return text.encode("latin-1", "replace").decode("latin-1")
 
 
+def is_latin1(text: str) -> bool:
+    try:
+        text.encode("latin-1")
+        return True
+    except UnicodeEncodeError:
+        return False
+
+
+# ----------------------------
+# Tracing: structured spans for the spec -> PDF path (OTLP-style JSON)
+# ----------------------------
+TRACE_FILE = Path(os.environ.get("WOW_TRACE_FILE", os.path.join(tempfile.gettempdir(), "wow_traces", "spans.jsonl")))
+TRACE_FILE_MAX_BYTES = int(float(os.environ.get("WOW_TRACE_MAX_MB", "5")) * 1024 * 1024)
+TRACE_FILE_BACKUPS = 3  # spans.jsonl.1 .. .3, like logging's RotatingFileHandler
+TRACE_SERVICE = "wow-dynamic-pdf"
+TRACE_HISTORY = 20
+
+_ACTIVE_TRACE: contextvars.ContextVar = contextvars.ContextVar("wow_active_trace", default=None)
+_ACTIVE_SPAN: contextvars.ContextVar = contextvars.ContextVar("wow_active_span", default=None)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    attributes: Dict[str, Any]
+    end_ns: int = 0
+    status: str = "OK"
+
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    # A no-op outside start_trace(), so instrumented helpers cost nothing in bulk/worker paths.
+    trace = _ACTIVE_TRACE.get()
+    if trace is None:
+        yield None
+        return
+    parent = _ACTIVE_SPAN.get()
+    span = Span(name, trace["trace_id"], secrets.token_hex(8), parent.span_id if parent else None, time.time_ns(), dict(attrs))
+    token = _ACTIVE_SPAN.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.status = "ERROR"
+        span.attributes["error"] = str(e)[:200]
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _ACTIVE_SPAN.reset(token)
+        trace["spans"].append(span)
+
+
+def span_set(**attrs):
+    span = _ACTIVE_SPAN.get()
+    if span is not None:
+        span.attributes.update(attrs)
+
+
+def traced(name: str, attrs=None):
+    """Wraps a function in a span; attrs(result, args, kwargs) adds sizes/counts on success."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _ACTIVE_TRACE.get() is None:
+                return fn(*args, **kwargs)
+            with trace_span(name) as span:
+                result = fn(*args, **kwargs)
+                if attrs is not None:
+                    try:
+                        span.attributes.update(attrs(result, args, kwargs))
+                    except Exception:
+                        pass
+                return result
+        return wrapper
+    return deco
+
+
+def otlp_value(v: Any) -> Dict[str, Any]:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+def trace_to_otlp(trace: Dict[str, Any]) -> Dict[str, Any]:
+    spans = [
+        {
+            "traceId": sp.trace_id,
+            "spanId": sp.span_id,
+            **({"parentSpanId": sp.parent_id} if sp.parent_id else {}),
+            "name": sp.name,
+            "kind": 1,
+            "startTimeUnixNano": str(sp.start_ns),
+            "endTimeUnixNano": str(sp.end_ns),
+            "attributes": [{"key": k, "value": otlp_value(v)} for k, v in sp.attributes.items() if v is not None],
+            "status": {"code": 2 if sp.status == "ERROR" else 1},
+        }
+        for sp in sorted(trace["spans"], key=lambda x: x.start_ns)
+    ]
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE}}]},
+            "scopeSpans": [{"scope": {"name": "app"}, "spans": spans}],
+        }]
+    }
+
+
+@st.cache_resource
+def get_trace_file_lock() -> threading.Lock:
+    # One writer at a time across sessions; each rerun builds a new module, so a module-level
+    # lock would not be shared.
+    return threading.Lock()
+
+
+def rotate_trace_file(path: Path, incoming: int):
+    # Size-based rollover: path -> path.1 -> ... -> path.N, the oldest is dropped.
+    size = path.stat().st_size if path.exists() else 0
+    if size == 0 or size + incoming <= TRACE_FILE_MAX_BYTES:
+        return
+    for i in range(TRACE_FILE_BACKUPS, 0, -1):
+        src = path if i == 1 else path.with_name(f"{path.name}.{i - 1}")
+        if src.exists():
+            os.replace(src, path.with_name(f"{path.name}.{i}"))
+
+
+def export_trace(otlp: Dict[str, Any], path: Path = TRACE_FILE):
+    # Same line-per-export layout as the OpenTelemetry collector's file exporter.
+    line = (json.dumps(otlp, ensure_ascii=False) + "\n").encode("utf-8")
+    try:
+        with get_trace_file_lock():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            rotate_trace_file(path, len(line))
+            with open(path, "ab") as fh:
+                fh.write(line)
+    except OSError:
+        pass
+
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    """
+    Root span for one user action. On exit (including st.rerun(), which is not an
+    Exception) the trace is exported to TRACE_FILE and kept in the session for the
+    dashboard waterfall.
+    """
+    trace = {"trace_id": secrets.token_hex(16), "spans": []}
+    token = _ACTIVE_TRACE.set(trace)
+    try:
+        with trace_span(name, **attrs):
+            yield trace
+    finally:
+        _ACTIVE_TRACE.reset(token)
+        otlp = trace_to_otlp(trace)
+        export_trace(otlp)
+        history = st.session_state.get("trace_history")
+        if history is not None:
+            history.insert(0, otlp)
+            del history[TRACE_HISTORY:]
+
+
+def otlp_waterfall_rows(otlp: Dict[str, Any]) -> List[Dict[str, Any]]:
+    spans = otlp["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    if not spans:
+        return []
+    t0 = min(int(sp["startTimeUnixNano"]) for sp in spans)
+    parents = {sp["spanId"]: sp.get("parentSpanId") for sp in spans}
+
+    def depth(sid: Optional[str]) -> int:
+        d = 0
+        while parents.get(sid):
+            sid, d = parents[sid], d + 1
+        return d
+
+    rows = []
+    for i, sp in enumerate(spans):
+        start = (int(sp["startTimeUnixNano"]) - t0) / 1e6
+        end = (int(sp["endTimeUnixNano"]) - t0) / 1e6
+        attrs = {a["key"]: next(iter(a["value"].values())) for a in sp["attributes"]}
+        rows.append({
+            "order": i,
+            "span": "  " * depth(sp["spanId"]) + sp["name"],
+            "start_ms": round(start, 3),
+            "end_ms": round(end, 3),
+            "duration_ms": round(end - start, 3),
+            "status": "error" if sp["status"]["code"] == 2 else "ok",
+            "attributes": ", ".join(f"{k}={v}" for k, v in attrs.items()),
+        })
+    return rows
+
+
+# ----------------------------
+# Metrics: process-wide registry + Prometheus text endpoint
+# ----------------------------
+METRICS_PORT = int(os.environ.get("WOW_METRICS_PORT", "9464"))  # 0 disables the scrape endpoint
+METRICS_HOST = os.environ.get("WOW_METRICS_HOST", "127.0.0.1")  # set 0.0.0.0 to let a remote Prometheus scrape
+METRICS_PREFIX = "wow_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 2e7)
+CHARS_PER_TOKEN = 4  # estimate used when tiktoken is unavailable
+
+# name -> (type, help, histogram buckets)
+METRIC_DEFS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "pdf_generations_total": ("counter", "Spec-to-PDF renders by engine and outcome.", ()),
+    "pdf_render_seconds": ("histogram", "Spec-to-PDF render latency.", LATENCY_BUCKETS),
+    "pdf_output_bytes": ("histogram", "Size of rendered PDFs.", BYTES_BUCKETS),
+    "fill_documents_total": ("counter", "Documents produced by bulk fill, by outcome.", ()),
+    "fill_seconds": ("histogram", "Wall time of a bulk fill run.", LATENCY_BUCKETS),
+    "font_downloads_total": ("counter", "Font download attempts by font and outcome.", ()),
+    "font_download_seconds": ("histogram", "Font download time.", LATENCY_BUCKETS),
+    "agent_step_seconds": ("histogram", "Agent call latency per agent step and model route.", LATENCY_BUCKETS),
+    "agent_tokens_total": ("counter", "Agent tokens by model and direction (estimated without tiktoken).", ()),
+    "cache_hits_total": ("counter", "Cache hits per process-wide cache.", ()),
+    "cache_misses_total": ("counter", "Cache misses per process-wide cache.", ()),
+    "cache_entries": ("gauge", "Current entries per process-wide cache.", ()),
+    "cache_hit_ratio": ("gauge", "hits / (hits + misses) per process-wide cache.", ()),
+}
+
+@functools.lru_cache(maxsize=1)
+def token_encoding():
+    # Loaded on first use: importing tiktoken and building the BPE ranks is not free at startup.
+    try:
+        import tiktoken  # optional exact token counts
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:  # pragma: no cover
+        return None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def prom_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    def esc(v: str) -> str:
+        return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+
+def prom_number(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class MetricsRegistry:
+    """Counters and histograms aggregated across every session of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, Tuple], Any] = {}
+        self._caches: Dict[str, Any] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = METRIC_DEFS[name][2]
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                h = self._values[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h["buckets"][i] += 1
+            h["sum"] += value
+            h["count"] += 1
+
+    def watch_cache(self, name: str, cache: Any):
+        # Caches keep their own hit/miss counters; they are read at scrape time.
+        with self._lock:
+            self._caches[name] = cache
+
+    def cache_samples(self) -> List[Tuple[str, Tuple, float]]:
+        with self._lock:
+            caches = list(self._caches.items())
+        out = []
+        for name, cache in caches:
+            s = cache.stats()
+            lbl = (("cache", name),)
+            total = s["hits"] + s["misses"]
+            out += [
+                ("cache_hits_total", lbl, float(s["hits"])),
+                ("cache_misses_total", lbl, float(s["misses"])),
+                ("cache_entries", lbl, float(s["entries"])),
+                ("cache_hit_ratio", lbl, round(s["hits"] / total, 4) if total else 0.0),
+            ]
+        return out
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = [(k, dict(v) if isinstance(v, dict) else v) for k, v in self._values.items()]
+        rows = []
+        for (name, labels), v in items:
+            row = {"metric": name, "labels": ", ".join(f"{k}={val}" for k, val in labels)}
+            if isinstance(v, dict):
+                row.update({"count": v["count"], "value": round(v["sum"] / v["count"], 4) if v["count"] else 0.0})
+            else:
+                row.update({"count": None, "value": v})
+            rows.append(row)
+        rows += [{"metric": n, "labels": f"cache={lbl[0][1]}", "count": None, "value": v} for n, lbl, v in self.cache_samples()]
+        return sorted(rows, key=lambda r: (r["metric"], r["labels"]))
+
+    def render(self) -> str:
+        with self._lock:
+            items = sorted(((k, dict(v) if isinstance(v, dict) else v) for k, v in self._values.items()), key=lambda kv: kv[0])
+        by_name: Dict[str, List[Tuple[Tuple, Any]]] = {}
+        for (name, labels), v in items:
+            by_name.setdefault(name, []).append((labels, v))
+        for name, labels, v in self.cache_samples():
+            by_name.setdefault(name, []).append((labels, v))
+
+        lines: List[str] = []
+        for name, samples in by_name.items():
+            kind, help_text, buckets = METRIC_DEFS[name]
+            full = METRICS_PREFIX + name
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, v in samples:
+                if kind != "histogram":
+                    lines.append(f"{full}{prom_labels(labels)} {prom_number(v)}")
+                    continue
+                for bound, n in list(zip(buckets, v["buckets"])) + [(float("inf"), v["count"])]:
+                    lines.append(f"{full}_bucket{prom_labels(labels + (('le', prom_number(bound)),))} {n}")
+                lines.append(f"{full}_sum{prom_labels(labels)} {prom_number(round(v['sum'], 6))}")
+                lines.append(f"{full}_count{prom_labels(labels)} {v['count']}")
+        return "\n".join(lines) + "\n"
+
+
+@st.cache_resource
+def get_metrics() -> MetricsRegistry:
+    return MetricsRegistry()
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Dict[str, Any]:
+    """Serves GET /metrics from a daemon thread; one listener per process, shared by all sessions."""
+    if port <= 0:
+        return {"running": False, "host": host, "port": port, "error": "disabled"}
+    try:
+        metrics_listener(port, host)
+    except OSError as e:  # not cached: the next run tries to bind again
+        return {"running": False, "host": host, "port": port, "error": str(e)}
+    return {"running": True, "host": host, "port": port, "error": None}
+
+
+@st.cache_resource
+def metrics_listener(port: int, host: str) -> ThreadingHTTPServer:
+    # cache_resource keeps only successful binds; an OSError propagates and is retried.
+    registry = get_metrics()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="wow-metrics", daemon=True).start()
+    return server
+
+
 # ----------------------------
 # Spec parsing/validation
 # ----------------------------
@@ -577,28 +1251,194 @@ def extract_structured_block(text: str) -> Tuple[str, str]:
     return "raw", (text or "").strip()
 
 
-def parse_pdfspec(text: str) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+# Guards against pathological agent output (huge payloads, alias bombs, deep nesting).
+MAX_SPEC_BYTES = 2_000_000
+MAX_SPEC_DEPTH = 32
+MAX_SPEC_NODES = 500_000
+
+
+def sniff_spec_format(kind: str, payload: str) -> str:
+    if kind in ("yaml", "json"):
+        return kind
+    head = payload.lstrip()[:1]
+    return "json" if head in ("{", "[") else "yaml"
+
+
+def spec_shape_error(obj: Any, max_depth: int = MAX_SPEC_DEPTH, max_nodes: int = MAX_SPEC_NODES) -> Optional[str]:
+    # Iterative walk; shared YAML alias nodes are counted every time they are reached,
+    # which is exactly what bounds "billion laughs" style inputs.
+    stack = [(obj, 1)]
+    nodes = 0
+    while stack:
+        cur, depth = stack.pop()
+        nodes += 1
+        if nodes > max_nodes:
+            return f"Spec has more than {max_nodes} nodes."
+        if depth > max_depth:
+            return f"Spec nesting deeper than {max_depth} levels."
+        if isinstance(cur, dict):
+            stack.extend((v, depth + 1) for v in cur.values())
+        elif isinstance(cur, list):
+            stack.extend((v, depth + 1) for v in cur)
+    return None
+
+
+# Brackets, plus the quoted scalars and comments whose brackets must not count. Quotes
+# only open a scalar at a token boundary, so apostrophes inside plain text are ignored.
+FLOW_TOKEN_RE = re.compile(
+    r"""(?:(?<=[\s\[{,:])|^)(?:"(?:[^"\\\n]|\\.)*"|'(?:[^'\n]|'')*')|(?:(?<=\s)|^)#[^\n]*|[\[\]{}]""",
+    re.MULTILINE,
+)
+
+
+def flow_nesting_depth(payload: str) -> int:
+    # Deep flow nesting can crash the C loaders before any post-parse check runs.
+    depth = peak = 0
+    for m in FLOW_TOKEN_RE.finditer(payload):
+        tok = m.group()
+        if tok in ("[", "{"):
+            depth += 1
+            peak = max(peak, depth)
+        elif tok in ("]", "}"):
+            depth = max(depth - 1, 0)  # a stray closer must not hide the nesting that follows
+    return peak
+
+
+def load_json_fast(payload: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+@traced("spec.parse", lambda r, a, kw: {"chars": len(a[0]), "errors": len(r[1]), **(kw.get("stats") or {})})
+def parse_pdfspec(text: str, stats: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Dict[str, Any]], List[str]]:
     kind, payload = extract_structured_block(text)
     if not payload:
         return None, ["Spec is empty."]
+    size = len(payload.encode("utf-8"))
+    fmt = sniff_spec_format(kind, payload)
+    if stats is not None:
+        stats.update({"format": fmt, "bytes": size, "loader": None, "parse_ms": 0.0})
+    if size > MAX_SPEC_BYTES:
+        return None, [f"Spec is {size} bytes; limit is {MAX_SPEC_BYTES}."]
+    if flow_nesting_depth(payload) > MAX_SPEC_DEPTH:
+        return None, [f"Spec nesting deeper than {MAX_SPEC_DEPTH} levels."]
+
+    # Sniffed format goes first; the other loader only runs if it fails ("raw" input).
+    order = [fmt] if kind != "raw" else [fmt, "yaml" if fmt == "json" else "json"]
     errors: List[str] = []
-    if kind in ("yaml", "raw"):
-        try:
-            obj = yaml.safe_load(payload)
-            if isinstance(obj, dict):
-                return obj, []
-        except Exception as e:
-            errors.append(f"YAML parse error: {e}")
-    if kind in ("json", "raw"):
+    start = time.perf_counter()
+    for f in order:
         try:
-            obj = json.loads(payload)
-            if isinstance(obj, dict):
-                return obj, []
+            if f == "json":
+                obj = load_json_fast(payload)
+                loader = "orjson" if orjson is not None else "json"
+            else:
+                obj = yaml.load(payload, Loader=YamlSafeLoader)
+                loader = YamlSafeLoader.__name__
+        except RecursionError:
+            errors.append(f"{f.upper()} parse error: nesting too deep.")
+            continue
         except Exception as e:
-            errors.append(f"JSON parse error: {e}")
+            errors.append(f"{f.upper()} parse error: {e}")
+            continue
+        if stats is not None:
+            stats["loader"] = loader
+            stats["parse_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        if not isinstance(obj, dict):
+            continue
+        shape_err = spec_shape_error(obj)
+        if shape_err:
+            return None, [shape_err]
+        return obj, []
+    if stats is not None:
+        stats["parse_ms"] = round((time.perf_counter() - start) * 1000, 3)
     return None, errors or ["Parsed content is not an object/dict."]
 
 
+FENCED_BLOCK_RE = re.compile(r"```(yaml|yml|jsonl|ndjson|json)[^\n]*\n(.*?)```", flags=re.DOTALL | re.IGNORECASE)
+
+
+def iter_structured_blocks(text: str) -> Iterator[Tuple[str, str]]:
+    # Every fenced yaml/json/jsonl block in document order; the whole text if none.
+    found = False
+    for m in FENCED_BLOCK_RE.finditer(text or ""):
+        found = True
+        kind = m.group(1).lower()
+        kind = {"yml": "yaml", "ndjson": "jsonl"}.get(kind, kind)
+        yield kind, m.group(2).strip()
+    if not found:
+        payload = (text or "").strip()
+        lines = [ln for ln in payload.splitlines()[:3] if ln.strip()]
+        if len(lines) > 1 and all(ln.lstrip().startswith("{") for ln in lines):
+            yield "jsonl", payload
+        else:
+            yield "raw", payload
+
+
+YAML_DOC_START_RE = re.compile(r"^(?=---(?:[ \t]|$))", re.MULTILINE)
+
+
+def iter_yaml_documents(payload: str) -> Iterator[str]:
+    # "---" only starts a document at column 0, so a textual split yields the same documents
+    # load_all would, while letting the size/nesting guards run on each one separately.
+    pending = ""
+    for chunk in YAML_DOC_START_RE.split(payload):
+        if not chunk.strip():
+            continue
+        body = [ln for ln in chunk.splitlines() if ln.strip() and not ln.lstrip().startswith("#")]
+        if all(ln.startswith("%") for ln in body):
+            pending += chunk  # directives/comments belong to the document that follows
+            continue
+        yield pending + chunk
+        pending = ""
+
+
+def iter_pdfspecs(text: str) -> Iterator[Tuple[str, Optional[Dict[str, Any]], List[str]]]:
+    """
+    Lazily yields (label, spec_obj, errors) for every spec in a bulk source: all fenced
+    blocks, YAML multi-document streams (---) and JSONL lines. Each document gets the
+    same guards as parse_pdfspec.
+    """
+    for bi, (kind, payload) in enumerate(iter_structured_blocks(text), start=1):
+        if not payload:
+            continue
+        if kind == "jsonl":
+            docs = ((f"block {bi} line {li}", line) for li, line in enumerate(payload.splitlines(), start=1) if line.strip())
+            for label, line in docs:
+                yield (label,) + parse_pdfspec("```json\n" + line + "\n```")
+            continue
+        fmt = sniff_spec_format(kind, payload)
+        if fmt == "json":
+            yield (f"block {bi}",) + parse_pdfspec("```json\n" + payload + "\n```")
+            continue
+        di = 0
+        for doc in iter_yaml_documents(payload):
+            di += 1
+            label = f"block {bi} doc {di}"
+            size = len(doc.encode("utf-8"))
+            if size > MAX_SPEC_BYTES:
+                yield label, None, [f"Spec is {size} bytes; limit is {MAX_SPEC_BYTES}."]
+                continue
+            if flow_nesting_depth(doc) > MAX_SPEC_DEPTH:
+                yield label, None, [f"Spec nesting deeper than {MAX_SPEC_DEPTH} levels."]
+                continue
+            try:
+                objs = list(yaml.load_all(doc, Loader=YamlSafeLoader))
+            except Exception as e:
+                yield label, None, [f"YAML parse error: {e}"]
+                continue
+            for obj in objs:
+                if obj is None:
+                    continue
+                if not isinstance(obj, dict):
+                    yield label, None, ["Parsed content is not an object/dict."]
+                    continue
+                shape_err = spec_shape_error(obj)
+                yield (label, None, [shape_err]) if shape_err else (label, obj, [])
+
+
+@traced("spec.normalize")
 def normalize_units_in_place(spec: Dict[str, Any], target_unit: str) -> Tuple[List[str], List[str]]:
     warnings, errors = [], []
     doc = spec.get("document", {}) or {}
@@ -641,7 +1481,8 @@ def normalize_units_in_place(spec: Dict[str, Any], target_unit: str) -> Tuple[Li
     return warnings, errors
 
 
-def validate_pdfspec(spec: Dict[str, Any], unit_fallback: str, page_fallback: str) -> Dict[str, Any]:
+@traced("spec.validate", lambda r, a, kw: {"errors": len(r["errors"]), "warnings": len(r["warnings"]), "fields": (r.get("field_stats") or {}).get("total", 0)})
+def validate_pdfspec(spec: Dict[str, Any], unit_fallback: str, page_fallback: str, label_fit: Optional[str] = None) -> Dict[str, Any]:
     errors: List[str] = []
     warnings: List[str] = []
     if not isinstance(spec, dict):
@@ -732,11 +1573,14 @@ def validate_pdfspec(spec: Dict[str, Any], unit_fallback: str, page_fallback: st
                     if not isinstance(opts, list) or not opts:
                         errors.append(f"Field '{fid}': '{ftype}' requires non-empty options.")
 
+    text_stats = fit_labels(spec_norm, label_fit, warnings) if not errors else {}
+
     return {
         "errors": errors,
         "warnings": warnings,
         "normalized": spec_norm,
         "field_stats": {"total": sum(counts.values()), "by_type": counts, "unique_ids": len(field_ids)},
+        "text_stats": text_stats,
     }
 
 
@@ -771,9 +1615,184 @@ def choose_font_family_for_text(text: str, default_family: str, cjk_family: str,
     return "Helvetica"
 
 
+# ----------------------------
+# Text metrics: cached glyph advances, label overflow and fitting
+# ----------------------------
+LABEL_FIT_MODES = ["none", "wrap", "shrink"]
+LABEL_LEADING = 1.2  # line height as a multiple of the font size
+LABEL_MIN_SIZE = 6.0
+LABEL_BAND_MM = 10.0
+
+
+class TextMetrics:
+    """
+    Glyph advance tables (1/1000 em) per font, built once per process. TTF tables are
+    copied from the parsed face; standard fonts fill lazily one code point at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables: Dict[str, Tuple[Dict[int, float], float]] = {}
+
+    def table(self, family: str) -> Tuple[Dict[int, float], float]:
+        entry = self._tables.get(family)
+        if entry is None:
+            with self._lock:
+                entry = self._tables.get(family)
+                if entry is None:
+                    face = getattr(pdfmetrics.getFont(family), "face", None)
+                    widths = dict(getattr(face, "charWidths", None) or {})
+                    entry = (widths, float(getattr(face, "defaultWidth", 0) or 0))
+                    self._tables[family] = entry
+        return entry
+
+    def width_pt(self, text: str, family: str, size: float) -> float:
+        widths, default = self.table(family)
+        total = 0.0
+        for ch in text:
+            cp = ord(ch)
+            adv = widths.get(cp)
+            if adv is None:
+                adv = widths[cp] = pdfmetrics.stringWidth(ch, family, 1000) if not default else default
+            total += adv
+        return total * size / 1000.0
+
+    def width_mm(self, text: str, family: str, size: float) -> float:
+        return self.width_pt(text, family, size) * MM_PER_PT
+
+    def wrap(self, text: str, family: str, size: float, max_mm: float) -> List[str]:
+        # Greedy on spaces; CJK runs may break between any two characters.
+        tokens = re.findall(r"[\u2E80-\u9FFF\uF900-\uFAFF]|[^\s\u2E80-\u9FFF\uF900-\uFAFF]+|\s+", text)
+        lines: List[str] = []
+        cur = ""
+        for tok in tokens:
+            cand = cur + tok
+            if not cur or self.width_mm(cand.rstrip(), family, size) <= max_mm:
+                cur = cand
+                continue
+            lines.append(cur.rstrip())
+            cur = tok.lstrip()
+            while cur and self.width_mm(cur, family, size) > max_mm and len(cur) > 1:
+                cut = len(cur) - 1
+                while cut > 1 and self.width_mm(cur[:cut], family, size) > max_mm:
+                    cut -= 1
+                lines.append(cur[:cut])
+                cur = cur[cut:]
+        if cur.strip():
+            lines.append(cur.rstrip())
+        return lines or [""]
+
+
+@st.cache_resource
+def get_text_metrics() -> TextMetrics:
+    return TextMetrics()
+
+
+def element_tops(elements: List[Dict[str, Any]], to_mm: float, base_size: float) -> List[Tuple[float, float, int]]:
+    """(top mm, left mm, element index) for a page, sorted top to bottom; built once per page."""
+    tops = []
+    for i, el in enumerate(elements):
+        try:
+            x, y = float(el.get("x") or 0) * to_mm, float(el.get("y") or 0) * to_mm
+            if (el.get("type") or "").lower() == "label":
+                y -= float(el.get("size") or base_size) * 0.8 * MM_PER_PT
+        except (TypeError, ValueError):
+            continue
+        tops.append((y, x, i))
+    tops.sort()
+    return tops
+
+
+def room_below(tops: List[Tuple[float, float, int]], index: int, x: float, y: float, limit: float) -> float:
+    # First element below y whose left edge falls in [x, limit); the list is sorted by top.
+    for top, ox, i in tops[bisect.bisect_right(tops, (y, math.inf, math.inf)):]:
+        if i != index and x <= ox < limit:
+            return top
+    return math.inf
+
+
+@traced("spec.measure_labels", lambda r, a, kw: {k: r[k] for k in ("labels", "overflow", "wrapped", "shrunk")})
+def fit_labels(spec_norm: Dict[str, Any], label_fit: Optional[str], warnings: List[str]) -> Dict[str, Any]:
+    """
+    Measures every label against the room it has: up to the first field to its right on
+    the same line, else the right margin. Overflow is a warning unless the label (or the
+    label_fit fallback) asks for "wrap" (sets "lines") or "shrink" (lowers "size").
+    """
+    start = time.time()
+    metrics = get_text_metrics()
+    available = reportlab_register_fonts([])
+    default_family, cjk_family, base_size = spec_font_families(spec_norm)
+    doc = spec_norm.get("document") or {}
+    to_mm = MM_PER_PT if doc.get("unit") == "pt" else 1.0
+    page_w, _ = page_dims_mm(doc.get("page_size", "A4"), doc.get("orientation", "portrait"))
+    right_edge = page_w - float((doc.get("margin") or {}).get("right", 0) or 0) * to_mm
+    stats = {"labels": 0, "overflow": 0, "wrapped": 0, "shrunk": 0}
+
+    for pi, p in enumerate(spec_norm.get("pages") or [], start=1):
+        elements = [el for el in (p or {}).get("elements") or [] if isinstance(el, dict)]
+        bands: Dict[int, List[Tuple[float, float, float]]] = {}
+        for el in elements:
+            if (el.get("type") or "").lower() == "field":
+                x, y, h = (float(el.get(k) or 0) * to_mm for k in ("x", "y", "h"))
+                for b in range(int(y // LABEL_BAND_MM), int((y + h) // LABEL_BAND_MM) + 1):
+                    bands.setdefault(b, []).append((x, y, y + h))
+
+        tops: Optional[List[Tuple[float, float, int]]] = None
+        for ei, el in enumerate(elements, start=1):
+            if (el.get("type") or "").lower() != "label" or not el.get("text"):
+                continue
+            stats["labels"] += 1
+            text = str(el["text"])
+            x, y = float(el.get("x") or 0) * to_mm, float(el.get("y") or 0) * to_mm
+            try:
+                size = float(el.get("size") or base_size)
+            except (TypeError, ValueError):
+                warnings.append(f"Page {pi} label {ei}: invalid size {el.get('size')!r}, using {base_size:g}.")
+                el.pop("size")
+                size = base_size
+            top, bottom = y - size * 0.8 * MM_PER_PT, y + size * 0.4 * MM_PER_PT
+            limit = right_edge
+            for b in range(int(top // LABEL_BAND_MM), int(bottom // LABEL_BAND_MM) + 1):
+                for fx, ftop, fbottom in bands.get(b, ()):
+                    if fx > x and ftop < bottom and fbottom > top:
+                        limit = min(limit, fx)
+            room = limit - x - 1.0
+            family = choose_font_family_for_text(text, default_family, cjk_family, available)
+            width = metrics.width_mm(text, family, size)
+            if width <= room:
+                continue
+            mode = str(el.get("fit") or label_fit or "none").lower()
+            if mode == "shrink" and room > 0:
+                new_size = max(LABEL_MIN_SIZE, math.floor(size * room / width * 10) / 10)
+                el["size"] = new_size
+                stats["shrunk"] += 1
+                width = width * new_size / size
+                if width <= room:
+                    continue
+            elif mode == "wrap" and room > 0:
+                el["lines"] = metrics.wrap(text, family, size, room)
+                stats["wrapped"] += 1
+                # The extra lines grow downwards: they must clear whatever sits below in the same column.
+                wrapped_bottom = y + ((len(el["lines"]) - 1) * LABEL_LEADING + 0.4) * size * MM_PER_PT
+                if tops is None:
+                    tops = element_tops(elements, to_mm, base_size)
+                below = room_below(tops, ei - 1, x, y, limit)
+                if wrapped_bottom <= below:
+                    continue
+                stats["overflow"] += 1
+                warnings.append(f"Page {pi} label {ei}: wrapped text runs {wrapped_bottom - below:.1f} mm into the element below ('{text[:30]}').")
+                continue
+            stats["overflow"] += 1
+            warnings.append(f"Page {pi} label {ei}: text overflows by {width - room:.1f} mm ('{text[:30]}').")
+
+    stats["ms"] = round((time.time() - start) * 1000, 2)
+    return stats
+
+
 # ----------------------------
 # Engine A: fpdf2 generator (Unicode + AcroForm)
 # ----------------------------
+@traced("fonts.register", lambda r, a, kw: {"engine": "fpdf2", "fonts": sum(1 for v in r.values() if v)})
 def fpdf2_register_fonts(pdf: FPDF, render_log: List[str]) -> Dict[str, bool]:
     reg: Dict[str, bool] = {}
     for family, meta in FONT_REGISTRY.items():
@@ -792,6 +1811,12 @@ def fpdf2_register_fonts(pdf: FPDF, render_log: List[str]) -> Dict[str, bool]:
     return reg
 
 
+# Fixed creation date and no random document ID (ReportLab's invariant mode uses the same
+# date), so the same spec always renders to the same bytes and the artifact store dedupes it.
+PDF_CREATION_DATE = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+@traced("render.fpdf2", lambda r, a, kw: {"bytes": len(r[0]), "pages": len(a[0].get("pages") or [])})
 def generate_pdf_fpdf2(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]:
     render_log: List[str] = []
     doc = spec_norm.get("document") or {}
@@ -800,6 +1825,7 @@ def generate_pdf_fpdf2(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]:
 
     fmt, orient = fpdf_format_orientation(page_size, orientation)
     pdf = FPDF(orientation=orient, unit="mm", format=fmt)
+    pdf.set_creation_date(PDF_CREATION_DATE)
     pdf.set_auto_page_break(auto=False)
 
     fonts_cfg = spec_norm.get("fonts") or {}
@@ -815,10 +1841,16 @@ def generate_pdf_fpdf2(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]:
         fs = ensure_unicode_fonts()
         st.session_state.unicode_fonts_status = fs
 
-    available = fpdf2_register_fonts(pdf, render_log)
+    # TTF parsing dominates small renders; a fields-only layer never needs it.
+    has_labels = any(
+        isinstance(el, dict) and (el.get("type") or "").lower() == "label"
+        for p in (spec_norm.get("pages") or []) for el in ((p or {}).get("elements") or [])
+    )
+    available = fpdf2_register_fonts(pdf, render_log) if has_labels else {}
 
     pages = spec_norm.get("pages") or []
-    for p in pages:
+
+    def render_page(page_i: int, p: Any):
         pdf.add_page()
         elements = (p or {}).get("elements") or []
         for el in elements:
@@ -846,7 +1878,10 @@ def generate_pdf_fpdf2(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]:
                         render_log.append(f"fpdf2: style '{style}' unavailable for {family}; used regular")
 
                 pdf.set_xy(x, y)
-                pdf.multi_cell(w=0, h=5, text=txt)
+                if el.get("lines"):
+                    pdf.multi_cell(w=0, h=size * LABEL_LEADING * MM_PER_PT, text="\n".join(el["lines"]))
+                else:
+                    pdf.multi_cell(w=0, h=5, text=txt)
 
             elif et == "field":
                 fid = str(el.get("id") or "")
@@ -883,7 +1918,12 @@ def generate_pdf_fpdf2(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]:
                     pdf.cell(w=w - 3, h=h - 3, text=sanitize_to_latin1(f"[{ftype}] {name}"), border=0)
                     render_log.append(f"fpdf2: field render failed {fid} err={e}")
 
-    out = pdf.output(dest="S")
+    for page_i, p in enumerate(pages, start=1):
+        with trace_span("render.page", page=page_i, elements=len((p or {}).get("elements") or [])):
+            render_page(page_i, p)
+
+    with trace_span("render.serialize"):
+        out = pdf.output(dest="S")
     pdf_bytes = bytes(out) if isinstance(out, (bytes, bytearray)) else out.encode("latin-1")
     return pdf_bytes, render_log
 
@@ -891,6 +1931,7 @@ def generate_pdf_fpdf2(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]:
 # ----------------------------
 # Engine B: ReportLab generator (Unicode + AcroForm)
 # ----------------------------
+@traced("fonts.register", lambda r, a, kw: {"engine": "reportlab", "fonts": sum(1 for v in r.values() if v)})
 def reportlab_register_fonts(render_log: List[str]) -> Dict[str, bool]:
     # Register fonts globally in pdfmetrics (safe to call multiple times)
     reg: Dict[str, bool] = {}
@@ -916,6 +1957,70 @@ def reportlab_register_fonts(render_log: List[str]) -> Dict[str, bool]:
     return reg
 
 
+# ReportLab AcroForm widgets only accept the standard 14 fonts; fields that need a TTF get
+# their appearance and /DA patched in afterwards (rl_apply_ttf_appearance).
+RL_FORM_FONT = "Helvetica"
+
+
+def rl_widget_family(content: str, label: str, default_family: str, cjk_family: str, available: Dict[str, bool]) -> str:
+    # CJK in the value/options, or in the label right before the field, keeps the CJK TTF;
+    # other non-Latin-1 values use the default TTF; everything else stays on Helvetica.
+    if CJK_RE.search(content + label) and available.get(cjk_family):
+        return cjk_family
+    if is_latin1(content) or not available.get(default_family):
+        return RL_FORM_FONT
+    return default_family
+
+
+class RLFormResources(pdfdoc.PDFObject):
+    """AcroForm /DR that also lists the document's own fonts, so a widget /DA can name a TTF subset."""
+
+    def __init__(self, acro):
+        self.acro = acro
+
+    def format(self, document):
+        fonts = dict(document.idToObject[pdfdoc.BasicFonts].dict)
+        fonts.update({k: PDFFromString(v) for k, v in self.acro.fonts.items()})
+        return pdfdoc.PDFDictionary({
+            "Font": pdfdoc.PDFDictionary(fonts),
+            "Encoding": PDFFromString(f"<< /RLAFencoding {self.acro.encRefStr} >>"),
+        }).format(document)
+
+
+def rl_apply_ttf_appearance(
+    c,
+    family: str,
+    size: float,
+    value: str,
+    options: List[str],
+    w: float,
+    h: float,
+    multiline: bool,
+    available: Dict[str, bool],
+) -> None:
+    """
+    Gives the widget just created on canvas c (with Latin-1 placeholders, which is all
+    ReportLab can encode) its real value/options, a normal appearance drawn with a
+    registered TTF (a named form on the same canvas, so the font subset gains these
+    glyphs) and a /DA naming that font.
+    """
+    acro = c.acroForm
+    annot = c._doc.idToObject[acro.fields[-1].name]  # pylint: disable=protected-access
+    form_name = f"wow_ap_{len(acro.fields)}"
+    c.beginForm(form_name, 0, 0, w, h)
+    info = {"ft": "/Tx", "value": value, "flags": FF_MULTILINE if multiline else 0, "rect": [0.0, 0.0, w, h]}
+    draw_flat_field(c, info, family, family, available, size)
+    c.endForm()
+    font_res = pdfmetrics.getFont(family).getSubsetInternalName(0, c._doc)  # pylint: disable=protected-access
+    annot.dict["AP"] = pdfdoc.PDFDictionary({"N": pdfdoc.PDFObjectReference(pdfdoc.xObjectName(form_name))})
+    annot.dict["DA"] = pdfdoc.PDFString(f"{font_res} {size:g} Tf 0 g")
+    annot.dict["V"] = annot.dict["DV"] = pdfdoc.PDFString(value)
+    if options:
+        annot.dict["Opt"] = pdfdoc.PDFArray([pdfdoc.PDFString(o) for o in options])
+        annot.dict.pop("I", None)
+    acro.extras["DR"] = RLFormResources(acro)
+
+
 def rl_font_for_text(text: str, default_family: str, cjk_family: str, available: Dict[str, bool]) -> str:
     if isinstance(text, str) and CJK_RE.search(text) and available.get(cjk_family):
         return cjk_family
@@ -924,6 +2029,7 @@ def rl_font_for_text(text: str, default_family: str, cjk_family: str, available:
     return "Helvetica"
 
 
+@traced("render.reportlab", lambda r, a, kw: {"bytes": len(r[0]), "pages": len(a[0].get("pages") or [])})
 def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]:
     render_log: List[str] = []
     doc = spec_norm.get("document") or {}
@@ -949,7 +2055,7 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
     available = reportlab_register_fonts(render_log)
 
     buf = io.BytesIO()
-    c = canvas.Canvas(buf, pagesize=(w_pt, h_pt))
+    c = canvas.Canvas(buf, pagesize=(w_pt, h_pt), invariant=1)
 
     # A simple “top-left mm” coordinate conversion:
     # spec y is from top; ReportLab y is from bottom.
@@ -960,8 +2066,10 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
         return h_pt - (y_mm * RL_MM) - (field_h_mm * RL_MM)
 
     pages = spec_norm.get("pages") or []
-    for page_i, p in enumerate(pages, start=1):
+
+    def render_page(page_i: int, p: Any):
         elements = (p or {}).get("elements") or []
+        prev_label = ""
         for el in elements:
             if not isinstance(el, dict):
                 continue
@@ -969,6 +2077,7 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
 
             if et == "label":
                 txt = str(el.get("text") or "")
+                prev_label = txt
                 family = rl_font_for_text(txt, default_family, cjk_family, available)
                 if family == "Helvetica" and not available.get(default_family) and not available.get(cjk_family):
                     txt = sanitize_to_latin1(txt)
@@ -984,7 +2093,8 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
 
                 c.setFont(family, size)
                 # drawString uses baseline; move a bit down for a nicer alignment vs spec's top coordinate
-                c.drawString(x_mm * RL_MM, y_label_top_to_rl(y_mm) - 3, txt)
+                for li, line in enumerate(el.get("lines") or [txt]):
+                    c.drawString(x_mm * RL_MM, y_label_top_to_rl(y_mm) - 3 - li * size * LABEL_LEADING, line)
 
             elif et == "field":
                 fid = str(el.get("id") or "")
@@ -1001,6 +2111,13 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
                 y = y_field_top_to_rl(y_mm, h_mm_)
                 w = w_mm_ * RL_MM
                 h = h_mm_ * RL_MM
+                options = [str(o) for o in el.get("options") or []] if ftype in ("dropdown", "combo") else []
+                shown = str(value) if value is not None else (options[0] if options else "")
+                family = RL_FORM_FONT
+                if ftype != "checkbox":
+                    family = rl_widget_family(shown + "".join(options), prev_label, default_family, cjk_family, available)
+                # ReportLab can only encode Latin-1; TTF fields get their real text patched in afterwards.
+                rl_value, rl_options = (shown, options) if family == RL_FORM_FONT else (" ", [" "])
 
                 try:
                     if ftype in ("text", "textarea"):
@@ -1009,11 +2126,11 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
                         c.acroForm.textfield(
                             name=name,
                             x=x, y=y, width=w, height=h,
-                            value=str(value) if value is not None else "",
+                            value=rl_value,
                             borderStyle="inset",
                             forceBorder=True,
                             fieldFlags=flags,
-                            fontName=default_family if available.get(default_family) else "Helvetica",
+                            fontName=RL_FORM_FONT,
                             fontSize=max(8, base_size),
                         )
                     elif ftype == "checkbox":
@@ -1026,29 +2143,31 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
                             borderWidth=1,
                         )
                     elif ftype in ("dropdown", "combo"):
-                        options = el.get("options") or []
                         c.acroForm.choice(
                             name=name,
                             x=x, y=y, width=w, height=h,
-                            options=[str(o) for o in options],
-                            value=str(value) if value is not None else "",
+                            options=rl_options,
+                            # ReportLab's choice() needs a selected value; default to the first option.
+                            value=rl_value,
                             fieldFlags=0,
                             borderStyle="inset",
                             forceBorder=True,
-                            fontName=default_family if available.get(default_family) else "Helvetica",
+                            fontName=RL_FORM_FONT,
                             fontSize=max(8, base_size),
                         )
                     else:
                         c.acroForm.textfield(
                             name=name,
                             x=x, y=y, width=w, height=h,
-                            value=str(value) if value is not None else "",
+                            value=rl_value,
                             borderStyle="inset",
                             forceBorder=True,
-                            fontName=default_family if available.get(default_family) else "Helvetica",
+                            fontName=RL_FORM_FONT,
                             fontSize=max(8, base_size),
                         )
                         render_log.append(f"reportlab: fallback field type '{ftype}' -> text for {fid}")
+                    if family != RL_FORM_FONT:
+                        rl_apply_ttf_appearance(c, family, max(8, base_size), shown, options, w, h, multiline, available)
                 except Exception as e:
                     # fallback: draw a rectangle placeholder
                     c.rect(x, y, w, h, stroke=1, fill=0)
@@ -1059,7 +2178,12 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
         if page_i < len(pages):
             c.showPage()
 
-    c.save()
+    for page_i, p in enumerate(pages, start=1):
+        with trace_span("render.page", page=page_i, elements=len((p or {}).get("elements") or [])):
+            render_page(page_i, p)
+
+    with trace_span("render.serialize"):
+        c.save()
     pdf_bytes = buf.getvalue()
     buf.close()
     return pdf_bytes, render_log
@@ -1068,12 +2192,12 @@ def generate_pdf_reportlab(spec_norm: Dict[str, Any]) -> Tuple[bytes, List[str]]
 # ----------------------------
 # Post-process: set NeedAppearances (helps some viewers show/edit fields)
 # ----------------------------
+@traced("postprocess.need_appearances", lambda r, a, kw: {"bytes": len(r[0]), "changed": r[1]})
 def set_need_appearances(pdf_bytes: bytes) -> Tuple[bytes, bool]:
     try:
         r = PdfReader(io.BytesIO(pdf_bytes))
-        w = PdfWriter()
-        for page in r.pages:
-            w.add_page(page)
+        # clone_from keeps the catalog's /AcroForm (add_page alone drops it).
+        w = PdfWriter(clone_from=r)
         root = w._root_object  # pylint: disable=protected-access
         acro = root.get("/AcroForm")
         if acro is None:
@@ -1081,7 +2205,8 @@ def set_need_appearances(pdf_bytes: bytes) -> Tuple[bytes, bool]:
             out = io.BytesIO()
             w.write(out)
             return out.getvalue(), False
-        acro.update({"/NeedAppearances": True})
+        acro = acro.get_object()
+        acro[NameObject("/NeedAppearances")] = BooleanObject(True)
         out = io.BytesIO()
         w.write(out)
         return out.getvalue(), True
@@ -1090,104 +2215,1359 @@ def set_need_appearances(pdf_bytes: bytes) -> Tuple[bytes, bool]:
 
 
 # ----------------------------
-# Export scripts (PY / JS) based on spec
+# Flatten: bake field values into page content (no AcroForm left)
 # ----------------------------
-def safe_json(obj: Any) -> str:
-    return json.dumps(obj, ensure_ascii=False, indent=2)
+FLATTEN_BORDER_GRAY = 0.55
+FF_MULTILINE = 4096
 
 
-def build_py_script_fpdf2(spec_norm: Dict[str, Any]) -> str:
-    # Best-effort standalone script (requires fpdf2 + downloaded fonts alongside script).
-    return f"""# Generated by WOW Agentic PDF Studio (fpdf2)
-# Requirements: fpdf2
-# Fonts: place DejaVuSans.ttf and NotoSansTC-Regular.ttf in ./fonts_cache or adjust paths
+def widget_field_info(annot: DictionaryObject) -> Dict[str, Any]:
+    # Merged field/widget dicts (ReportLab) or kids pointing at a /Parent field (pypdf, fpdf2).
+    parent = annot.get("/Parent")
+    parent = parent.get_object() if parent is not None else DictionaryObject()
 
-import json
-from fpdf import FPDF
+    def inherited(key: str) -> Any:
+        return annot.get(key) if key in annot else parent.get(key)
 
-SPEC = {safe_json(spec_norm)}
+    ft = str(inherited("/FT") or "")
+    value = annot.get("/AS") if ft == "/Btn" and "/AS" in annot else inherited("/V")
+    return {
+        "ft": ft,
+        "value": "" if value is None else str(value),
+        "flags": int(inherited("/Ff") or 0),
+        "rect": [float(v) for v in annot.get("/Rect") or [0, 0, 0, 0]],
+    }
 
-FONT_PATHS = {{
-  "DejaVuSans": "fonts_cache/DejaVuSans.ttf",
-  "NotoSansTC": "fonts_cache/NotoSansTC-Regular.ttf",
-}}
 
-def choose_font(text, default_family="DejaVuSans", cjk_family="NotoSansTC"):
-    for ch in text:
-        if '\\u4e00' <= ch <= '\\u9fff':
-            return cjk_family
-    return default_family
+def draw_flat_field(c, info: Dict[str, Any], default_family: str, cjk_family: str, available: Dict[str, bool], base_size: float):
+    x1, y1, x2, y2 = info["rect"]
+    x, y, w, h = min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1)
+    c.setStrokeGray(FLATTEN_BORDER_GRAY)
+    c.setLineWidth(0.5)
+    c.rect(x, y, w, h, stroke=1, fill=0)
+    value = info["value"]
+    if info["ft"] == "/Btn":
+        if value and value != "/Off":
+            c.setStrokeGray(0)
+            c.setLineWidth(max(0.8, min(w, h) / 10))
+            c.line(x + w * 0.2, y + h * 0.5, x + w * 0.42, y + h * 0.22)
+            c.line(x + w * 0.42, y + h * 0.22, x + w * 0.8, y + h * 0.8)
+        return
+    if not value:
+        return
+    # Latin-1 values use the built-in Helvetica (nothing to embed); anything else goes
+    # through the same Unicode/CJK selection as labels.
+    try:
+        value.encode("latin-1")
+        family = "Helvetica"
+    except UnicodeEncodeError:
+        family = choose_font_family_for_text(value, default_family, cjk_family, available)
+        if family == "Helvetica":
+            value = sanitize_to_latin1(value)
+    multiline = bool(info["flags"] & FF_MULTILINE)
+    size = min(base_size, max(6.0, h - 4)) if not multiline else base_size
+    c.setFillGray(0)
+    c.setFont(family, size)
+    path = c.beginPath()
+    path.rect(x, y, w, h)
+    c.saveState()
+    c.clipPath(path, stroke=0, fill=0)
+    if multiline:
+        line_y = y + h - 2 - size
+        for line in value.splitlines() or [value]:
+            if line_y < y:
+                break
+            c.drawString(x + 2, line_y, line)
+            line_y -= size * 1.2
+    else:
+        c.drawString(x + 2, y + (h - size) / 2 + size * 0.22, value.replace("\n", " "))
+    c.restoreState()
 
-def main():
-    doc = SPEC.get("document", {{}})
-    page_size = (doc.get("page_size") or "A4").upper()
-    orientation = (doc.get("orientation") or "portrait").lower()
-    fmt = "LETTER" if page_size == "LETTER" else "A4"
-    orient = "L" if orientation == "landscape" else "P"
 
-    pdf = FPDF(orientation=orient, unit="mm", format=fmt)
-    pdf.set_auto_page_break(auto=False)
+@traced("postprocess.flatten", lambda r, a, kw: {"bytes": len(r[0])})
+def flatten_pdf_bytes(
+    pdf_bytes: bytes,
+    default_family: str = "DejaVuSans",
+    cjk_family: str = "NotoSansTC",
+    base_size: float = 10.0,
+) -> Tuple[bytes, List[str]]:
+    """
+    Draws every widget's value (and a border) into page content with ReportLab, using the
+    registered Unicode fonts picked per value, then drops the widgets and /AcroForm.
+    Works on freshly generated PDFs and on filled ones alike.
+    """
+    log: List[str] = []
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    writer = PdfWriter(clone_from=reader)
+    available = reportlab_register_fonts(log)
+
+    overlay_buf = io.BytesIO()
+    c = canvas.Canvas(overlay_buf)
+    widgets_per_page: List[int] = []
+    for page in writer.pages:
+        box = page.mediabox
+        c.setPageSize((float(box.width), float(box.height)))
+        c.translate(-float(box.left), -float(box.bottom))
+        count = 0
+        for annot_ref in page.get("/Annots") or []:
+            annot = annot_ref.get_object()
+            if annot.get("/Subtype") != "/Widget":
+                continue
+            draw_flat_field(c, widget_field_info(annot), default_family, cjk_family, available, base_size)
+            count += 1
+        widgets_per_page.append(count)
+        c.showPage()
+    c.save()
 
-    # Register fonts
-    for fam, path in FONT_PATHS.items():
-        try:
-            pdf.add_font(fam, style="", fname=path, uni=True)
-        except Exception:
-            pass
+    overlay = PdfReader(io.BytesIO(overlay_buf.getvalue()))
+    for page, ov, count in zip(writer.pages, overlay.pages, widgets_per_page):
+        if count:
+            page.merge_page(ov)
+    writer.remove_annotations(subtypes="/Widget")
+    writer._root_object.pop("/AcroForm", None)  # pylint: disable=protected-access
+    out = io.BytesIO()
+    writer.write(out)
+    flat = out.getvalue()
+    log.append(f"flatten: {sum(widgets_per_page)} widgets baked into content; {len(pdf_bytes)} -> {len(flat)} bytes")
+    return flat, log
 
-    fonts = SPEC.get("fonts", {{}})
-    default_family = (fonts.get("default") or {{}}).get("family", "DejaVuSans")
-    cjk_family = (fonts.get("cjk") or {{}}).get("family", "NotoSansTC")
-    base_size = float((fonts.get("default") or {{}}).get("size", 11))
 
-    for page in SPEC.get("pages", []):
-        pdf.add_page()
-        for el in (page or {{}}).get("elements", []):
-            if (el.get("type") or "").lower() == "label":
-                txt = str(el.get("text") or "")
-                fam = choose_font(txt, default_family, cjk_family)
-                x = float(el.get("x") or 0)
-                y = float(el.get("y") or 0)
-                size = float(el.get("size") or base_size)
-                pdf.set_font(fam, size=size)
-                pdf.set_xy(x, y)
-                pdf.multi_cell(w=0, h=5, text=txt)
-            elif (el.get("type") or "").lower() == "field":
-                fid = str(el.get("id") or "")
-                ftype = (el.get("field_type") or "text").lower()
-                name = el.get("name") or fid
-                x = float(el.get("x") or 0)
-                y = float(el.get("y") or 0)
-                w = float(el.get("w") or 40)
-                h = float(el.get("h") or 8)
-                multiline = bool(el.get("multiline") or ftype == "textarea")
-                if ftype in ("text", "textarea"):
-                    pdf.form_text(name=str(name), x=x, y=y, w=w, h=h, multiline=multiline)
-                elif ftype in ("dropdown", "combo"):
-                    opts = el.get("options") or []
-                    pdf.form_combo(name=str(name), x=x, y=y, w=w, h=h, options=[str(o) for o in opts])
-                elif ftype == "checkbox":
-                    pdf.form_checkbox(name=str(name), x=x, y=y, w=w, h=h)
-                else:
-                    pdf.form_text(name=str(name), x=x, y=y, w=w, h=h)
+# ----------------------------
+# Field appearance streams for filled non-Latin-1 values
+# ----------------------------
+def checkbox_on_state(annot: DictionaryObject) -> str:
+    normal = ((annot.get("/AP") or {}).get("/N") or {})
+    normal = normal.get_object() if hasattr(normal, "get_object") else normal
+    states = [str(k) for k in getattr(normal, "keys", lambda: [])() if k != "/Off"]
+    return states[0] if states else "/Yes"
+
+
+@traced("postprocess.appearances", lambda r, a, kw: {"bytes": len(r[0])})
+def build_field_appearances(
+    pdf_bytes: bytes,
+    default_family: str = "DejaVuSans",
+    cjk_family: str = "NotoSansTC",
+    base_size: float = 10.0,
+) -> Tuple[bytes, List[str]]:
+    """
+    Writes an explicit /AP /N stream for every widget (text, textarea, combo, and both
+    checkbox states) so viewers render immediately instead of synthesizing appearances.
+    All appearances are drawn in one ReportLab pass (one small page per appearance,
+    same drawing as flatten mode, registered Unicode fonts) and attached as Form XObjects.
+    """
+    log: List[str] = []
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    writer = PdfWriter(clone_from=reader)
+    available = reportlab_register_fonts(log)
 
-    pdf.output("dynamic_form.pdf")
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf)
+    jobs: List[Tuple[DictionaryObject, Optional[str]]] = []
+    for page in writer.pages:
+        for annot_ref in page.get("/Annots") or []:
+            annot = annot_ref.get_object()
+            if annot.get("/Subtype") != "/Widget":
+                continue
+            info = widget_field_info(annot)
+            x1, y1, x2, y2 = info["rect"]
+            w, h = max(abs(x2 - x1), 1.0), max(abs(y2 - y1), 1.0)
+            local = dict(info, rect=[0.0, 0.0, w, h])
+            states: List[Optional[str]] = [checkbox_on_state(annot), "/Off"] if info["ft"] == "/Btn" else [None]
+            for state in states:
+                c.setPageSize((w, h))
+                draw_flat_field(c, dict(local, value=state) if state else local, default_family, cjk_family, available, base_size)
+                c.showPage()
+                jobs.append((annot, state))
+    if not jobs:
+        return pdf_bytes, log
+    c.save()
 
-if __name__ == "__main__":
-    main()
-"""
+    ap_reader = PdfReader(io.BytesIO(buf.getvalue()))
+    fresh: set = set()
+    for (annot, state), ap_page in zip(jobs, ap_reader.pages):
+        ref = writer._add_object(page_to_form_xobject(ap_page).clone(writer))  # pylint: disable=protected-access
+        if state is None:
+            annot[NameObject("/AP")] = DictionaryObject({NameObject("/N"): ref})
+            continue
+        if id(annot) not in fresh:
+            fresh.add(id(annot))
+            annot[NameObject("/AP")] = DictionaryObject({NameObject("/N"): DictionaryObject()})
+        annot["/AP"]["/N"][NameObject(state)] = ref
 
+    acro = writer._root_object.get("/AcroForm")  # pylint: disable=protected-access
+    if acro is not None:
+        acro.get_object().pop("/NeedAppearances", None)
+    out = io.BytesIO()
+    writer.write(out)
+    widgets = len({id(annot) for annot, _ in jobs})
+    log.append(f"appearances: {len(jobs)} appearance streams for {widgets} widgets")
+    return out.getvalue(), log
 
-def build_py_script_reportlab(spec_norm: Dict[str, Any]) -> str:
-    return f"""# Generated by WOW Agentic PDF Studio (ReportLab)
-# Requirements: reportlab
-# Fonts: place DejaVuSans.ttf and NotoSansTC-Regular.ttf in ./fonts_cache or adjust paths
 
-import json
-from reportlab.pdfgen import canvas
+# ----------------------------
+# Template precompilation: static layer rendered once, fields overlaid per render
+# ----------------------------
+TEMPLATE_CACHE_SIZE = 32
+STATIC_XOBJECT_NAME = "/WowStatic"
+
+
+def split_static_spec(spec_norm: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    # Same document/fonts and page count; labels go to the static layer, fields to the overlay.
+    static_spec = {k: v for k, v in spec_norm.items() if k != "pages"}
+    fields_spec = dict(static_spec)
+    static_spec["pages"], fields_spec["pages"] = [], []
+    for p in spec_norm.get("pages") or []:
+        elements = [el for el in ((p or {}).get("elements") or []) if isinstance(el, dict)]
+        static_spec["pages"].append({"elements": [el for el in elements if (el.get("type") or "").lower() != "field"]})
+        fields_spec["pages"].append({"elements": [el for el in elements if (el.get("type") or "").lower() == "field"]})
+    return static_spec, fields_spec
+
+
+def page_to_form_xobject(page) -> StreamObject:
+    xobj = StreamObject()
+    contents = page.get_contents()
+    xobj.set_data(contents.get_data() if contents is not None else b"")
+    xobj.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): ArrayObject([FloatObject(v) for v in page.mediabox]),
+        NameObject("/Resources"): page.get("/Resources") or DictionaryObject(),
+    })
+    # Compressed once at compile time instead of on every overlay.
+    return xobj.flate_encode()
+
+
+class TemplateCache:
+    """LRU keyed by content hash, shared process-wide (compiled static layers, field trees)."""
+
+    def __init__(self, size: int = TEMPLATE_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._size = size
+        self._items: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compile(self, key: str, compile_fn) -> Tuple[Dict[str, Any], bool]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return entry, True
+        entry = compile_fn()
+        with self._lock:
+            self.misses += 1
+            self._items[key] = entry
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+        return entry, False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+@st.cache_resource
+def get_template_cache() -> TemplateCache:
+    cache = TemplateCache()
+    get_metrics().watch_cache("template", cache)
+    return cache
+
+
+def compile_static_layer(static_spec: Dict[str, Any], engine: str) -> Dict[str, Any]:
+    gen = generate_pdf_reportlab if engine == "reportlab" else generate_pdf_fpdf2
+    static_bytes, log = gen(static_spec)
+    reader = PdfReader(io.BytesIO(static_bytes))
+    xobjs = [page_to_form_xobject(pg) for pg in reader.pages]
+    return {"reader": reader, "xobjects": xobjs, "bytes": len(static_bytes), "log": log, "lock": threading.Lock()}
+
+
+@traced("render.compiled", lambda r, a, kw: {"bytes": len(r[0]), "engine": a[1]})
+def generate_pdf_compiled(spec_norm: Dict[str, Any], engine: str) -> Tuple[bytes, List[str]]:
+    """
+    Renders only the fields with the chosen engine and places the cached static layer
+    underneath each page as a Form XObject, so repeat renders of a layout cost
+    O(fields) instead of re-laying out and re-subsetting fonts for every label.
+    """
+    static_spec, fields_spec = split_static_spec(spec_norm)
+    key = hashlib.sha256((engine + json.dumps(static_spec, sort_keys=True, ensure_ascii=False)).encode("utf-8")).hexdigest()
+    entry, hit = get_template_cache().get_or_compile(key, lambda: compile_static_layer(static_spec, engine))
+
+    gen = generate_pdf_reportlab if engine == "reportlab" else generate_pdf_fpdf2
+    fields_bytes, render_log = gen(fields_spec)
+    render_log.insert(0, f"template: static layer {'cache hit' if hit else 'compiled'} key={key[:12]} ({entry['bytes']} bytes)")
+    if not hit:
+        render_log[1:1] = entry["log"]
+
+    writer = PdfWriter(clone_from=PdfReader(io.BytesIO(fields_bytes)))
+    with entry["lock"]:  # cloning reads from the shared reader's stream
+        for page, xobj in zip(writer.pages, entry["xobjects"]):
+            ref = writer._add_object(xobj.clone(writer))  # pylint: disable=protected-access
+            res = page.setdefault(NameObject("/Resources"), DictionaryObject())
+            res = res.get_object()
+            xdict = res.setdefault(NameObject("/XObject"), DictionaryObject())
+            xdict.get_object()[NameObject(STATIC_XOBJECT_NAME)] = ref
+            call = StreamObject()
+            call.set_data(f"q {STATIC_XOBJECT_NAME} Do Q\n".encode("ascii"))
+            existing = page.get("/Contents")
+            parts = [writer._add_object(call)]  # pylint: disable=protected-access
+            if existing is not None:
+                existing = existing.get_object()
+                parts.extend(existing if isinstance(existing, ArrayObject) else [page.raw_get("/Contents")])
+            page[NameObject("/Contents")] = ArrayObject(parts)
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue(), render_log
+
+
+# ----------------------------
+# Output optimization: stream compression, object dedup, object/xref streams
+# ----------------------------
+OPTIMIZE_LEVELS = ["off", "fast", "balanced", "max"]
+OPTIMIZE_FLATE = {"fast": 1, "balanced": 6, "max": 9}
+QPDF_BIN = shutil.which("qpdf")
+
+try:
+    import pikepdf  # optional: object streams + cross-reference streams
+except ImportError:  # pragma: no cover
+    pikepdf = None
+
+# Backend for rewrites pypdf cannot do (object/xref streams, linearization); None hides them.
+PDF_REWRITER = "pikepdf" if pikepdf is not None else ("qpdf" if QPDF_BIN else None)
+
+
+def compress_writer_streams(writer: PdfWriter, level: int, recompress: bool) -> Tuple[int, int]:
+    # Streams are swapped in place in the writer's object table, so every reference to them
+    # (page /Contents, widget /AP, font files) keeps pointing at the compressed copy. pypdf has
+    # no public API for that; _objects is why requirements.txt bounds pypdf to >=5.0,<7.
+    encoded = recompressed = 0
+    for i, obj in enumerate(writer._objects):
+        if not isinstance(obj, StreamObject):
+            continue
+        flt = obj.get("/Filter")
+        if flt is None:
+            new = obj.flate_encode(level)
+            encoded += 1
+        elif recompress and flt == "/FlateDecode" and "/DecodeParms" not in obj:
+            raw = DecodedStreamObject()
+            raw.update({k: v for k, v in obj.items() if k not in ("/Filter", "/Length")})
+            raw.set_data(obj.get_data())
+            new = raw.flate_encode(level)
+            recompressed += 1
+        else:
+            continue
+        new.indirect_reference = obj.indirect_reference
+        writer._objects[i] = new
+    return encoded, recompressed
+
+
+def write_object_streams(pdf_bytes: bytes, level: str) -> Tuple[Optional[bytes], str]:
+    """Object + xref streams need pikepdf or the qpdf CLI; returns (None, reason) without them."""
+    if pikepdf is not None:
+        out = io.BytesIO()
+        with pikepdf.open(io.BytesIO(pdf_bytes)) as pdf:
+            pdf.save(
+                out,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                recompress_flate=(level == "max"),
+            )
+        return out.getvalue(), "pikepdf"
+    if QPDF_BIN:
+        with tempfile.TemporaryDirectory(prefix="wow_qpdf_") as tmp:
+            src, dst = Path(tmp) / "in.pdf", Path(tmp) / "out.pdf"
+            src.write_bytes(pdf_bytes)
+            args = [QPDF_BIN, "--object-streams=generate", "--compress-streams=y"]
+            if level == "max":
+                args += ["--recompress-flate", "--compression-level=9"]
+            proc = subprocess.run(args + [str(src), str(dst)], capture_output=True, timeout=120)
+            # Exit code 3 means "succeeded with warnings".
+            if proc.returncode in (0, 3) and dst.exists():
+                return dst.read_bytes(), "qpdf"
+            return None, f"qpdf failed: {proc.stderr.decode('utf-8', 'replace')[:200]}"
+    return None, "unavailable (install pikepdf or qpdf)"
+
+
+@traced("postprocess.optimize", lambda r, a, kw: {"level": a[1] if len(a) > 1 else kw.get("level"), "bytes": len(r[0])})
+def optimize_pdf_bytes(pdf_bytes: bytes, level: str = "balanced") -> Tuple[bytes, Dict[str, Any]]:
+    """
+    fast: dedup identical objects (fonts, appearance streams, resources) and Flate-encode any
+    uncompressed stream at level 1. balanced: level 6 plus object/xref streams. max: level 9,
+    re-encoding existing Flate streams as well. Never returns a larger file than it was given.
+    """
+    start = time.time()
+    report: Dict[str, Any] = {"level": level, "before": len(pdf_bytes), "steps": []}
+    writer = PdfWriter(clone_from=PdfReader(io.BytesIO(pdf_bytes)))
+    encoded, recompressed = compress_writer_streams(writer, OPTIMIZE_FLATE[level], recompress=(level == "max"))
+    report["steps"].append(f"flate {OPTIMIZE_FLATE[level]}: {encoded} encoded, {recompressed} re-encoded")
+    objects_before = sum(1 for o in writer._objects if o is not None)
+    writer.compress_identical_objects(remove_duplicates=True, remove_unreferenced=True)
+    objects_after = sum(1 for o in writer._objects if o is not None)
+    report["steps"].append(f"dedup: {objects_before} -> {objects_after} objects")
+    out = io.BytesIO()
+    writer.write(out)
+    best = out.getvalue()
+
+    report["object_streams"] = None
+    if level in ("balanced", "max"):
+        packed, how = write_object_streams(best, level)
+        report["steps"].append(f"object streams: {how}")
+        if packed is not None:
+            report["object_streams"] = how
+            best = min(best, packed, key=len)
+
+    if len(best) >= len(pdf_bytes):
+        best = pdf_bytes
+        report["steps"].append("kept original (no gain)")
+    report["after"] = len(best)
+    report["saved"] = report["before"] - report["after"]
+    report["saved_pct"] = round(100.0 * report["saved"] / max(1, report["before"]), 1)
+    report["ms"] = round((time.time() - start) * 1000, 1)
+    return best, report
+
+
+# ----------------------------
+# Linearized ("fast web view") output + time-to-first-page
+# ----------------------------
+PDFTOPPM_BIN = shutil.which("pdftoppm")
+LINEARIZED_HEAD_BYTES = 1024  # the spec requires the linearization dict within the first 1 KB
+LINEARIZED_RE = re.compile(rb"<<\s*/Linearized\s+[\d.]+(.*?)>>", re.DOTALL)
+TTFP_LINKS_KBPS = {"3G": 750, "4G": 9_000, "broadband": 50_000}
+
+
+def linearize_pdf_bytes(pdf_bytes: bytes) -> Tuple[Optional[bytes], str]:
+    """Needs pikepdf or the qpdf CLI (pypdf cannot write hint streams); returns (None, reason) without."""
+    if pikepdf is not None:
+        out = io.BytesIO()
+        with pikepdf.open(io.BytesIO(pdf_bytes)) as pdf:
+            pdf.save(out, linearize=True)
+        return out.getvalue(), "pikepdf"
+    if QPDF_BIN:
+        with tempfile.TemporaryDirectory(prefix="wow_qpdf_") as tmp:
+            src, dst = Path(tmp) / "in.pdf", Path(tmp) / "out.pdf"
+            src.write_bytes(pdf_bytes)
+            proc = subprocess.run([QPDF_BIN, "--linearize", str(src), str(dst)], capture_output=True, timeout=120)
+            if proc.returncode in (0, 3) and dst.exists():
+                return dst.read_bytes(), "qpdf"
+            return None, f"qpdf failed: {proc.stderr.decode('utf-8', 'replace')[:200]}"
+    return None, "unavailable (install pikepdf or qpdf)"
+
+
+def linearization_info(pdf_bytes: bytes) -> Dict[str, Any]:
+    """
+    Structural check of the linearization parameter dictionary (/L, /O, /E, /N, /T, /H)
+    against the file; qpdf --check-linearization also validates the hint tables when present.
+    """
+    info: Dict[str, Any] = {"linearized": False, "file_bytes": len(pdf_bytes), "first_page_bytes": None, "problems": [], "checker": "builtin"}
+    m = LINEARIZED_RE.search(pdf_bytes[:LINEARIZED_HEAD_BYTES])
+    if not m:
+        info["problems"].append("no linearization dictionary in the first 1024 bytes")
+        return info
+    params = {k.decode(): int(v) for k, v in re.findall(rb"/([LOENT])\s+(\d+)", m.group(1))}
+    problems = info["problems"]
+    missing = [k for k in "LOENT" if k not in params]
+    if missing:
+        problems.append(f"missing /{', /'.join(missing)}")
+    if not re.search(rb"/H\s*\[", m.group(1)):
+        problems.append("missing /H hint stream offsets")
+    if params.get("L") != len(pdf_bytes):
+        problems.append(f"/L {params.get('L')} != file length {len(pdf_bytes)} (modified after linearization)")
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        if params.get("N") != len(reader.pages):
+            problems.append(f"/N {params.get('N')} != page count {len(reader.pages)}")
+        first = reader.pages[0].indirect_reference if reader.pages else None
+        if first is not None and params.get("O") != first.idnum:
+            problems.append(f"/O {params.get('O')} is not the first page object ({first.idnum})")
+    except Exception as e:
+        problems.append(f"unreadable: {e}")
+    end = params.get("E", 0)
+    if not 0 < end <= len(pdf_bytes):
+        problems.append(f"/E {end} outside the file")
+    info["first_page_bytes"] = end or None
+
+    if QPDF_BIN and not problems:
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+            f.write(pdf_bytes)
+            f.flush()
+            proc = subprocess.run([QPDF_BIN, "--check-linearization", f.name], capture_output=True, timeout=60)
+        info["checker"] = "qpdf"
+        if proc.returncode != 0:
+            problems.append(proc.stdout.decode("utf-8", "replace").strip()[:300] or "qpdf check failed")
+    info["linearized"] = not problems
+    return info
+
+
+def render_first_page_ms(pdf_bytes: bytes) -> Tuple[Optional[float], bool]:
+    """Wall time for poppler to rasterize page 1 at 72 dpi; (None, False) without pdftoppm."""
+    if not PDFTOPPM_BIN:
+        return None, False
+    with tempfile.TemporaryDirectory(prefix="wow_ttfp_") as tmp:
+        src = Path(tmp) / "in.pdf"
+        src.write_bytes(pdf_bytes)
+        start = time.time()
+        proc = subprocess.run(
+            [PDFTOPPM_BIN, "-f", "1", "-l", "1", "-r", "72", "-png", str(src), str(Path(tmp) / "p")],
+            capture_output=True,
+            timeout=120,
+        )
+        ms = (time.time() - start) * 1000
+        ok = proc.returncode == 0 and any(Path(tmp).glob("p*.png"))
+    return round(ms, 1), ok
+
+
+def time_to_first_page(pdf_bytes: bytes, label: str) -> List[Dict[str, Any]]:
+    """
+    Bytes a viewer must receive before page 1 can be drawn (/E for a linearized file, the
+    whole file otherwise), turned into transfer time per link profile, plus poppler's
+    page-1 render time. For linearized files poppler also renders from just the first /E
+    bytes, which shows the prefix really is self-sufficient.
+    """
+    info = linearization_info(pdf_bytes)
+    needed = info["first_page_bytes"] if info["linearized"] else len(pdf_bytes)
+    render_ms, _ = render_first_page_ms(pdf_bytes)
+    prefix_ok = render_first_page_ms(pdf_bytes[:needed])[1] if info["linearized"] and PDFTOPPM_BIN else None
+    rows = []
+    for link, kbps in TTFP_LINKS_KBPS.items():
+        transfer_ms = needed * 8 / kbps
+        rows.append({
+            "variant": label,
+            "link": link,
+            "file_bytes": len(pdf_bytes),
+            "first_page_bytes": needed,
+            "transfer_ms": round(transfer_ms, 1),
+            "render_ms": render_ms,
+            "ttfp_ms": round(transfer_ms + (render_ms or 0.0), 1),
+            "prefix_renders": prefix_ok,
+        })
+    return rows
+
+
+def run_ttfp_benchmark(spec_norm: Dict[str, Any], engine: str, optimize: str = "off") -> Dict[str, Any]:
+    plain, _ = render_spec_pdf(spec_norm, engine, optimize=optimize)
+    rows = time_to_first_page(plain, "plain")
+    lin, how = linearize_pdf_bytes(plain)
+    if lin is not None:
+        rows += time_to_first_page(lin, f"linearized ({how})")
+    return {"rows": rows, "linearizer": how if lin is not None else None, "note": None if lin is not None else how,
+            "renderer": "pdftoppm" if PDFTOPPM_BIN else None}
+
+
+# ----------------------------
+# Render entry point (engine dispatch + post-process)
+# ----------------------------
+def spec_font_families(spec_norm: Dict[str, Any]) -> Tuple[str, str, float]:
+    fonts_cfg = spec_norm.get("fonts") or {}
+    default_cfg = (fonts_cfg.get("default") or {}) if isinstance(fonts_cfg, dict) else {}
+    cjk_cfg = (fonts_cfg.get("cjk") or {}) if isinstance(fonts_cfg, dict) else {}
+    return (
+        str(default_cfg.get("family") or "DejaVuSans"),
+        str(cjk_cfg.get("family") or "NotoSansTC"),
+        float(default_cfg.get("size") or 11.0),
+    )
+
+
+@traced("render_spec_pdf", lambda r, a, kw: {"engine": a[1] if len(a) > 1 else kw.get("engine"), "bytes": len(r[0])})
+def render_spec_pdf(
+    spec_norm: Dict[str, Any],
+    engine: str,
+    compiled: bool = False,
+    flatten: bool = False,
+    appearances: bool = False,
+    optimize: str = "off",
+    linearize: bool = False,
+) -> Tuple[bytes, List[str]]:
+    metrics = get_metrics()
+    start = time.time()
+    try:
+        pdf_bytes, render_log = _render_spec_pdf(spec_norm, engine, compiled, flatten, appearances)
+        if optimize != "off":
+            pdf_bytes, opt = optimize_pdf_bytes(pdf_bytes, optimize)
+            render_log.append(
+                f"optimize: {opt['level']} · {opt['before']:,} -> {opt['after']:,} bytes "
+                f"(-{opt['saved_pct']}%) in {opt['ms']} ms · " + "; ".join(opt["steps"])
+            )
+        if linearize:
+            # Must stay the last rewrite: any later save invalidates /L and the hint tables.
+            lin, how = linearize_pdf_bytes(pdf_bytes)
+            if lin is None:
+                render_log.append(f"linearize: skipped, {how}")
+            else:
+                pdf_bytes = lin
+                info = linearization_info(pdf_bytes)
+                render_log.append(
+                    f"linearize: {how} · first page in {info['first_page_bytes'] or '?'} of {len(pdf_bytes):,} bytes · "
+                    + ("check ok" if info["linearized"] else "check failed: " + "; ".join(info["problems"]))
+                )
+    except Exception:
+        metrics.inc("pdf_generations_total", engine=engine, outcome="error")
+        raise
+    metrics.observe("pdf_render_seconds", time.time() - start, engine=engine)
+    metrics.observe("pdf_output_bytes", len(pdf_bytes), engine=engine)
+    metrics.inc("pdf_generations_total", engine=engine, outcome="ok")
+    return pdf_bytes, render_log
+
+
+def _render_spec_pdf(
+    spec_norm: Dict[str, Any], engine: str, compiled: bool, flatten: bool, appearances: bool
+) -> Tuple[bytes, List[str]]:
+    if compiled:
+        pdf_bytes, render_log = generate_pdf_compiled(spec_norm, engine)
+    elif engine == "reportlab":
+        pdf_bytes, render_log = generate_pdf_reportlab(spec_norm)
+    else:
+        pdf_bytes, render_log = generate_pdf_fpdf2(spec_norm)
+
+    if flatten:
+        # No widgets survive, so NeedAppearances would be pointless.
+        default_family, cjk_family, base_size = spec_font_families(spec_norm)
+        flat, flat_log = flatten_pdf_bytes(pdf_bytes, default_family, cjk_family, base_size)
+        return flat, render_log + flat_log
+
+    if appearances:
+        # ReportLab writes an /AP for every widget in the render pass itself (TTF ones via
+        # rl_apply_ttf_appearance) and fpdf2 emits no widgets here, so nothing is left to do.
+        render_log.append("appearances: written by the engine, no post-process")
+        return pdf_bytes, render_log
+
+    # Improve compatibility
+    pdf_bytes2, changed = set_need_appearances(pdf_bytes)
+    if changed:
+        render_log.append("postprocess: set /NeedAppearances true")
+    return pdf_bytes2, render_log
+
+
+# ----------------------------
+# Profiling mode: cProfile + tracemalloc around one generation
+# ----------------------------
+PROFILE_TOP_N = 25
+PROFILE_HISTORY = 8
+PROFILE_FRAMES = 6  # traceback depth recorded per allocation
+
+
+def spec_hash(spec_norm: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(spec_norm, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def profile_render_spec_pdf(spec_norm: Dict[str, Any], engine: str, **render_kwargs) -> Tuple[bytes, List[str], Dict[str, Any]]:
+    """
+    render_spec_pdf under cProfile and tracemalloc. Besides (bytes, log) it returns the
+    marshalled stats (what pstats.Stats/snakeviz load from a .pstats file), the top functions
+    by cumulative time and the allocation sites that grew the most during the generation.
+    """
+    with tracemalloc_session(PROFILE_FRAMES):
+        before = tracemalloc.take_snapshot()
+        base_mem = tracemalloc.get_traced_memory()[0]
+        prof = cProfile.Profile()
+        start = time.time()
+        prof.enable()
+        try:
+            pdf_bytes, render_log = render_spec_pdf(spec_norm, engine, **render_kwargs)
+        finally:
+            prof.disable()
+        elapsed_ms = (time.time() - start) * 1000
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+
+    noise = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    allocations = []
+    for stat in after.filter_traces(noise).compare_to(before.filter_traces(noise), "lineno")[:PROFILE_TOP_N]:
+        if stat.size_diff <= 0:
+            continue
+        frame = stat.traceback[0]
+        allocations.append({
+            "site": f"{frame.filename}:{frame.lineno}",
+            "kb": round(stat.size_diff / 1024, 1),
+            "blocks": stat.count_diff,
+        })
+
+    buf = io.StringIO()
+    stats = pstats.Stats(prof, stream=buf)
+    # Marshal before strip_dirs(): the saved .pstats keeps full paths and unmerged entries.
+    raw_stats = marshal.dumps(stats.stats)
+    stats.strip_dirs().sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    key = spec_hash(spec_norm)
+    profile = {
+        "key": key,
+        "engine": engine,
+        "created": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"),
+        "elapsed_ms": round(elapsed_ms, 1),
+        "peak_kb": round(max(0, peak - base_mem) / 1024, 1),
+        "calls": stats.total_calls,
+        "pstats": raw_stats,
+        "top_functions": buf.getvalue().strip(),
+        "allocations": allocations,
+    }
+    render_log.append(f"profile: {elapsed_ms:.1f} ms, {stats.total_calls} calls, key={key[:12]}")
+    return pdf_bytes, render_log, profile
+
+
+def allocation_summary(profile: Dict[str, Any]) -> str:
+    lines = [f"spec {profile['key']} · {profile['engine']} · {profile['elapsed_ms']} ms · peak {profile['peak_kb'] or '?'} KiB", ""]
+    lines += [f"{a['kb']:>10.1f} KiB  {a['blocks']:>7} blocks  {a['site']}" for a in profile["allocations"]]
+    return "\n".join(lines) + "\n"
+
+
+def store_profile(profile: Dict[str, Any]):
+    profiles = st.session_state.pdf_profiles
+    profiles.pop(profile["key"], None)
+    profiles[profile["key"]] = profile
+    while len(profiles) > PROFILE_HISTORY:
+        profiles.pop(next(iter(profiles)))
+
+
+# ----------------------------
+# Deterministic layout: form Markdown -> PDF Build Spec (no LLM)
+# ----------------------------
+LAYOUT_MARGIN_MM = 12.0
+LAYOUT_FONT_SIZE = 11.0
+LAYOUT_FIELD_H = 8.0
+LAYOUT_TEXTAREA_H = 30.0
+LAYOUT_CHECK_MM = 5.0
+LAYOUT_ROW_GAP = 4.0
+LAYOUT_LABEL_COL_MAX = 0.42  # share of the content width the label column may take
+
+LIST_MARKER_RE = re.compile(r"^\s*(?:[-*+]|\d+[.)])\s+")
+CHECKBOX_LINE_RE = re.compile(r"^\s*[-*+]\s*\[[ xX]\]\s*(.+)$")
+CHOICE_RE = re.compile(r"\((?:choose|select|pick)\s+(one|any|all(?: that apply)?)\)\s*:?\s*(.*)$", re.IGNORECASE)
+REQUIRED_RE = re.compile(r"\s*(?:\*{1,2}required\*{1,2}|\(required\))\s*", re.IGNORECASE)
+MULTILINE_RE = re.compile(r"\s*\((?:multi-?line|paragraph|long answer)\)", re.IGNORECASE)
+BLANK_RE = re.compile(r"\s*:?\s*_{2,}\s*$")
+
+
+def parse_form_markdown(md: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Classifies form Markdown lines into title / heading / field / note items. Lines the
+    rules cannot place (tables, code, long prose without a blank) are returned as
+    ambiguous so the caller can decide whether the LLM step is still needed.
+    """
+    items: List[Dict[str, Any]] = []
+    ambiguous: List[str] = []
+    in_code = False
+    for raw in (md or "").splitlines():
+        line = raw.strip()
+        if line.startswith("```"):
+            in_code = not in_code
+            continue
+        if in_code or not line or line.startswith(("|", ">", "<!--")):
+            if line and not in_code:
+                ambiguous.append(line)
+            continue
+        if line.startswith("#"):
+            level = len(line) - len(line.lstrip("#"))
+            items.append({"kind": "title" if level == 1 else "heading", "text": line.lstrip("#").strip()})
+            continue
+
+        cb = CHECKBOX_LINE_RE.match(line)
+        text = cb.group(1) if cb else LIST_MARKER_RE.sub("", line)
+        required = bool(REQUIRED_RE.search(text))
+        text = REQUIRED_RE.sub(" ", text).strip()
+        if cb:
+            items.append({"kind": "field", "field_type": "checkbox", "label": text, "required": required})
+            continue
+
+        choice = CHOICE_RE.search(text)
+        if choice:
+            label = text[: choice.start()].strip().rstrip(":")
+            options = [o.strip() for o in re.split(r"\s*[,/;|]\s*", choice.group(2)) if o.strip()]
+            if not options:
+                ambiguous.append(line)
+            elif choice.group(1).lower() == "one":
+                items.append({"kind": "field", "field_type": "dropdown", "label": label, "options": options, "required": required})
+            else:
+                items.append({"kind": "note", "text": label})
+                items.extend({"kind": "field", "field_type": "checkbox", "label": o, "required": False} for o in options)
+            continue
+
+        if MULTILINE_RE.search(text):
+            items.append({"kind": "field", "field_type": "textarea", "label": MULTILINE_RE.sub("", text).strip().rstrip(".:"), "required": required})
+            continue
+        if BLANK_RE.search(text):
+            items.append({"kind": "field", "field_type": "text", "label": BLANK_RE.sub("", text).strip(), "required": required})
+            continue
+        if text.endswith(".") and len(text.split()) > 8:
+            # Instructions rather than a prompt for input.
+            items.append({"kind": "note", "text": text})
+            ambiguous.append(line)
+            continue
+        if text.endswith(":"):
+            items.append({"kind": "field", "field_type": "text", "label": text.rstrip(":").strip(), "required": required})
+            continue
+        # No blank and no trailing colon: text on the form, not a prompt for input.
+        items.append({"kind": "note", "text": text})
+    return items, ambiguous
+
+
+def measure_text_mm(text: str, size: float, default_family: str, cjk_family: str, available: Dict[str, bool]) -> float:
+    family = choose_font_family_for_text(text, default_family, cjk_family, available)
+    return get_text_metrics().width_mm(text, family, size)
+
+
+def layout_field_ids(label: str, index: int, used: set) -> Tuple[str, str]:
+    words = re.findall(r"[A-Za-z0-9]+", label)[:5]
+    base = "_".join(w.lower() for w in words) or f"field_{index}"
+    fid, n = base, 2
+    while fid in used:
+        fid, n = f"{base}_{n}", n + 1
+    used.add(fid)
+    name = "_".join(part.capitalize() for part in fid.split("_"))
+    return fid, name
+
+
+def layout_form_markdown(md: str, page_size: str = "A4", orientation: str = "portrait") -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Flow layout of parse_form_markdown items onto pages (mm, top-left origin): a label
+    column sized from measured label widths, fields to its right, textareas and long
+    labels stacked full width, headings kept with the next row, page breaks on overflow.
+    """
+    start = time.time()
+    items, ambiguous = parse_form_markdown(md)
+    available = reportlab_register_fonts([])
+    default_family, cjk_family = "DejaVuSans", "NotoSansTC"
+
+    def measure(text: str, size: float = LAYOUT_FONT_SIZE) -> float:
+        return measure_text_mm(text, size, default_family, cjk_family, available)
+
+    page_w, page_h = page_dims_mm(page_size, orientation)
+    m = LAYOUT_MARGIN_MM
+    content_w = page_w - 2 * m
+    inline_labels = [it["label"] for it in items if it["kind"] == "field" and it["field_type"] in ("text", "dropdown")]
+    # Labels too wide for the capped column are stacked above their field and don't widen it.
+    col_max = content_w * LAYOUT_LABEL_COL_MAX
+    fitting = [w + 4.0 for w in (measure(lb + ":") for lb in inline_labels) if w + 4.0 <= col_max]
+    label_col = max(fitting) if fitting else col_max
+
+    title = next((it["text"] for it in items if it["kind"] == "title"), "Form")
+    pages: List[Dict[str, Any]] = [{"number": 1, "elements": []}]
+    y = m
+    used_ids: set = set()
+
+    def new_page():
+        nonlocal y
+        pages.append({"number": len(pages) + 1, "elements": []})
+        y = m
+
+    def place(height: float) -> float:
+        nonlocal y
+        if y + height > page_h - m and y > m:
+            new_page()
+        top = y
+        y += height
+        return top
+
+    def label(text: str, x: float, top: float, size: float = LAYOUT_FONT_SIZE, style: str = ""):
+        el = {"type": "label", "text": text, "x": round(x, 2), "y": round(top, 2)}
+        if size != LAYOUT_FONT_SIZE:
+            el["size"] = size
+        if style:
+            el["style"] = style
+        pages[-1]["elements"].append(el)
+
+    def field(it: Dict[str, Any], x: float, top: float, w: float, h: float):
+        fid, name = layout_field_ids(it["label"], len(used_ids) + 1, used_ids)
+        el = {"type": "field", "field_type": it["field_type"], "id": fid, "name": name,
+              "x": round(x, 2), "y": round(top, 2), "w": round(w, 2), "h": h}
+        if it.get("options"):
+            el["options"] = it["options"]
+        if it["field_type"] == "textarea":
+            el["multiline"] = True
+        if it.get("required"):
+            el["required"] = True
+        pages[-1]["elements"].append(el)
+
+    for i, it in enumerate(items):
+        kind = it["kind"]
+        if kind == "title":
+            label(it["text"], m, place(12.0) + 2.0, size=14, style="B")
+        elif kind == "heading":
+            # Keep the heading on the same page as the row that follows it.
+            if y + 10.0 + LAYOUT_FIELD_H + LAYOUT_ROW_GAP > page_h - m and y > m:
+                new_page()
+            label(it["text"], m, place(10.0) + 2.0, size=12, style="B")
+        elif kind == "note":
+            label(it["text"], m, place(7.0) + 1.0)
+        elif it["field_type"] == "checkbox":
+            top = place(LAYOUT_FIELD_H + 2.0)
+            field(it, m, top + 1.5, LAYOUT_CHECK_MM, LAYOUT_CHECK_MM)
+            label(it["label"], m + LAYOUT_CHECK_MM + 3.0, top + 2.5)
+        elif it["field_type"] == "textarea":
+            top = place(6.0 + LAYOUT_TEXTAREA_H + LAYOUT_ROW_GAP)
+            label(it["label"] + ":", m, top)
+            field(it, m, top + 6.0, content_w, LAYOUT_TEXTAREA_H)
+        else:
+            text = it["label"] + ":"
+            if measure(text) + 4.0 > label_col:
+                top = place(6.0 + LAYOUT_FIELD_H + LAYOUT_ROW_GAP)
+                label(text, m, top)
+                fx, fy, fw = m, top + 6.0, content_w
+            else:
+                top = place(LAYOUT_FIELD_H + LAYOUT_ROW_GAP)
+                label(text, m, top + 2.5)
+                fx, fy, fw = m + label_col, top, content_w - label_col
+            if it["field_type"] == "dropdown":
+                fw = min(fw, max(measure(o) for o in it["options"]) + 16.0)
+            field(it, fx, fy, fw, LAYOUT_FIELD_H)
+
+    spec = {
+        "document": {
+            "title": title,
+            "page_size": page_size.upper(),
+            "orientation": orientation,
+            "unit": "mm",
+            "margin": {"left": m, "top": m, "right": m, "bottom": m},
+        },
+        "fonts": {
+            "default": {"family": default_family, "size": LAYOUT_FONT_SIZE},
+            "cjk": {"family": cjk_family, "size": LAYOUT_FONT_SIZE},
+        },
+        "pages": pages,
+    }
+    report = {
+        "fields": len(used_ids),
+        "pages": len(pages),
+        "ambiguous": ambiguous,
+        "elapsed_ms": round((time.time() - start) * 1000, 2),
+    }
+    return spec, report
+
+
+def layout_spec_markdown(spec: Dict[str, Any]) -> str:
+    return "# PDF Build Spec (auto layout)\n\n" + wrap_yaml_block(spec)
+
+
+# ----------------------------
+# Bulk specs: stream every spec in a source into PDFs
+# ----------------------------
+OUTPUT_TTL_S = 2 * 3600  # bulk zips/PDFs and exports outlive the session that made them by at most this
+
+
+@st.cache_resource
+def get_output_dir() -> Path:
+    # One private directory per process (mkdtemp creates it 0o700); new_output_path sweeps it.
+    return Path(tempfile.mkdtemp(prefix="wow_outputs_"))
+
+
+def new_output_path(prefix: str, suffix: str) -> str:
+    """A fresh file for a downloadable result; files older than OUTPUT_TTL_S are removed first."""
+    root = get_output_dir()
+    now = time.time()
+    for path in root.iterdir():
+        try:
+            if now - path.stat().st_mtime > OUTPUT_TTL_S:
+                path.unlink()
+        except OSError:
+            pass
+    fd, out_path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=root)
+    os.close(fd)
+    return out_path
+
+
+def rename_merged_fields(spec_norm: Dict[str, Any], index: int, seen_names: set):
+    # Field names must stay unique across the merged AcroForm.
+    for p in spec_norm.get("pages") or []:
+        for el in (p or {}).get("elements") or []:
+            if isinstance(el, dict) and (el.get("type") or "").lower() == "field":
+                name = str(el.get("name") or el.get("id") or "")
+                if name in seen_names:
+                    el["name"] = f"{name}__{index}"
+                    el["id"] = f"{el.get('id')}__{index}"
+                seen_names.add(str(el.get("name") or el.get("id")))
+
+
+def render_spec_stream(
+    text: str,
+    engine: str,
+    unit_fallback: str,
+    page_fallback: str,
+    merge: bool = False,
+    compiled: bool = False,
+    flatten: bool = False,
+    appearances: bool = False,
+    label_fit: Optional[str] = None,
+    optimize: str = "off",
+    linearize: bool = False,
+) -> Dict[str, Any]:
+    """
+    Validates and renders every spec yielded by iter_pdfspecs in one pass. Separate mode
+    writes each PDF straight into a zip on disk so only one document is in memory at a
+    time; merge mode renders each spec on its own and appends its pages to one PdfWriter
+    as it goes, so only the compressed page objects accumulate (optimize/linearize still
+    need the finished file in memory once). A spec that fails to render is recorded on its
+    row and skipped; the output file is removed when nothing usable was written.
+    """
+    rows: List[Dict[str, Any]] = []
+    log: List[str] = []
+    out_path = new_output_path("wow_bulk_", ".pdf" if merge else ".zip")
+    writer: Optional[PdfWriter] = None
+    seen_names: set = set()
+    start = time.time()
+
+    zf = None
+    try:
+        zf = None if merge else zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_DEFLATED)
+        for i, (label, obj, errors) in enumerate(iter_pdfspecs(text), start=1):
+            row = {"index": i, "source": label, "ok": False, "errors": list(errors), "warnings": 0, "fields": 0, "bytes": 0}
+            rows.append(row)
+            if errors or obj is None:
+                continue
+            report = validate_pdfspec(obj, unit_fallback=unit_fallback, page_fallback=page_fallback, label_fit=label_fit)
+            row["errors"] = report.get("errors") or []
+            row["warnings"] = len(report.get("warnings") or [])
+            if row["errors"] or report.get("normalized") is None:
+                continue
+            spec_norm = report["normalized"]
+            row["fields"] = (report.get("field_stats") or {}).get("total", 0)
+            try:
+                if merge:
+                    rename_merged_fields(spec_norm, i, seen_names)
+                    pdf_bytes, _ = render_spec_pdf(spec_norm, engine, compiled=compiled, flatten=flatten, appearances=appearances)
+                    reader = PdfReader(io.BytesIO(pdf_bytes))
+                    if writer is None:
+                        writer = PdfWriter()
+                        if reader.metadata:
+                            writer.add_metadata(dict(reader.metadata))
+                        log.append(
+                            f"merge: document title/metadata come from spec {i}; every spec keeps its own page size, "
+                            "orientation and fonts"
+                        )
+                    writer.append(reader)
+                    row["bytes"] = len(pdf_bytes)
+                    row["ok"] = True
+                    continue
+                pdf_bytes, _ = render_spec_pdf(
+                    spec_norm, engine, compiled=compiled, flatten=flatten, appearances=appearances, optimize=optimize,
+                    linearize=linearize,
+                )
+            except Exception as e:
+                row["errors"] = [f"Render failed: {e}"]
+                continue
+            title = str((spec_norm.get("document") or {}).get("title") or "form")
+            slug = re.sub(r"[^A-Za-z0-9]+", "_", title).strip("_")[:40] or "form"
+            zf.writestr(f"{i:04d}_{slug}.pdf", pdf_bytes)
+            row["bytes"] = len(pdf_bytes)
+            row["ok"] = True
+        if zf is not None:
+            zf.close()
+            zf = None
+
+        if merge and writer is not None:
+            try:
+                if optimize == "off" and not linearize:
+                    with open(out_path, "wb") as fh:
+                        writer.write(fh)
+                else:
+                    buf = io.BytesIO()
+                    writer.write(buf)
+                    pdf_bytes = buf.getvalue()
+                    if optimize != "off":
+                        pdf_bytes, opt = optimize_pdf_bytes(pdf_bytes, optimize)
+                        log.append(f"optimize: {opt['before']:,} -> {opt['after']:,} bytes")
+                    if linearize:
+                        lin, how = linearize_pdf_bytes(pdf_bytes)
+                        pdf_bytes = lin if lin is not None else pdf_bytes
+                        log.append(f"linearize: {how}" if lin is not None else f"linearize: skipped, {how}")
+                    Path(out_path).write_bytes(pdf_bytes)
+            except Exception as e:
+                for row in rows:
+                    if row["ok"]:
+                        row["ok"] = False
+                        row["errors"] = [f"Merged render failed: {e}"]
+    except BaseException:
+        if zf is not None:
+            zf.close()
+        Path(out_path).unlink(missing_ok=True)
+        raise
+
+    if not any(r["ok"] for r in rows):
+        Path(out_path).unlink(missing_ok=True)
+
+    return {
+        "path": out_path,
+        "file_name": "bulk_forms.pdf" if merge else "bulk_forms.zip",
+        "mime": "application/pdf" if merge else "application/zip",
+        "rows": rows,
+        "log": log,
+        "ok": sum(1 for r in rows if r["ok"]),
+        "elapsed_ms": int((time.time() - start) * 1000),
+    }
+
+
+# ----------------------------
+# Fill engine: bulk merge data rows into a rendered template
+# ----------------------------
+FILL_WORKERS = max(1, min(8, (os.cpu_count() or 2) - 1))
+FILL_CHUNK = 20
+TRUTHY = {"1", "true", "yes", "y", "on", "x", "checked", "✓"}
+
+_FILL_TEMPLATE: Dict[str, Any] = {}
+
+
+def worker_pool_context():
+    # Never "fork": the Streamlit server is multithreaded, and a lock another thread holds at
+    # fork time (cache_resource, TemplateCache, logging) stays locked forever in the child.
+    # Spawned workers re-run this script as "__mp_main__", which skips the UI at the bottom.
+    return multiprocessing.get_context("spawn")
+
+
+def iter_fill_records(raw: bytes, filename: str) -> Iterator[Dict[str, Any]]:
+    # CSV and JSONL are streamed row by row; a JSON array is loaded once.
+    name = (filename or "").lower()
+    text = io.TextIOWrapper(io.BytesIO(raw), encoding="utf-8-sig", newline="")
+    if name.endswith(".csv"):
+        yield from csv.DictReader(text)
+    elif name.endswith((".jsonl", ".ndjson")):
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        data = json.loads(text.read())
+        rows = data.get("records", []) if isinstance(data, dict) else data
+        for row in rows or []:
+            if isinstance(row, dict):
+                yield row
+
+
+def template_field_meta(reader: PdfReader) -> Dict[str, Dict[str, Any]]:
+    # Field type plus checkbox "on" state names, read once per template.
+    meta: Dict[str, Dict[str, Any]] = {}
+    for name, f in (reader.get_fields() or {}).items():
+        info = {"ft": str(f.get("/FT", "")), "on": "/Yes"}
+        if info["ft"] == "/Btn":
+            for kid in f.get("/Kids", []) or [f]:
+                ap = (kid.get_object() if hasattr(kid, "get_object") else kid).get("/AP") or {}
+                states = [k for k in (ap.get("/N") or {}).keys() if k != "/Off"]
+                if states:
+                    info["on"] = states[0]
+                    break
+        meta[str(name)] = info
+    return meta
+
+
+def coerce_fill_value(info: Dict[str, Any], value: Any) -> str:
+    if info.get("ft") == "/Btn":
+        return info.get("on", "/Yes") if str(value).strip().lower() in TRUTHY or value is True else "/Off"
+    return "" if value is None else str(value)
+
+
+def _fill_worker_init(template_bytes: bytes):
+    reader = PdfReader(io.BytesIO(template_bytes))
+    _FILL_TEMPLATE["reader"] = reader
+    _FILL_TEMPLATE["meta"] = template_field_meta(reader)
+
+
+def fill_one(record: Dict[str, Any], flatten: bool = False, appearances: bool = False) -> bytes:
+    # Clones the already-parsed template held by this process; nothing is re-rendered.
+    reader, meta = _FILL_TEMPLATE["reader"], _FILL_TEMPLATE["meta"]
+    values = {k: coerce_fill_value(meta[k], v) for k, v in record.items() if k in meta}
+    writer = PdfWriter(clone_from=reader)
+    if values:
+        writer.update_page_form_field_values(list(writer.pages), values, auto_regenerate=False)
+    out = io.BytesIO()
+    writer.write(out)
+    if flatten:
+        return flatten_pdf_bytes(out.getvalue())[0]
+    if appearances and not all(is_latin1(v) for v in values.values()):
+        # pypdf already drew appearances for the filled values in the write above, but with
+        # the /DA font; only values Latin-1 cannot encode need the TTF redraw.
+        return build_field_appearances(out.getvalue())[0]
+    return out.getvalue()
+
+
+def _fill_worker_chunk(
+    chunk: List[Tuple[int, Dict[str, Any]]], flatten: bool, appearances: bool = False
+) -> List[Tuple[int, Optional[bytes], Optional[str]]]:
+    results = []
+    for idx, record in chunk:
+        try:
+            results.append((idx, fill_one(record, flatten=flatten, appearances=appearances), None))
+        except Exception as e:
+            results.append((idx, None, str(e)))
+    return results
+
+
+def fill_records_to_zip(
+    template_bytes: bytes,
+    records: Iterator[Dict[str, Any]],
+    flatten: bool = False,
+    workers: int = FILL_WORKERS,
+    name_field: Optional[str] = None,
+    appearances: bool = False,
+) -> Dict[str, Any]:
+    """
+    Fills one PDF per record and streams them into a zip on disk. Records are chunked
+    across a spawned process pool whose workers parse the template once at start-up;
+    in-flight chunks are capped so arbitrarily long record streams stay bounded.
+    """
+    out_path = new_output_path("wow_fill_", ".zip")
+    start = time.time()
+    stats = {"records": 0, "filled": 0, "failed": 0, "errors": []}
+    names: Dict[int, str] = {}
+
+    def chunks() -> Iterator[List[Tuple[int, Dict[str, Any]]]]:
+        buf: List[Tuple[int, Dict[str, Any]]] = []
+        for i, rec in enumerate(records, start=1):
+            stats["records"] += 1
+            raw_name = str(rec.get(name_field) or "") if name_field else ""
+            names[i] = re.sub(r"[^A-Za-z0-9_.-]+", "_", raw_name).strip("_") or f"record_{i:06d}"
+            buf.append((i, rec))
+            if len(buf) >= FILL_CHUNK:
+                yield buf
+                buf = []
+        if buf:
+            yield buf
+
+    with zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        def collect(results: List[Tuple[int, Optional[bytes], Optional[str]]]):
+            for idx, pdf, err in results:
+                if err:
+                    stats["failed"] += 1
+                    if len(stats["errors"]) < 50:
+                        stats["errors"].append(f"record {idx}: {err}")
+                    continue
+                zf.writestr(f"{idx:06d}_{names.pop(idx)}.pdf", pdf)
+                stats["filled"] += 1
+
+        if workers <= 1:
+            _fill_worker_init(template_bytes)
+            for ch in chunks():
+                collect(_fill_worker_chunk(ch, flatten, appearances))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=worker_pool_context(),
+                initializer=_fill_worker_init,
+                initargs=(template_bytes,),
+            ) as pool:
+                inflight = set()
+                for ch in chunks():
+                    inflight.add(pool.submit(_fill_worker_chunk, ch, flatten, appearances))
+                    if len(inflight) >= workers * 2:
+                        done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            collect(fut.result())
+                for fut in inflight:
+                    collect(fut.result())
+
+    elapsed = max(time.time() - start, 1e-6)
+    metrics = get_metrics()
+    metrics.inc("fill_documents_total", stats["filled"], outcome="ok")
+    metrics.inc("fill_documents_total", stats["failed"], outcome="error")
+    metrics.observe("fill_seconds", elapsed)
+    stats.update({
+        "path": out_path,
+        "workers": max(workers, 1),
+        "elapsed_s": round(elapsed, 3),
+        "records_per_s": round(stats["filled"] / elapsed, 1),
+        "zip_bytes": Path(out_path).stat().st_size,
+    })
+    return stats
+
+
+# ----------------------------
+# Export scripts (PY / JS) based on spec
+# ----------------------------
+def safe_json(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
+
+@traced("export.py", lambda r, a, kw: {"engine": "fpdf2", "bytes": len(r)})
+def build_py_script_fpdf2(spec_norm: Dict[str, Any]) -> str:
+    # Best-effort standalone script (requires fpdf2 + downloaded fonts alongside script).
+    return f"""# Generated by WOW Agentic PDF Studio (fpdf2)
+# Requirements: fpdf2
+# Fonts: place DejaVuSans.ttf and NotoSansTC-Regular.ttf in ./fonts_cache or adjust paths
+
+import json
+from fpdf import FPDF
+
+SPEC = {safe_json(spec_norm)}
+
+FONT_PATHS = {{
+  "DejaVuSans": "fonts_cache/DejaVuSans.ttf",
+  "NotoSansTC": "fonts_cache/NotoSansTC-Regular.ttf",
+}}
+
+def choose_font(text, default_family="DejaVuSans", cjk_family="NotoSansTC"):
+    for ch in text:
+        if '\\u4e00' <= ch <= '\\u9fff':
+            return cjk_family
+    return default_family
+
+def main():
+    doc = SPEC.get("document", {{}})
+    page_size = (doc.get("page_size") or "A4").upper()
+    orientation = (doc.get("orientation") or "portrait").lower()
+    fmt = "LETTER" if page_size == "LETTER" else "A4"
+    orient = "L" if orientation == "landscape" else "P"
+
+    pdf = FPDF(orientation=orient, unit="mm", format=fmt)
+    pdf.set_auto_page_break(auto=False)
+
+    # Register fonts
+    for fam, path in FONT_PATHS.items():
+        try:
+            pdf.add_font(fam, style="", fname=path, uni=True)
+        except Exception:
+            pass
+
+    fonts = SPEC.get("fonts", {{}})
+    default_family = (fonts.get("default") or {{}}).get("family", "DejaVuSans")
+    cjk_family = (fonts.get("cjk") or {{}}).get("family", "NotoSansTC")
+    base_size = float((fonts.get("default") or {{}}).get("size", 11))
+
+    for page in SPEC.get("pages", []):
+        pdf.add_page()
+        for el in (page or {{}}).get("elements", []):
+            if (el.get("type") or "").lower() == "label":
+                txt = str(el.get("text") or "")
+                fam = choose_font(txt, default_family, cjk_family)
+                x = float(el.get("x") or 0)
+                y = float(el.get("y") or 0)
+                size = float(el.get("size") or base_size)
+                pdf.set_font(fam, size=size)
+                pdf.set_xy(x, y)
+                if el.get("lines"):
+                    pdf.multi_cell(w=0, h=size * 1.2 * 0.3527777778, text="\n".join(el["lines"]))
+                else:
+                    pdf.multi_cell(w=0, h=5, text=txt)
+            elif (el.get("type") or "").lower() == "field":
+                fid = str(el.get("id") or "")
+                ftype = (el.get("field_type") or "text").lower()
+                name = el.get("name") or fid
+                x = float(el.get("x") or 0)
+                y = float(el.get("y") or 0)
+                w = float(el.get("w") or 40)
+                h = float(el.get("h") or 8)
+                multiline = bool(el.get("multiline") or ftype == "textarea")
+                if ftype in ("text", "textarea"):
+                    pdf.form_text(name=str(name), x=x, y=y, w=w, h=h, multiline=multiline)
+                elif ftype in ("dropdown", "combo"):
+                    opts = el.get("options") or []
+                    pdf.form_combo(name=str(name), x=x, y=y, w=w, h=h, options=[str(o) for o in opts])
+                elif ftype == "checkbox":
+                    pdf.form_checkbox(name=str(name), x=x, y=y, w=w, h=h)
+                else:
+                    pdf.form_text(name=str(name), x=x, y=y, w=w, h=h)
+
+    pdf.output("dynamic_form.pdf")
+
+if __name__ == "__main__":
+    main()
+"""
+
+
+@traced("export.py", lambda r, a, kw: {"engine": "reportlab", "bytes": len(r)})
+def build_py_script_reportlab(spec_norm: Dict[str, Any]) -> str:
+    return f"""# Generated by WOW Agentic PDF Studio (ReportLab)
+# Requirements: reportlab
+# Fonts: place DejaVuSans.ttf and NotoSansTC-Regular.ttf in ./fonts_cache or adjust paths
+
+import json
+from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4, LETTER
 from reportlab.lib.units import mm
-from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase import pdfdoc, pdfmetrics
+from reportlab.pdfbase.acroform import PDFFromString
 from reportlab.pdfbase.ttfonts import TTFont
 
 SPEC = {safe_json(spec_norm)}
@@ -1205,6 +3585,42 @@ def page_dims_mm(page_size, orientation):
 def has_cjk(text):
     return any('\\u4e00' <= ch <= '\\u9fff' for ch in text)
 
+def registered(fam):
+    try:
+        pdfmetrics.getFont(fam)
+        return True
+    except KeyError:
+        return False
+
+class FormResources(pdfdoc.PDFObject):
+    # AcroForm /DR that also lists the document's TTF subsets, so a widget /DA can name one.
+    def __init__(self, acro):
+        self.acro = acro
+
+    def format(self, document):
+        fonts = dict(document.idToObject[pdfdoc.BasicFonts].dict)
+        fonts.update({{k: PDFFromString(v) for k, v in self.acro.fonts.items()}})
+        enc = PDFFromString("<< /RLAFencoding %s >>" % self.acro.encRefStr)
+        return pdfdoc.PDFDictionary({{"Font": pdfdoc.PDFDictionary(fonts), "Encoding": enc}}).format(document)
+
+def use_ttf(c, fam, size, value, options, w, h):
+    # ReportLab widgets only take the standard 14 fonts: redraw the last widget's
+    # appearance with the TTF and point its /DA at that font.
+    acro = c.acroForm
+    annot = c._doc.idToObject[acro.fields[-1].name]
+    form = "ap_%d" % len(acro.fields)
+    c.beginForm(form, 0, 0, w, h)
+    if value:
+        c.setFont(fam, size)
+        c.drawString(2, (h - size) / 2 + size * 0.22, value)
+    c.endForm()
+    annot.dict["AP"] = pdfdoc.PDFDictionary({{"N": pdfdoc.PDFObjectReference(pdfdoc.xObjectName(form))}})
+    annot.dict["DA"] = pdfdoc.PDFString("%s %g Tf 0 g" % (pdfmetrics.getFont(fam).getSubsetInternalName(0, c._doc), size))
+    annot.dict["V"] = annot.dict["DV"] = pdfdoc.PDFString(value)
+    if options:
+        annot.dict["Opt"] = pdfdoc.PDFArray([pdfdoc.PDFString(o) for o in options])
+    acro.extras["DR"] = FormResources(acro)
+
 def main():
     doc = SPEC.get("document", {{}})
     page_size = (doc.get("page_size") or "A4").upper()
@@ -1238,15 +3654,18 @@ def main():
 
     pages = SPEC.get("pages", [])
     for pi, p in enumerate(pages, start=1):
+        prev_label = ""
         for el in (p or {{}}).get("elements", []):
             if (el.get("type") or "").lower() == "label":
                 txt = str(el.get("text") or "")
+                prev_label = txt
                 fam = cjk_family if has_cjk(txt) else default_family
                 x_mm = float(el.get("x") or 0)
                 y_mm = float(el.get("y") or 0)
                 size = float(el.get("size") or base_size)
                 c.setFont(fam, size)
-                c.drawString(x_mm*mm, y_label(y_mm)-3, txt)
+                for li, line in enumerate(el.get("lines") or [txt]):
+                    c.drawString(x_mm*mm, y_label(y_mm)-3-li*size*1.2, line)
             elif (el.get("type") or "").lower() == "field":
                 fid = str(el.get("id") or "")
                 ftype = (el.get("field_type") or "text").lower()
@@ -1256,16 +3675,21 @@ def main():
                 w_mm_ = float(el.get("w") or 40)
                 h_mm_ = float(el.get("h") or 8)
                 x, y, w, h = x_mm*mm, y_field(y_mm, h_mm_), w_mm_*mm, h_mm_*mm
+                opts = [str(o) for o in el.get("options") or []] if ftype in ("dropdown", "combo") else []
+                # Fields with CJK options, or right after a CJK label, keep the CJK TTF.
+                ttf = ftype != "checkbox" and has_cjk(prev_label + "".join(opts)) and registered(cjk_family)
                 if ftype in ("text", "textarea"):
                     flags = 4096 if bool(el.get("multiline") or ftype=="textarea") else 0
-                    c.acroForm.textfield(name=name, x=x, y=y, width=w, height=h, fieldFlags=flags, fontName=default_family, fontSize=max(8, base_size))
+                    c.acroForm.textfield(name=name, x=x, y=y, width=w, height=h, fieldFlags=flags, fontName="Helvetica", fontSize=max(8, base_size))
                 elif ftype == "checkbox":
                     c.acroForm.checkbox(name=name, x=x, y=y, size=min(w, h), buttonStyle="check")
                 elif ftype in ("dropdown", "combo"):
-                    opts = el.get("options") or []
-                    c.acroForm.choice(name=name, x=x, y=y, width=w, height=h, options=[str(o) for o in opts], fontName=default_family, fontSize=max(8, base_size))
+                    rl_opts = [" "] if ttf else opts
+                    c.acroForm.choice(name=name, x=x, y=y, width=w, height=h, options=rl_opts, value=rl_opts[0] if rl_opts else "", fontName="Helvetica", fontSize=max(8, base_size))
                 else:
-                    c.acroForm.textfield(name=name, x=x, y=y, width=w, height=h, fontName=default_family, fontSize=max(8, base_size))
+                    c.acroForm.textfield(name=name, x=x, y=y, width=w, height=h, fontName="Helvetica", fontSize=max(8, base_size))
+                if ttf:
+                    use_ttf(c, cjk_family, max(8, base_size), opts[0] if opts else "", opts, w, h)
 
         if pi < len(pages):
             c.showPage()
@@ -1335,6 +3759,7 @@ def infer_fields_for_jspdf(spec_norm: Dict[str, Any]) -> Dict[str, Any]:
     return {"title": title, "fields": js_fields}
 
 
+@traced("export.js", lambda r, a, kw: {"bytes": len(r)})
 def build_js_script_jspdf(spec_norm: Dict[str, Any]) -> str:
     structure = infer_fields_for_jspdf(spec_norm)
     structure_json = json.dumps(structure, ensure_ascii=False, indent=2)
@@ -1409,11 +3834,80 @@ export const generateClientSidePDF = (structure) => {{
 # ----------------------------
 # PDF preview + field extraction + reconcile
 # ----------------------------
+PREVIEW_MEMO_SIZE = 8
+PREVIEW_MEMO_BYTES = 16 * 1024 * 1024  # PDFs pinned as keys plus the cached values
+
+
+class PreviewMemo:
+    """
+    LRU memo for per-PDF preview helpers, keyed on the bytes object itself: session state
+    hands back the same object every rerun, and bytes cache their hash, so a hit costs no
+    re-encoding or re-hashing of the PDF. Unlike lru_cache it is bounded by the bytes it
+    keeps alive, since every key pins a whole PDF outside the session budget. Instances come
+    from get_preview_memo(): a module-level one would be recreated empty on every rerun.
+    """
+
+    def __init__(self, size: int = PREVIEW_MEMO_SIZE, max_bytes: int = PREVIEW_MEMO_BYTES):
+        self._size = size
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[bytes, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pdf_bytes: bytes, compute: Callable[[bytes], Any]) -> Any:
+        with self._lock:
+            item = self._items.get(pdf_bytes)
+            if item is not None:
+                self._items.move_to_end(pdf_bytes)
+                self.hits += 1
+                return item[0]
+        value = compute(pdf_bytes)
+        cost = len(pdf_bytes) + (len(value) if isinstance(value, str) else sys.getsizeof(value))
+        with self._lock:
+            self.misses += 1
+            if cost > self._max_bytes or pdf_bytes in self._items:
+                return value
+            self._items[pdf_bytes] = (value, cost)
+            self._bytes += cost
+            while len(self._items) > self._size or self._bytes > self._max_bytes:
+                self._bytes -= self._items.popitem(last=False)[1][1]
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+@st.cache_resource
+def get_preview_memo(name: str) -> PreviewMemo:
+    return PreviewMemo()
+
+
+def _pdf_data_uri(pdf_bytes: bytes) -> str:
+    return "data:application/pdf;base64," + base64.b64encode(pdf_bytes).decode("ascii")
+
+
+def _pdf_field_count(pdf_bytes: bytes) -> Union[int, str]:
+    try:
+        return extract_pdf_fields(pdf_bytes).get("raw_count", 0)
+    except Exception:
+        return "(unavailable)"
+
+
+def pdf_data_uri(pdf_bytes: bytes) -> str:
+    return get_preview_memo("pdf_data_uri").get(pdf_bytes, _pdf_data_uri)
+
+
+def pdf_field_count(pdf_bytes: bytes) -> Union[int, str]:
+    return get_preview_memo("pdf_field_count").get(pdf_bytes, _pdf_field_count)
+
+
 def pdf_iframe_view(pdf_bytes: bytes, height: int = 720) -> str:
-    b64 = base64.b64encode(pdf_bytes).decode("utf-8")
     return f"""
     <iframe
-      src="data:application/pdf;base64,{b64}"
+      src="{pdf_data_uri(pdf_bytes)}"
       width="100%"
       height="{height}"
       style="border: 1px solid var(--wow-border); border-radius: 14px; background: var(--wow-card);"
@@ -1421,20 +3915,74 @@ def pdf_iframe_view(pdf_bytes: bytes, height: int = 720) -> str:
     """
 
 
-def extract_pdf_fields(pdf_bytes: bytes) -> Dict[str, Any]:
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    fields = reader.get_fields() or {}
-    out_fields = {}
-    for k, v in fields.items():
-        info = {}
-        try:
-            info["ft"] = str(v.get("/FT", "")) if isinstance(v, dict) else ""
-            info["t"] = str(v.get("/T", "")) if isinstance(v, dict) else ""
-            info["v"] = str(v.get("/V", "")) if isinstance(v, dict) else ""
-        except Exception:
-            pass
-        out_fields[str(k)] = info
-    return {"fields": out_fields, "names": sorted(out_fields.keys()), "raw_count": len(out_fields)}
+FIELD_CACHE_SIZE = 128
+
+
+@st.cache_resource
+def get_field_cache() -> TemplateCache:
+    cache = TemplateCache(size=FIELD_CACHE_SIZE)
+    get_metrics().watch_cache("fields", cache)
+    return cache
+
+
+def walk_acroform_fields(reader: PdfReader) -> Dict[str, Dict[str, str]]:
+    """
+    Reads trailer -> /Root -> /AcroForm -> /Fields only. Pages, content streams and
+    annotations outside the field tree are never resolved. /FT and /V are inherited from
+    parents as in the spec; widget-only kids are folded into their terminal field.
+    """
+    root = reader.trailer["/Root"].get_object()
+    acro = root.get("/AcroForm")
+    if acro is None:
+        return {}
+    stack = [(ref, "", "", None) for ref in reversed(acro.get_object().get("/Fields") or [])]
+    seen: set = set()
+    out: Dict[str, Dict[str, str]] = {}
+    while stack:
+        ref, parent, ft, value = stack.pop()
+        idnum = getattr(ref, "idnum", None)
+        if idnum is not None:
+            if idnum in seen:
+                continue
+            seen.add(idnum)
+        node = ref.get_object()
+        if not isinstance(node, DictionaryObject):
+            continue
+        t = node.get("/T")
+        name = (f"{parent}.{t}" if parent else str(t)) if t is not None else parent
+        ft = str(node.get("/FT", ft))
+        value = node.get("/V", value)
+        kids = [k for k in node.get("/Kids") or [] if "/T" in k.get_object()]
+        if kids:
+            stack.extend((k, name, ft, value) for k in reversed(kids))
+        elif name:
+            out[name] = {"ft": ft, "t": str(t if t is not None else name.rsplit(".", 1)[-1]), "v": "" if value is None else str(value)}
+    return out
+
+
+def extract_pdf_fields(source: Union[bytes, str, Path]) -> Dict[str, Any]:
+    """
+    Field names/types/values of a PDF, memoized by content hash. Paths are mmapped so
+    large files are paged in lazily rather than read up front. Returns a copy, so callers
+    may modify the result without touching the shared cache.
+    """
+    def index(stream) -> Dict[str, Any]:
+        fields = walk_acroform_fields(PdfReader(stream))
+        return {"fields": fields, "names": sorted(fields.keys()), "raw_count": len(fields)}
+
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:  # mmap cannot map an empty file
+                raise ValueError("empty file, not a PDF")
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                key = hashlib.sha256(mm).hexdigest()
+                entry, _ = get_field_cache().get_or_compile(key, lambda: index(mm))
+    else:
+        if not source:
+            raise ValueError("empty file, not a PDF")
+        key = hashlib.sha256(source).hexdigest()
+        entry, _ = get_field_cache().get_or_compile(key, lambda: index(io.BytesIO(source)))
+    return {"fields": {k: dict(v) for k, v in entry["fields"].items()}, "names": list(entry["names"]), "raw_count": entry["raw_count"]}
 
 
 def spec_field_names(spec_norm: Dict[str, Any]) -> List[str]:
@@ -1459,26 +4007,94 @@ def spec_field_names(spec_norm: Dict[str, Any]) -> List[str]:
     return ordered
 
 
-def reconcile_pdf_vs_spec(spec_norm: Dict[str, Any], uploaded_pdf_bytes: bytes) -> Dict[str, Any]:
-    pdf_info = extract_pdf_fields(uploaded_pdf_bytes)
+RENAME_MIN_SCORE = 0.6
+RENAME_CANDIDATES = 8
+
+
+def slug_field_name(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "", name.lower())
+
+
+def name_trigrams(slug: str) -> set:
+    padded = f"  {slug} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str) -> int:
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        cur = [i]
+        for j, cb in enumerate(b, start=1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+class FieldNameIndex:
+    """
+    Normalized-slug and trigram index over spec field names. A lookup only scores names
+    that share a trigram with the query (top RENAME_CANDIDATES by overlap), so matching
+    a whole PDF is roughly linear in its field count.
+    """
+
+    def __init__(self, names: List[str]):
+        self.names = list(names)
+        self.slugs = [slug_field_name(n) for n in self.names]
+        self.by_slug: Dict[str, int] = {}
+        self.postings: Dict[str, List[int]] = {}
+        for i, slug in enumerate(self.slugs):
+            self.by_slug.setdefault(slug, i)
+            for g in name_trigrams(slug):
+                self.postings.setdefault(g, []).append(i)
+
+    def match(self, name: str, allowed: Optional[set] = None) -> Optional[Tuple[str, float]]:
+        slug = slug_field_name(name)
+        if not slug:
+            return None
+        exact = self.by_slug.get(slug)
+        if exact is not None and (allowed is None or self.names[exact] in allowed):
+            return self.names[exact], 1.0
+        overlap: Dict[int, int] = {}
+        for g in name_trigrams(slug):
+            for i in self.postings.get(g, ()):
+                # Filter before ranking, or names already present could fill every candidate slot.
+                if allowed is None or self.names[i] in allowed:
+                    overlap[i] = overlap.get(i, 0) + 1
+        best: Optional[Tuple[str, float]] = None
+        for i in sorted(overlap, key=overlap.get, reverse=True)[:RENAME_CANDIDATES]:
+            cand = self.slugs[i]
+            score = 1.0 - edit_distance(slug, cand) / max(len(slug), len(cand))
+            if cand in slug or slug in cand:
+                score = max(score, 0.9)
+            if best is None or score > best[1]:
+                best = (self.names[i], round(score, 3))
+        return best if best and best[1] >= RENAME_MIN_SCORE else None
+
+
+def suggest_renames(index: FieldNameIndex, missing_in_pdf: List[str], extra_in_pdf: List[str]) -> List[Dict[str, Any]]:
+    # Each PDF-only name proposes its closest missing spec name; the best proposal per spec name wins.
+    allowed = set(missing_in_pdf)
+    best: Dict[str, Tuple[str, float]] = {}
+    for pname in extra_in_pdf:
+        hit = index.match(pname, allowed)
+        if hit and (hit[0] not in best or hit[1] > best[hit[0]][1]):
+            best[hit[0]] = (pname, hit[1])
+    return [{"spec": s, "pdf": best[s][0], "score": best[s][1]} for s in missing_in_pdf if s in best]
+
+
+def reconcile_pdf_vs_spec(
+    spec_norm: Dict[str, Any], uploaded_pdf: Union[bytes, str, Path], index: Optional[FieldNameIndex] = None
+) -> Dict[str, Any]:
+    pdf_info = extract_pdf_fields(uploaded_pdf)
     pdf_names = set(pdf_info["names"])
     spec_names_list = spec_field_names(spec_norm)
     spec_names = set(spec_names_list)
 
     missing_in_pdf = sorted(spec_names - pdf_names)
     extra_in_pdf = sorted(pdf_names - spec_names)
-
-    suggestions = []
-    for sname in missing_in_pdf[:40]:
-        sslug = re.sub(r"[^a-z0-9]+", "", sname.lower())
-        close = None
-        for pname in extra_in_pdf:
-            pslug = re.sub(r"[^a-z0-9]+", "", pname.lower())
-            if sslug and pslug and (sslug in pslug or pslug in sslug):
-                close = pname
-                break
-        if close:
-            suggestions.append({"spec": sname, "pdf": close})
+    suggestions = suggest_renames(index or FieldNameIndex(spec_names_list), missing_in_pdf, extra_in_pdf)
 
     return {
         "spec_field_count": len(spec_names_list),
@@ -1490,6 +4106,554 @@ def reconcile_pdf_vs_spec(spec_norm: Dict[str, Any], uploaded_pdf_bytes: bytes)
     }
 
 
+# ----------------------------
+# Bulk reconcile: many returned PDFs against one spec
+# ----------------------------
+RECONCILE_CSV_COLUMNS = ["file", "ok", "error", "pdf_field_count", "missing", "extra", "renames"]
+# Server-side folder input is confined to this directory; unset disables it.
+PDF_FOLDER_ROOT = os.environ.get("WOW_PDF_FOLDER_ROOT", "").strip()
+
+_RECONCILE_SPEC: Dict[str, Any] = {}
+
+
+def resolve_pdf_folder(folder: str) -> Path:
+    # Relative input is taken from PDF_FOLDER_ROOT; anything resolving outside it is rejected.
+    if not PDF_FOLDER_ROOT:
+        raise ValueError("Server folders are disabled (set WOW_PDF_FOLDER_ROOT to enable them).")
+    root = Path(PDF_FOLDER_ROOT).expanduser().resolve()
+    path = (root / folder.strip()).resolve()
+    if not path.is_relative_to(root):
+        raise ValueError(f"Folder must be inside {root}.")
+    if not path.is_dir():
+        raise ValueError(f"Not a folder: {path}")
+    return path
+
+
+def iter_pdf_sources(uploads: List[Tuple[str, bytes]], folder: str = "") -> Iterator[Tuple[str, Union[bytes, str]]]:
+    # Zip members are read one at a time; folder PDFs are passed as paths so workers mmap them.
+    base = resolve_pdf_folder(folder) if folder.strip() else None
+    for name, data in uploads:
+        if name.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir() and info.filename.lower().endswith(".pdf"):
+                        yield f"{name}/{info.filename}", zf.read(info)
+        else:
+            yield name, data
+    if base is not None:
+        root = Path(PDF_FOLDER_ROOT).expanduser().resolve()
+        for path in sorted(base.rglob("*.pdf")):
+            if path.resolve().is_relative_to(root):  # symlinks must not lead back out
+                yield str(path.relative_to(root)), str(path)
+
+
+def map_pdf_sources(sources, worker_fn, init_fn, init_args: tuple, workers: int) -> Tuple[List[Any], int]:
+    # Shared by the bulk PDF tools: spawned pool, bounded in-flight sources, results in input order.
+    if workers <= 1:
+        init_fn(*init_args)
+        return [worker_fn(label, src) for label, src in sources], 1
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=worker_pool_context(),
+        initializer=init_fn,
+        initargs=init_args,
+    ) as pool:
+        futures, inflight = [], set()
+        for label, src in sources:
+            fut = pool.submit(worker_fn, label, src)
+            futures.append(fut)
+            inflight.add(fut)
+            if len(inflight) >= workers * 4:
+                _, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+        return [f.result() for f in futures], workers
+
+
+def _reconcile_worker_init(spec_norm: Dict[str, Any]):
+    _RECONCILE_SPEC["spec"] = spec_norm
+    _RECONCILE_SPEC["index"] = FieldNameIndex(spec_field_names(spec_norm))
+
+
+def _reconcile_worker(label: str, source: Union[bytes, str]) -> Dict[str, Any]:
+    try:
+        rep = reconcile_pdf_vs_spec(_RECONCILE_SPEC["spec"], source, index=_RECONCILE_SPEC["index"])
+    except Exception as e:
+        return {"file": label, "ok": False, "error": str(e)}
+    rep.pop("pdf_fields_sample", None)
+    return {"file": label, "ok": True, "error": "", **rep}
+
+
+def reconcile_many(
+    spec_norm: Dict[str, Any], sources: Iterator[Tuple[str, Union[bytes, str]]], workers: int = FILL_WORKERS
+) -> Dict[str, Any]:
+    """
+    Reconciles every source against one spec. Workers build the name index once at
+    start-up; a broken PDF only fails its own row. Results come back in input order.
+    """
+    start = time.time()
+    rows, used = map_pdf_sources(sources, _reconcile_worker, _reconcile_worker_init, (spec_norm,), workers)
+
+    ok_rows = [r for r in rows if r["ok"]]
+    missing_by_field: Dict[str, int] = {}
+    for r in ok_rows:
+        for name in r["missing_in_pdf"]:
+            missing_by_field[name] = missing_by_field.get(name, 0) + 1
+    return {
+        "summary": {
+            "files": len(rows),
+            "ok": len(ok_rows),
+            "failed": len(rows) - len(ok_rows),
+            "clean": sum(1 for r in ok_rows if not r["missing_in_pdf"] and not r["extra_in_pdf"]),
+            "missing_by_field": dict(sorted(missing_by_field.items(), key=lambda kv: -kv[1])),
+            "workers": used,
+            "elapsed_s": round(time.time() - start, 3),
+        },
+        "rows": rows,
+    }
+
+
+def reconcile_report_csv(result: Dict[str, Any]) -> bytes:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=RECONCILE_CSV_COLUMNS)
+    writer.writeheader()
+    for r in result["rows"]:
+        writer.writerow({
+            "file": r["file"],
+            "ok": r["ok"],
+            "error": r.get("error", ""),
+            "pdf_field_count": r.get("pdf_field_count", ""),
+            "missing": "; ".join(r.get("missing_in_pdf") or []),
+            "extra": "; ".join(r.get("extra_in_pdf") or []),
+            "renames": "; ".join(f"{x['pdf']} -> {x['spec']}" for x in r.get("rename_suggestions") or []),
+        })
+    return buf.getvalue().encode("utf-8")
+
+
+# ----------------------------
+# Value extraction: returned PDFs -> typed table
+# ----------------------------
+EXTRACT_FORMATS = ["csv", "parquet"]
+OFF_VALUES = {"", "/Off", "Off", "/No", "No", "False", "false"}
+
+_EXTRACT_SPEC: Dict[str, Any] = {}
+
+
+def spec_field_schema(spec_norm: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    schema: Dict[str, Dict[str, Any]] = {}
+    for p in spec_norm.get("pages") or []:
+        for el in (p or {}).get("elements") or []:
+            if not isinstance(el, dict) or (el.get("type") or "").lower() != "field":
+                continue
+            name = str(el.get("name") or el.get("id") or "")
+            if name and name not in schema:
+                schema[name] = {
+                    "type": (el.get("field_type") or "text").lower(),
+                    "options": [str(o) for o in el.get("options") or []],
+                }
+    return schema
+
+
+def coerce_extracted_value(info: Dict[str, Any], raw: str) -> Tuple[Any, Optional[str]]:
+    # Returns (typed value, warning). Missing text stays None so it is a null in the table.
+    kind = info.get("type")
+    if kind == "checkbox":
+        return raw not in OFF_VALUES, None
+    if raw == "":
+        return None, None
+    if kind == "dropdown" and info.get("options"):
+        if raw in info["options"]:
+            return raw, None
+        folded = {o.casefold(): o for o in info["options"]}
+        if raw.casefold() in folded:
+            return folded[raw.casefold()], None
+        return None, f"'{raw}' is not an option"
+    return raw, None
+
+
+def _extract_worker_init(spec_norm: Dict[str, Any]):
+    _EXTRACT_SPEC["schema"] = spec_field_schema(spec_norm)
+
+
+def _extract_worker(label: str, source: Union[bytes, str]) -> Dict[str, Any]:
+    schema = _EXTRACT_SPEC["schema"]
+    row: Dict[str, Any] = {"_file": label, "_ok": False, "_error": ""}
+    try:
+        fields = extract_pdf_fields(source)["fields"]
+    except Exception as e:
+        row["_error"] = str(e)
+        return row
+    notes = []
+    for name, info in schema.items():
+        if name not in fields:
+            row[name] = None
+            notes.append(f"{name}: missing")
+            continue
+        row[name], warn = coerce_extracted_value(info, fields[name].get("v", ""))
+        if warn:
+            notes.append(f"{name}: {warn}")
+    row["_ok"] = True
+    row["_error"] = "; ".join(notes)
+    return row
+
+
+def values_dataframe(rows: List[Dict[str, Any]], schema: Dict[str, Dict[str, Any]]) -> "pd.DataFrame":
+    columns = ["_file"] + list(schema.keys()) + ["_ok", "_error"]
+    df = pd.DataFrame(rows, columns=columns)
+    for name, info in schema.items():
+        if info["type"] == "checkbox":
+            df[name] = df[name].astype("boolean")
+        elif info["type"] == "dropdown" and info["options"]:
+            df[name] = pd.Categorical(df[name], categories=info["options"])
+        else:
+            df[name] = df[name].astype("string")
+    return df
+
+
+def extract_values_to_table(
+    spec_norm: Dict[str, Any], sources: Iterator[Tuple[str, Union[bytes, str]]], fmt: str = "csv", workers: int = FILL_WORKERS
+) -> Dict[str, Any]:
+    """
+    Pulls every spec field's /V out of each source, typed by the spec (checkbox -> bool,
+    dropdown -> one of its options, else string), into one row per file. A file that
+    cannot be read keeps its row with _ok=False. Parquet needs pyarrow; without it the
+    table is written as CSV.
+    """
+    start = time.time()
+    schema = spec_field_schema(spec_norm)
+    rows, used = map_pdf_sources(sources, _extract_worker, _extract_worker_init, (spec_norm,), workers)
+    df = values_dataframe(rows, schema)
+
+    note = ""
+    out_path = new_output_path("wow_values_", ".parquet" if fmt == "parquet" else ".csv")
+    if fmt == "parquet":
+        try:
+            df.to_parquet(out_path, index=False)
+        except ImportError as e:
+            note = f"parquet unavailable ({e}); wrote CSV"
+            fmt = "csv"
+            Path(out_path).unlink(missing_ok=True)
+            out_path = str(Path(out_path).with_suffix(".csv"))
+    if fmt == "csv":
+        df.to_csv(out_path, index=False)
+    return {
+        "path": out_path,
+        "format": fmt,
+        "file_name": f"form_values.{fmt}",
+        "mime": "application/vnd.apache.parquet" if fmt == "parquet" else "text/csv",
+        "files": len(df),
+        "failed": int((~df["_ok"]).sum()),
+        "preview": df.head(50),
+        "workers": used,
+        "elapsed_s": round(time.time() - start, 3),
+        "note": note,
+    }
+
+
+# ----------------------------
+# Engine parity + benchmark harness
+# ----------------------------
+BENCH_ENGINES = ["reportlab", "fpdf2"]
+BENCH_REPEATS = 5
+PARITY_TOLERANCE_PT = 1.0
+REGRESSION_THRESHOLD = 0.15  # relative increase vs baseline that counts as a regression
+REGRESSION_METRICS = ["ms_median", "peak_kb", "bytes"]
+
+
+def widget_kind(ft: str, flags: int) -> str:
+    if ft == "/Tx":
+        return "textarea" if flags & FF_MULTILINE else "text"
+    return {"/Ch": "dropdown", "/Btn": "checkbox"}.get(ft, ft or "unknown")
+
+
+def extract_widget_layout(pdf_bytes: bytes) -> Dict[str, Dict[str, Any]]:
+    # Widget name -> page, kind and rect in points; names/types resolved through /Parent.
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    out: Dict[str, Dict[str, Any]] = {}
+    for pi, page in enumerate(reader.pages, start=1):
+        for ref in page.get("/Annots") or []:
+            annot = ref.get_object()
+            if annot.get("/Subtype") != "/Widget":
+                continue
+            parts, ft, flags, node = [], "", 0, annot
+            while node is not None:
+                if "/T" in node:
+                    parts.append(str(node["/T"]))
+                ft = ft or str(node.get("/FT", ""))
+                flags = flags or int(node.get("/Ff", 0))
+                parent = node.get("/Parent")
+                node = parent.get_object() if parent is not None else None
+            name = ".".join(reversed(parts))
+            if name:
+                out[name] = {"page": pi, "kind": widget_kind(ft, flags), "rect": [round(float(v), 2) for v in annot["/Rect"]]}
+    return out
+
+
+def compare_widget_layouts(a: Dict[str, Dict[str, Any]], b: Dict[str, Dict[str, Any]], tol_pt: float) -> Dict[str, Any]:
+    issues: List[str] = []
+    for name in sorted(a.keys() & b.keys()):
+        wa, wb = a[name], b[name]
+        if wa["kind"] != wb["kind"]:
+            issues.append(f"{name}: type {wa['kind']} vs {wb['kind']}")
+        if wa["page"] != wb["page"]:
+            issues.append(f"{name}: page {wa['page']} vs {wb['page']}")
+        delta = max(abs(x - y) for x, y in zip(wa["rect"], wb["rect"]))
+        if delta > tol_pt:
+            issues.append(f"{name}: rect differs by {delta:.2f} pt")
+    only_a, only_b = sorted(a.keys() - b.keys()), sorted(b.keys() - a.keys())
+    return {"ok": not (issues or only_a or only_b), "only_a": only_a, "only_b": only_b, "issues": issues}
+
+
+@st.cache_resource
+def get_tracemalloc_lock() -> threading.Lock:
+    # Process-wide like tracemalloc itself; a module-level lock would be rebuilt on every
+    # rerun and so only ever serialize one session with itself.
+    return threading.Lock()
+
+
+@contextmanager
+def tracemalloc_session(frames: int = 1) -> Iterator[bool]:
+    """
+    One tracemalloc user at a time across all sessions (benchmarks, stage breakdowns,
+    profiling share the process). Starts tracing only when nobody else did and only stops
+    what it started; yields whether it owns the tracing. The peak is reset on entry either way.
+    """
+    with get_tracemalloc_lock():
+        owns_tracing = not tracemalloc.is_tracing()
+        if owns_tracing:
+            tracemalloc.start(frames)
+        tracemalloc.reset_peak()
+        try:
+            yield owns_tracing
+        finally:
+            if owns_tracing:
+                tracemalloc.stop()
+
+
+def bench_engine(spec_norm: Dict[str, Any], engine: str, repeats: int) -> Tuple[bytes, Dict[str, Any]]:
+    # Timed runs stay free of tracemalloc overhead; one extra traced run gives the peak.
+    times = []
+    pdf_bytes = b""
+    for _ in range(max(1, repeats)):
+        t0 = time.perf_counter()
+        pdf_bytes, _ = render_spec_pdf(spec_norm, engine)
+        times.append((time.perf_counter() - t0) * 1000)
+    with tracemalloc_session():
+        base = tracemalloc.get_traced_memory()[0]
+        render_spec_pdf(spec_norm, engine)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    return pdf_bytes, {
+        "ms_median": round(statistics.median(times), 2),
+        "ms_min": round(min(times), 2),
+        "peak_kb": round(peak / 1024, 1),
+        "bytes": len(pdf_bytes),
+    }
+
+
+def current_commit() -> str:
+    try:
+        res = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=2,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return res.stdout.strip() or "unknown"
+    except Exception:
+        return "unknown"
+
+
+def run_parity_benchmark(
+    corpus: List[Tuple[str, Dict[str, Any]]],
+    engines: List[str] = BENCH_ENGINES,
+    repeats: int = BENCH_REPEATS,
+    tol_pt: float = PARITY_TOLERANCE_PT,
+) -> Dict[str, Any]:
+    """
+    Renders every corpus spec with each engine, records time/peak memory/size, and
+    compares each engine's widget names, types, pages and rects against the first
+    engine's. The report is plain JSON so runs from different commits can be diffed.
+    """
+    rows = []
+    for label, spec_norm in corpus:
+        expected = len(spec_field_names(spec_norm))
+        layouts: Dict[str, Dict[str, Any]] = {}
+        metrics: Dict[str, Any] = {}
+        for engine in engines:
+            try:
+                pdf_bytes, m = bench_engine(spec_norm, engine, repeats)
+                layouts[engine] = extract_widget_layout(pdf_bytes)
+                m["widgets"] = len(layouts[engine])
+                m["widgets_expected"] = expected
+            except Exception as e:
+                m = {"error": str(e)}
+            metrics[engine] = m
+        parity = {}
+        ref = engines[0]
+        for engine in engines[1:]:
+            if ref in layouts and engine in layouts:
+                parity[f"{ref}~{engine}"] = compare_widget_layouts(layouts[ref], layouts[engine], tol_pt)
+        rows.append({"spec": label, "engines": metrics, "parity": parity})
+    return {
+        "meta": {
+            "commit": current_commit(),
+            "ts": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeats": repeats,
+            "tolerance_pt": tol_pt,
+        },
+        "specs": rows,
+    }
+
+
+def flag_regressions(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float = REGRESSION_THRESHOLD) -> List[Dict[str, Any]]:
+    base = {row["spec"]: row["engines"] for row in baseline.get("specs") or []}
+    flags = []
+    for row in report.get("specs") or []:
+        for engine, m in row["engines"].items():
+            old = (base.get(row["spec"]) or {}).get(engine) or {}
+            for metric in REGRESSION_METRICS:
+                if metric in m and old.get(metric):
+                    change = (m[metric] - old[metric]) / old[metric]
+                    if change > threshold:
+                        flags.append({"spec": row["spec"], "engine": engine, "metric": metric,
+                                      "baseline": old[metric], "current": m[metric], "change_pct": round(change * 100, 1)})
+    return flags
+
+
+# ----------------------------
+# Synthetic spec corpus + scaling sweeps
+# ----------------------------
+SYNTH_FIELD_TYPES = ["text", "textarea", "checkbox", "dropdown"]
+SYNTH_DEFAULTS = {
+    "pages": 1,
+    "elements_per_page": 20,
+    "type_mix": {"text": 4, "textarea": 1, "checkbox": 2, "dropdown": 2},
+    "cjk_ratio": 0.0,
+    "option_count": 4,
+    "unit": "mm",
+}
+SWEEP_DIMENSIONS = ["pages", "elements_per_page", "cjk_ratio", "option_count"]
+SWEEP_STAGES = ["parse", "validate", "render", "postprocess"]
+SYNTH_WORDS = ["name", "date", "address", "device", "lot", "serial", "contact", "email", "phone", "model",
+               "batch", "site", "reason", "notes", "dose", "code", "region", "status", "owner", "version"]
+SYNTH_CJK = "申請人姓名日期地址裝置批號序號聯絡電話型號地點原因備註劑量代碼區域狀態版本"
+
+
+def generate_synthetic_spec(seed: int = 0, **params) -> Dict[str, Any]:
+    """
+    Deterministic (per seed) PDF Build Spec: N pages of label + field rows whose height
+    shrinks to fit elements_per_page, field types drawn from type_mix, a cjk_ratio share
+    of CJK labels, option_count options per dropdown, coordinates in mm or pt.
+    """
+    cfg = {**SYNTH_DEFAULTS, **{k: v for k, v in params.items() if v is not None}}
+    rng = random.Random(seed)
+    types = list(cfg["type_mix"].keys())
+    weights = list(cfg["type_mix"].values())
+    scale = 1.0 / MM_PER_PT if cfg["unit"] == "pt" else 1.0
+    page_w, page_h = page_dims_mm("A4", "portrait")
+    m = 12.0
+    rows = max(1, int(cfg["elements_per_page"]))
+    row_h = min(12.0, (page_h - 2 * m) / rows)
+    field_h = max(2.0, row_h * 0.75)
+
+    def coord(v: float) -> float:
+        return round(v * scale, 2)
+
+    pages = []
+    n = 0
+    for pn in range(1, int(cfg["pages"]) + 1):
+        elements = []
+        for r in range(rows):
+            n += 1
+            y = m + r * row_h
+            if rng.random() < cfg["cjk_ratio"]:
+                text = "".join(rng.choice(SYNTH_CJK) for _ in range(rng.randint(2, 6)))
+            else:
+                text = " ".join(rng.choice(SYNTH_WORDS) for _ in range(rng.randint(1, 3))).capitalize()
+            ftype = rng.choices(types, weights)[0]
+            elements.append({"type": "label", "text": f"{text}:", "x": coord(m), "y": coord(y + field_h * 0.3)})
+            field = {"type": "field", "field_type": ftype, "id": f"f{n}", "name": f"F{n}_{ftype}",
+                     "x": coord(70.0), "y": coord(y), "w": coord(5.0 if ftype == "checkbox" else page_w - 70.0 - m),
+                     "h": coord(min(field_h, 5.0) if ftype == "checkbox" else field_h)}
+            if ftype == "dropdown":
+                field["options"] = [f"Option {i + 1}" for i in range(max(1, int(cfg["option_count"])))]
+            if ftype == "textarea":
+                field["multiline"] = True
+            elements.append(field)
+        pages.append({"number": pn, "elements": elements})
+    return {
+        "document": {"title": f"Synthetic {seed}", "page_size": "A4", "orientation": "portrait", "unit": cfg["unit"],
+                     "margin": {"left": coord(m), "top": coord(m), "right": coord(m), "bottom": coord(m)}},
+        "fonts": {"default": {"family": "DejaVuSans", "size": 10}, "cjk": {"family": "NotoSansTC", "size": 10}},
+        "pages": pages,
+    }
+
+
+def profile_spec_stages(text: str, engine: str, appearances: bool = False) -> Dict[str, Dict[str, float]]:
+    # One untraced pass for durations, one traced pass for per-stage peak allocations.
+    def run(mark):
+        obj, errors = parse_pdfspec(text)
+        mark("parse")
+        if errors:
+            raise ValueError("; ".join(errors))
+        report = validate_pdfspec(obj, unit_fallback="mm", page_fallback="A4")
+        mark("validate")
+        spec_norm = report["normalized"]
+        gen = generate_pdf_reportlab if engine == "reportlab" else generate_pdf_fpdf2
+        pdf_bytes, _ = gen(spec_norm)
+        mark("render")
+        if not appearances:
+            set_need_appearances(pdf_bytes)
+        mark("postprocess")
+
+    out: Dict[str, Dict[str, float]] = {}
+    last = [time.perf_counter()]
+
+    def timed(stage: str):
+        now = time.perf_counter()
+        out[stage] = {"ms": round((now - last[0]) * 1000, 2)}
+        last[0] = now
+
+    run(timed)
+    with tracemalloc_session():
+        base = [tracemalloc.get_traced_memory()[0]]
+
+        def traced(stage: str):
+            current, peak = tracemalloc.get_traced_memory()
+            out[stage]["peak_kb"] = round(max(0, peak - base[0]) / 1024, 1)
+            tracemalloc.reset_peak()
+            base[0] = current
+
+        run(traced)
+    return out
+
+
+def run_synthetic_sweep(
+    dimension: str, values: List[float], base: Dict[str, Any], engine: str = "reportlab", seed: int = 0, appearances: bool = False
+) -> List[Dict[str, Any]]:
+    # Warm-up so font registration and imports don't land on the first point.
+    profile_spec_stages(wrap_yaml_block(generate_synthetic_spec(seed, **base)), engine, appearances)
+    rows = []
+    for v in values:
+        params = {**base, dimension: v}
+        spec = generate_synthetic_spec(seed, **params)
+        text = wrap_yaml_block(spec)
+        fields = sum(1 for p in spec["pages"] for el in p["elements"] if el["type"] == "field")
+        for stage, m in profile_spec_stages(text, engine, appearances).items():
+            rows.append({"dimension": dimension, "value": v, "fields": fields, "spec_bytes": len(text.encode("utf-8")),
+                         "stage": stage, "ms": m["ms"], "peak_kb": m.get("peak_kb", 0.0)})
+    return rows
+
+
+def default_bench_corpus() -> List[Tuple[str, Dict[str, Any]]]:
+    corpus = []
+    for label, text in (("default_spec", DEFAULT_PDFSPEC_MD), ("auto_layout_sample", None)):
+        if text is None:
+            obj = layout_form_markdown(DEFAULT_SAMPLE_MD)[0]
+        else:
+            obj = parse_pdfspec(text)[0]
+        report = validate_pdfspec(obj, unit_fallback="mm", page_fallback="A4")
+        if report.get("normalized") is not None and not report.get("errors"):
+            corpus.append((label, report["normalized"]))
+    return corpus
+
+
 # ----------------------------
 # Minimal pipeline stub (kept)
 # ----------------------------
@@ -1509,6 +4673,514 @@ def fake_agent_run(step: Dict[str, Any], input_text: str) -> Tuple[str, int]:
     return out, int((time.time() - start) * 1000)
 
 
+# ----------------------------
+# Model routing (rolling health, hedging, failover)
+# ----------------------------
+MODEL_PROVIDERS = {
+    "gpt-4o-mini": "OpenAI",
+    "gpt-4.1-mini": "OpenAI",
+    "gemini-2.5-flash": "Gemini",
+    "gemini-2.5-flash-lite": "Gemini",
+    "gemini-3-flash-preview": "Gemini",
+    "anthropic (configured)": "Anthropic",
+    "grok-4-fast-reasoning": "Grok",
+    "grok-3-mini": "Grok",
+}
+
+# Per-agent fallback order; the model picked in the UI is always tried first.
+AGENT_ROUTE_PREFERENCES = {
+    "ingest_normalize": ["gpt-4o-mini", "gemini-2.5-flash-lite", "anthropic (configured)", "grok-3-mini"],
+    "pdf_spec": ["gemini-2.5-flash", "gpt-4.1-mini", "anthropic (configured)", "grok-4-fast-reasoning"],
+}
+DEFAULT_ROUTE_PREFERENCES = ["gpt-4o-mini", "gemini-2.5-flash", "anthropic (configured)", "grok-3-mini"]
+
+ROUTER_WINDOW = 50
+ROUTER_HEDGE_AFTER_MS = 2500
+ROUTER_MAX_ATTEMPTS = 3
+
+
+def record_agent_tokens(model: str, input_text: str, output: str):
+    # Counted per model call, so repair rounds, batch requests and losing hedges all show up.
+    get_metrics().inc("agent_tokens_total", count_tokens(input_text), model=model, direction="input")
+    get_metrics().inc("agent_tokens_total", count_tokens(output), model=model, direction="output")
+
+
+class ModelRouter:
+    """Process-wide rolling latency/error stats per model, shared by all sessions."""
+
+    def __init__(self, window: int = ROUTER_WINDOW):
+        self._lock = threading.Lock()
+        self._window = window
+        self._samples: Dict[str, deque] = {}
+
+    def record(self, model: str, latency_ms: int, ok: bool, agent: str = ""):
+        get_metrics().observe(
+            "agent_step_seconds", latency_ms / 1000.0, agent=agent or "unknown", model=model, outcome="ok" if ok else "error"
+        )
+        with self._lock:
+            dq = self._samples.setdefault(model, deque(maxlen=self._window))
+            dq.append((int(latency_ms), bool(ok)))
+
+    def stats(self, model: str) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples.get(model) or [])
+        if not samples:
+            return {"model": model, "samples": 0, "p50_ms": None, "p95_ms": None, "error_rate": 0.0}
+        lats = sorted(lat for lat, ok in samples if ok) or sorted(lat for lat, _ in samples)
+        errors = sum(1 for _, ok in samples if not ok)
+        return {
+            "model": model,
+            "samples": len(samples),
+            "p50_ms": lats[len(lats) // 2],
+            "p95_ms": lats[min(len(lats) - 1, int(len(lats) * 0.95))],
+            "error_rate": round(errors / len(samples), 3),
+        }
+
+    def all_stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            models = list(self._samples.keys())
+        return [self.stats(m) for m in models]
+
+    def rank(self, candidates: List[str]) -> List[str]:
+        # Error rate dominates, then p95 latency; routes without samples are assumed to
+        # answer right at the hedge threshold. Ties keep the preference order.
+        def score(item: Tuple[int, str]) -> Tuple[float, float, int]:
+            pos, model = item
+            s = self.stats(model)
+            if not s["samples"]:
+                return 0.0, float(ROUTER_HEDGE_AFTER_MS), pos
+            return round(s["error_rate"], 1), float(s["p95_ms"] or 0), pos
+
+        return [m for _, m in sorted(enumerate(candidates), key=score)]
+
+    def call(self, step: Dict[str, Any], input_text: str, call_fn=None) -> Tuple[str, int]:
+        """One unrouted call to step["model"]; still feeds the rolling stats and token counters."""
+        out, lat = (call_fn or fake_agent_run)(step, input_text)
+        self.record(step["model"], lat, ok=True, agent=step.get("id", ""))
+        record_agent_tokens(step["model"], input_text, out)
+        return out, lat
+
+    def run(
+        self,
+        step: Dict[str, Any],
+        input_text: str,
+        preferences: List[str],
+        call_fn=None,
+        hedge_after_ms: Optional[int] = ROUTER_HEDGE_AFTER_MS,
+        max_attempts: int = ROUTER_MAX_ATTEMPTS,
+    ) -> Tuple[str, int, Dict[str, Any]]:
+        call_fn = call_fn or fake_agent_run
+        # The first preference is the model picked in the UI; only the fallbacks are ranked.
+        queue = (preferences[:1] + self.rank(preferences[1:]))[: max(1, max_attempts)]
+        attempts: List[Dict[str, Any]] = []
+        start = time.time()
+
+        def timed_call(model: str) -> Tuple[str, int]:
+            t0 = time.time()
+            try:
+                out, _ = call_fn(dict(step, model=model), input_text)
+            except Exception:
+                self.record(model, int((time.time() - t0) * 1000), ok=False, agent=step.get("id", ""))
+                raise
+            lat = int((time.time() - t0) * 1000)
+            self.record(model, lat, ok=True, agent=step.get("id", ""))
+            record_agent_tokens(model, input_text, out)
+            return out, lat
+
+        pool = ThreadPoolExecutor(max_workers=2)
+        pending: Dict[Any, str] = {}
+
+        def launch():
+            model = queue.pop(0)
+            pending[pool.submit(timed_call, model)] = model
+
+        launch()
+        hedged = False
+        try:
+            while pending:
+                timeout = None
+                if not hedged and queue and hedge_after_ms:
+                    timeout = max(0.0, hedge_after_ms / 1000.0 - (time.time() - start))
+                done, _ = wait(list(pending.keys()), timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    launch()
+                    continue
+                for fut in done:
+                    model = pending.pop(fut)
+                    try:
+                        out, lat = fut.result()
+                    except Exception as e:
+                        attempts.append({"model": model, "ok": False, "error": str(e)})
+                        if queue and len(pending) < 2:
+                            launch()
+                        continue
+                    attempts.append({"model": model, "ok": True, "latency_ms": lat})
+                    total_ms = int((time.time() - start) * 1000)
+                    route = {
+                        "model": model,
+                        "provider": MODEL_PROVIDERS.get(model, "?"),
+                        "hedged": hedged,
+                        "fallbacks": sum(1 for a in attempts if not a["ok"]),
+                        "attempts": attempts,
+                        "latency_ms": total_ms,
+                    }
+                    return out, total_ms, route
+        finally:
+            # Losing hedges finish in the background and still feed the stats.
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise RuntimeError("All routes failed: " + "; ".join(f"{a['model']}: {a.get('error')}" for a in attempts))
+
+
+@st.cache_resource
+def get_model_router() -> ModelRouter:
+    return ModelRouter()
+
+
+def route_preferences(step: Dict[str, Any]) -> List[str]:
+    prefs = AGENT_ROUTE_PREFERENCES.get(step.get("id"), DEFAULT_ROUTE_PREFERENCES)
+    first = step.get("model")
+    return ([first] if first else []) + [m for m in prefs if m != first]
+
+
+# ----------------------------
+# Batch / offline agent runs
+# ----------------------------
+BATCH_DEFAULT_AGENTS = ["summary_entities_agent", "guidance_to_checklist_converter"]
+BATCH_WORKERS = 4
+BATCH_JOB_TTL_S = 6 * 3600  # finished jobs (and their results) are dropped after this
+BATCH_MAX_JOBS = 200
+BATCH_PLACEHOLDER_RE = re.compile(r"\{([a-z_]+)\}")
+BATCH_SOURCES = ["submission", "fixed"]
+
+
+@st.cache_data(show_spinner=False)
+def load_agents_catalog(path: str = "agents.yaml") -> Dict[str, Dict[str, Any]]:
+    try:
+        data = yaml.safe_load(Path(path).read_text(encoding="utf-8")) or {}
+    except Exception:
+        return {}
+    agents = data.get("agents") if isinstance(data, dict) else None
+    return agents if isinstance(agents, dict) else {}
+
+
+def template_placeholders(template: str) -> List[str]:
+    return list(dict.fromkeys(BATCH_PLACEHOLDER_RE.findall(template or "{text}")))
+
+
+def default_placeholder_source(name: str) -> str:
+    # Document-shaped slots ({text}, {pdf_text}, {markdown_text}, ...) take the submission.
+    return "submission" if name == "text" or name.endswith("_text") else "fixed"
+
+
+def render_agent_prompt(template: str, inputs: Dict[str, str]) -> str:
+    # Unbound placeholders render empty rather than sending a literal "{name}" to the model.
+    return BATCH_PLACEHOLDER_RE.sub(lambda m: inputs.get(m.group(1), ""), template or "{text}")
+
+
+def placeholder_inputs(template: str, sub_text: str, bindings: Dict[str, Optional[str]]) -> Dict[str, str]:
+    """bindings maps placeholder -> fixed value, or None for "the submission document"."""
+    inputs = {}
+    for name in template_placeholders(template):
+        if name in bindings:
+            value = bindings[name]
+        else:
+            value = None if default_placeholder_source(name) == "submission" else ""
+        inputs[name] = sub_text if value is None else value
+    return inputs
+
+
+def build_batch_requests(
+    agent_ids: List[str],
+    submissions: List[Tuple[str, str]],
+    catalog: Dict[str, Dict[str, Any]],
+    bindings: Optional[Dict[str, Optional[str]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    One request per (submission, agent), shaped like an OpenAI Batch API JSONL line.
+    custom_id is "<submission>::<agent_id>" so results can be mapped back.
+    """
+    requests = []
+    for sub_name, sub_text in submissions:
+        for agent_id in agent_ids:
+            agent = catalog.get(agent_id) or {}
+            template = agent.get("user_prompt_template") or ""
+            inputs = placeholder_inputs(template, sub_text, bindings or {})
+            requests.append(
+                {
+                    "custom_id": f"{sub_name}::{agent_id}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": agent.get("model") or "gpt-4o-mini",
+                        "max_tokens": int(agent.get("max_tokens") or 12000),
+                        "temperature": float(agent.get("temperature") or 0.2),
+                        "messages": [
+                            {"role": "system", "content": agent.get("system_prompt") or ""},
+                            {"role": "user", "content": render_agent_prompt(template, inputs)},
+                        ],
+                    },
+                }
+            )
+    return requests
+
+
+def batch_requests_to_jsonl(requests: List[Dict[str, Any]]) -> str:
+    return "\n".join(json.dumps(r, ensure_ascii=False) for r in requests) + "\n"
+
+
+def group_batch_requests_by_provider(requests: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for r in requests:
+        provider = MODEL_PROVIDERS.get(r["body"]["model"], "OpenAI")
+        groups.setdefault(provider, []).append(r)
+    return groups
+
+
+class LocalBatchSimulator:
+    """
+    Stand-in for provider batch endpoints: accepts a JSONL-shaped job, works through it
+    in the background and exposes the same submit/status/results lifecycle.
+    """
+
+    def __init__(self, workers: int = BATCH_WORKERS, call_fn=None):
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._call_fn = call_fn or fake_agent_run
+
+    def submit(self, provider: str, requests: List[Dict[str, Any]]) -> str:
+        job_id = f"batch_{provider.lower()}_{hash_text(batch_requests_to_jsonl(requests) + str(time.time()))}"
+        job = {"id": job_id, "provider": provider, "status": "in_progress", "total": len(requests),
+               "completed": 0, "failed": 0, "results": [], "created_at": time.time(), "finished_at": None,
+               "collected": False}
+        with self._lock:
+            self._prune(time.time())
+            self._jobs[job_id] = job
+        for r in requests:
+            self._pool.submit(self._run_one, job_id, r)
+        return job_id
+
+    def _prune(self, now: float):
+        # Caller holds the lock. Only jobs whose results were written back (collected) are
+        # dropped: after BATCH_JOB_TTL_S, or oldest first once over BATCH_MAX_JOBS. Running
+        # and uncollected jobs stay, even past the cap, so no result is lost before write-back.
+        collected = [jid for jid, j in self._jobs.items() if j["collected"]]
+        expired = {jid for jid in collected if now - self._jobs[jid]["finished_at"] > BATCH_JOB_TTL_S}
+        overflow = len(self._jobs) - len(expired) - BATCH_MAX_JOBS + 1
+        if overflow > 0:
+            expired.update([jid for jid in collected if jid not in expired][:overflow])
+        for jid in expired:
+            del self._jobs[jid]
+
+    def mark_collected(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["finished_at"] is not None:
+                job["collected"] = True
+
+    def _run_one(self, job_id: str, request: Dict[str, Any]):
+        body = request["body"]
+        agent_id = request["custom_id"].split("::", 1)[-1]
+        step = {"id": agent_id, "model": body["model"], "max_tokens": body["max_tokens"]}
+        user_msg = next((m["content"] for m in body["messages"] if m["role"] == "user"), "")
+        try:
+            out, lat = self._call_fn(step, user_msg)
+            record_agent_tokens(body["model"], user_msg, out)
+            result = {"custom_id": request["custom_id"], "response": {"model": body["model"], "output": out, "latency_ms": lat}, "error": None}
+        except Exception as e:
+            result = {"custom_id": request["custom_id"], "response": None, "error": str(e)}
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job["results"].append(result)
+            job["completed" if result["error"] is None else "failed"] += 1
+            if job["completed"] + job["failed"] >= job["total"]:
+                job["status"] = "completed"
+                job["finished_at"] = time.time()
+
+    def status(self, job_id: str) -> Dict[str, Any]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job:
+                return {"id": job_id, "status": "unknown"}
+            return {k: v for k, v in job.items() if k != "results"}
+
+    def results(self, job_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id) or {}
+            return list(job.get("results") or [])
+
+
+@st.cache_resource
+def get_batch_backend() -> LocalBatchSimulator:
+    return LocalBatchSimulator()
+
+
+def submit_batch_run(
+    agent_ids: List[str], submissions: List[Tuple[str, str]], bindings: Optional[Dict[str, Optional[str]]] = None
+) -> List[Dict[str, Any]]:
+    backend = get_batch_backend()
+    requests = build_batch_requests(agent_ids, submissions, load_agents_catalog(), bindings)
+    jobs = []
+    for provider, group in group_batch_requests_by_provider(requests).items():
+        job_id = backend.submit(provider, group)
+        jobs.append({"id": job_id, "provider": provider, "total": len(group), "written_back": False,
+                     "submitted_at": datetime.utcnow().isoformat() + "Z"})
+    return jobs
+
+
+def write_back_batch_results(job: Dict[str, Any]) -> int:
+    # Completed outputs land in the history store as individual markdown artifacts.
+    written = 0
+    for res in get_batch_backend().results(job["id"]):
+        sub_name, _, agent_id = res["custom_id"].partition("::")
+        snap = {
+            "ts": datetime.utcnow().isoformat() + "Z",
+            "origin": "batch",
+            "batch_id": job["id"],
+            "agent_id": agent_id,
+            "submission": sub_name,
+        }
+        if res.get("error"):
+            snap["error"] = res["error"]
+        else:
+            out = res["response"]["output"]
+            snap["model"] = res["response"]["model"]
+            snap["artifact_name"] = f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', sub_name)}__{agent_id}.md"
+            snap["artifact_b64"] = base64.b64encode(out.encode("utf-8")).decode("utf-8")
+        st.session_state.history.insert(0, snap)
+        written += 1
+    job["written_back"] = True
+    get_batch_backend().mark_collected(job["id"])
+    return written
+
+
+# ----------------------------
+# pdf_spec step: validate output + targeted repair loop
+# ----------------------------
+PDF_SPEC_MAX_REPAIRS = 2
+REPAIR_CONTEXT_LINES = 12
+
+
+def wrap_yaml_block(obj: Any) -> str:
+    return "```yaml\n" + yaml.safe_dump(obj, allow_unicode=True, sort_keys=False) + "```\n"
+
+
+def check_spec_text(text: str) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    parse_stats: Dict[str, Any] = {}
+    spec_obj, parse_errors = parse_pdfspec(text, stats=parse_stats)
+    if parse_errors:
+        return None, {"errors": parse_errors, "warnings": [], "normalized": None, "parse": parse_stats}
+    report = validate_pdfspec(
+        spec_obj,
+        unit_fallback=st.session_state.get("pdfspec_unit_fallback", "mm"),
+        page_fallback=st.session_state.get("pdfspec_page_size_fallback", "A4"),
+        label_fit=st.session_state.get("pdf_label_fit"),
+    )
+    report["parse"] = parse_stats
+    return spec_obj, report
+
+
+def spec_error_page_index(spec_obj: Dict[str, Any], errors: List[str]) -> Optional[int]:
+    # Map the first locatable error to a 0-based page index ("Page N ..." or a field id).
+    pages = spec_obj.get("pages") if isinstance(spec_obj, dict) else None
+    if not isinstance(pages, list):
+        return None
+    for err in errors:
+        m = re.match(r"Page (\d+)", err)
+        if m and 0 < int(m.group(1)) <= len(pages):
+            return int(m.group(1)) - 1
+        m = re.search(r"field id '([^']*)'|Field '([^']*)'", err)
+        if m:
+            fid = m.group(1) or m.group(2)
+            for pi, p in enumerate(pages):
+                for el in (p or {}).get("elements") or []:
+                    if isinstance(el, dict) and el.get("id") == fid:
+                        return pi
+    return None
+
+
+def build_spec_repair_request(out_text: str, spec_obj: Optional[Dict[str, Any]], errors: List[str]) -> Tuple[str, Any]:
+    """
+    Returns (repair_prompt, apply_fn). The prompt carries only the error list plus the
+    smallest offending region: a single page, or a window of lines around a YAML error.
+    apply_fn(reply_text) splices the corrected region back into the full spec.
+    """
+    err_list = "\n".join(f"- {e}" for e in errors)
+
+    if spec_obj is not None:
+        pi = spec_error_page_index(spec_obj, errors)
+        if pi is not None:
+            page = spec_obj["pages"][pi]
+            prompt = (
+                f"The PDF build spec failed validation on page {pi + 1}.\n\nErrors:\n{err_list}\n\n"
+                f"Offending page:\n{wrap_yaml_block(page)}\n"
+                "Return ONLY the corrected page object as YAML in a ```yaml block."
+            )
+
+            def apply_page(reply: str) -> str:
+                kind, payload = extract_structured_block(reply)
+                fixed = yaml.safe_load(payload)
+                if not isinstance(fixed, dict):
+                    raise ValueError("Repair reply is not a page object.")
+                repaired = json.loads(json.dumps(spec_obj))
+                repaired["pages"][pi] = fixed
+                return wrap_yaml_block(repaired)
+
+            return prompt, apply_page
+
+    _, payload = extract_structured_block(out_text)
+    lines = payload.splitlines()
+    # PyYAML reports the enclosing block first and the failing token last.
+    err_lines = [int(n) for e in errors for n in re.findall(r"line (\d+)", e)[-1:]]
+    if err_lines and lines:
+        center = min(err_lines[0], len(lines)) - 1
+        lo = max(0, center - REPAIR_CONTEXT_LINES)
+        hi = min(len(lines), center + REPAIR_CONTEXT_LINES + 1)
+        snippet = "\n".join(lines[lo:hi])
+        prompt = (
+            f"The PDF build spec YAML failed to parse.\n\nErrors:\n{err_list}\n\n"
+            f"Offending lines {lo + 1}-{hi} (keep indentation relative to the full file):\n```yaml\n{snippet}\n```\n"
+            "Return ONLY the corrected lines in a ```yaml block."
+        )
+
+        def apply_lines(reply: str) -> str:
+            # Not extract_structured_block: its strip() would drop the first line's indentation.
+            fm = re.search(r"```(?:yaml|yml)?[^\n]*\n(.*?)```", reply, flags=re.DOTALL | re.IGNORECASE)
+            fixed = (fm.group(1) if fm else reply).strip("\n")
+            return "```yaml\n" + "\n".join(lines[:lo] + fixed.splitlines() + lines[hi:]) + "\n```\n"
+
+        return prompt, apply_lines
+
+    # Document-level problems cannot be localized; fall back to a full regeneration.
+    prompt = f"The PDF build spec is invalid.\n\nErrors:\n{err_list}\n\nRegenerate the complete spec as YAML in a ```yaml block."
+    return prompt, lambda reply: reply
+
+
+def repair_pdf_spec_output(step: Dict[str, Any], out_text: str, call_fn, max_repairs: int = PDF_SPEC_MAX_REPAIRS) -> Tuple[str, Dict[str, Any]]:
+    loop: Dict[str, Any] = {"valid": False, "repairs": [], "errors": []}
+    for attempt in range(max_repairs + 1):
+        spec_obj, report = check_spec_text(out_text)
+        errors = report.get("errors") or []
+        loop["errors"] = errors
+        if report.get("normalized") is not None and not errors:
+            loop["valid"] = True
+            break
+        if attempt == max_repairs:
+            break
+        prompt, apply_fn = build_spec_repair_request(out_text, spec_obj, errors)
+        entry = {"errors": len(errors), "prompt_chars": len(prompt), "full_output_chars": len(out_text)}
+        try:
+            reply, _ = call_fn(dict(step, prompt=prompt), prompt)
+            out_text = apply_fn(reply)
+        except Exception as e:
+            entry["error"] = str(e)
+        loop["repairs"].append(entry)
+    return out_text, loop
+
+
 def make_default_pipeline() -> List[Dict[str, Any]]:
     return [
         {
@@ -1520,16 +5192,19 @@ def make_default_pipeline() -> List[Dict[str, Any]]:
             "generated_output": "",
             "final_output": "",
             "status": "not_run",
+            "route": None,
         },
         {
             "id": "pdf_spec",
             "name": {"en": "PDF Build Specification", "zh-TW": "PDF 建置規格"},
             "model": "gemini-2.5-flash",
             "max_tokens": 12000,
+            "max_repairs": PDF_SPEC_MAX_REPAIRS,
             "prompt": "Generate a PDF build spec (YAML). Ensure Unicode-safe labels.",
             "generated_output": "",
             "final_output": "",
             "status": "not_run",
+            "route": None,
         },
     ]
 
@@ -1551,6 +5226,8 @@ def init_state():
     st.session_state.setdefault("form_content", "")
 
     st.session_state.setdefault("pipeline", make_default_pipeline())
+    st.session_state.setdefault("router_hedge_ms", ROUTER_HEDGE_AFTER_MS)
+    st.session_state.setdefault("batch_jobs", [])
 
     # Create and load defaultpdfspec.md
     ensure_file("defaultpdfspec.md", DEFAULT_PDFSPEC_MD)
@@ -1564,6 +5241,10 @@ def init_state():
     # Engine + download format
     st.session_state.setdefault("pdf_engine", "fpdf2")  # fpdf2|reportlab
     st.session_state.setdefault("download_format", "pdf")  # pdf|py|js
+    st.session_state.setdefault("pdf_use_compiled", True)
+    st.session_state.setdefault("pdf_flatten", False)
+    st.session_state.setdefault("pdf_appearances", True)
+    st.session_state.setdefault("pdf_label_fit", "none")
 
     # Artifacts
     st.session_state.setdefault("pdf_bytes", None)
@@ -1574,6 +5255,26 @@ def init_state():
     st.session_state.setdefault("last_spec_norm", None)
     st.session_state.setdefault("artifact_py", "")
     st.session_state.setdefault("artifact_js", "")
+    st.session_state.setdefault("pdf_bulk_result", None)
+    st.session_state.setdefault("fill_last_result", None)
+    st.session_state.setdefault("recon_bulk_result", None)
+    st.session_state.setdefault("extract_last_result", None)
+    st.session_state.setdefault("layout_last_report", None)
+    st.session_state.setdefault("bench_report", None)
+    st.session_state.setdefault("bench_baseline", None)
+    st.session_state.setdefault("sweep_params", {"seed": 0, "base": json.loads(json.dumps(SYNTH_DEFAULTS))})
+    st.session_state.setdefault("sweep_rows", None)
+    st.session_state.setdefault("trace_history", [])
+    st.session_state.setdefault("pdf_profile", False)
+    st.session_state.setdefault("pdf_profiles", {})
+    st.session_state.setdefault("pdf_profile_key", None)
+    st.session_state.setdefault("pdf_optimize", "off")
+    st.session_state.setdefault("pdf_linearize", False)
+    st.session_state.setdefault("ttfp_result", None)
+    st.session_state.setdefault("mem_lru", {})
+    st.session_state.setdefault("mem_sizes", {})
+    st.session_state.setdefault("mem_reloaded", set())
+    st.session_state.setdefault("mem_report", None)
 
     # Fonts status
     st.session_state.setdefault("unicode_fonts_status", None)
@@ -1620,28 +5321,373 @@ def status_label(status: str) -> str:
     return mapping.get(status, status)
 
 
-def current_style() -> PainterStyle:
-    return STYLE_BY_KEY.get(st.session_state.style_key, PAINTER_STYLES[0])
+def current_style() -> PainterStyle:
+    return STYLE_BY_KEY.get(st.session_state.style_key, PAINTER_STYLES[0])
+
+
+def palette() -> Dict[str, str]:
+    s = current_style()
+    return s.palette_dark if st.session_state.theme == "dark" else s.palette_light
+
+
+def style_display_name(style: PainterStyle) -> str:
+    return style.name_zh if st.session_state.lang == "zh-TW" else style.name_en
+
+
+init_state()
+
+
+# ----------------------------
+# Shared artifact store: process-wide, content-addressed, refcounted
+# ----------------------------
+class ArtifactRef:
+    """What a session holds instead of an artifact; the store drops the data with the last ref."""
+
+    __slots__ = ("digest", "size", "kind", "__weakref__")
+
+    def __init__(self, digest: str, size: int, kind: str):
+        self.digest = digest
+        self.size = size
+        self.kind = kind
+
+    def __repr__(self) -> str:
+        return f"ArtifactRef({self.kind}, {self.digest[:12]}, {self.size} bytes)"
+
+
+class SharedArtifactStore:
+    """
+    One copy of each distinct PDF/PY/JS artifact for the whole process. Refcounts follow the
+    ArtifactRef objects held in session state (weakref.finalize), so an artifact is freed, on
+    the store's next call, once every session that referenced it has replaced it or gone away.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        # Finalizers only queue here: they can fire from GC in the middle of intern() on the
+        # same thread, so they must not touch _entries themselves.
+        self._released: deque = deque()
+        self.deduped = 0
+
+    def intern(self, data: Union[bytes, str], kind: str) -> ArtifactRef:
+        # Deduplicated by content only: a render's bytes also depend on process state (fonts
+        # present, optimize/linearize backends), so equal inputs are not proof of equal output.
+        raw = data.encode("utf-8") if isinstance(data, str) else data
+        digest = hashlib.sha256(raw).hexdigest()
+        with self._lock:
+            self._apply_releases()
+            entry = self._entries.get(digest)
+            if entry is None:
+                entry = self._entries[digest] = {"data": data, "kind": kind, "size": len(raw), "refs": 0}
+            else:
+                self.deduped += 1
+            entry["refs"] += 1
+        ref = ArtifactRef(digest, entry["size"], kind)
+        weakref.finalize(ref, self._released.append, digest)
+        return ref
+
+    def _apply_releases(self):
+        # Caller holds the lock; a finalizer firing meanwhile just queues one more digest.
+        while self._released:
+            digest = self._released.popleft()
+            entry = self._entries.get(digest)
+            if entry is None:
+                continue
+            entry["refs"] -= 1
+            if entry["refs"] <= 0:
+                del self._entries[digest]
+
+    def get(self, ref: ArtifactRef) -> Union[bytes, str]:
+        with self._lock:
+            self._apply_releases()
+            return self._entries[ref.digest]["data"]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._apply_releases()
+            entries = list(self._entries.values())
+            deduped = self.deduped
+        stored = sum(e["size"] for e in entries)
+        logical = sum(e["size"] * e["refs"] for e in entries)
+        return {
+            "artifacts": len(entries),
+            "refs": sum(e["refs"] for e in entries),
+            "bytes": stored,
+            "saved_bytes": logical - stored,
+            "deduped": deduped,
+        }
+
+
+@st.cache_resource
+def get_artifact_store() -> SharedArtifactStore:
+    return SharedArtifactStore()
+
+
+# ----------------------------
+# Session memory: footprint, disk offload, per-session budget
+# ----------------------------
+SESSION_BUDGET_BYTES = int(float(os.environ.get("WOW_SESSION_BUDGET_MB", "32")) * 1024 * 1024)
+OFFLOAD_DIR = Path(os.environ.get("WOW_OFFLOAD_DIR", os.path.join(tempfile.gettempdir(), "wow_offload")))
+OFFLOAD_MIN_BYTES = 64 * 1024  # smaller values are not worth a disk round-trip
+OFFLOAD_TTL_S = 6 * 3600
+OFFLOAD_SWEEP_EVERY_S = 300
+SESSION_STALE_S = 3600
+# Large, rarely read values; readers go through session_get() so they can be rehydrated.
+# PDF bytes and the PY/JS exports are ArtifactRefs into the shared store and are not listed.
+OFFLOADABLE_KEYS = ["last_spec_norm", "pdfspec_last_validation"]
+MEMORY_STATE_KEYS = {"mem_lru", "mem_sizes", "mem_report", "mem_reloaded"}
+
+
+@dataclass(frozen=True)
+class OffloadRef:
+    digest: str
+    size: int
+
+
+def private_dir(root: Path, prefix: str) -> Path:
+    """
+    root, created 0o700, if it is a real directory owned by this user; otherwise a fresh
+    mkdtemp directory. A shared or pre-planted directory could feed us blobs to unpickle.
+    """
+    try:
+        root.mkdir(mode=0o700, parents=True, exist_ok=True)
+        info = os.lstat(root)
+        if stat.S_ISDIR(info.st_mode) and (not hasattr(os, "getuid") or info.st_uid == os.getuid()):
+            if info.st_mode & 0o077:
+                os.chmod(root, 0o700)
+            return root
+    except OSError:
+        pass
+    return Path(tempfile.mkdtemp(prefix=prefix))
+
+
+class DiskBlobStore:
+    """
+    Content-addressed blobs on local disk, shared by every session of the process. Blobs are
+    unpickled on the way back, so reads and overwrites check the content against its digest.
+    """
+
+    def __init__(self, root: Path = OFFLOAD_DIR):
+        self.root = private_dir(root, "wow_offload_")
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def _path(self, digest: str) -> Path:
+        if not re.fullmatch(r"[0-9a-f]{64}", digest):
+            raise ValueError(f"not a blob digest: {digest!r}")
+        return self.root / digest
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        try:
+            intact = hashlib.sha256(path.read_bytes()).hexdigest() == digest
+        except FileNotFoundError:
+            intact = False
+        if intact:
+            os.utime(path)
+        else:
+            tmp = self.root / f"{digest}.{secrets.token_hex(4)}.tmp"
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        self.sweep()
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        path = self._path(digest)
+        data = path.read_bytes()
+        if hashlib.sha256(data).hexdigest() != digest:
+            path.unlink(missing_ok=True)
+            raise FileNotFoundError(f"offload blob {digest[:12]} failed its checksum and was dropped")
+        os.utime(path)
+        return data
+
+    def sweep(self, max_age_s: float = OFFLOAD_TTL_S):
+        # Blobs may be shared between sessions, so they expire on idle time, not on overwrite.
+        now = time.time()
+        with self._lock:
+            if now - self._last_sweep < OFFLOAD_SWEEP_EVERY_S:
+                return
+            self._last_sweep = now
+        for path in self.root.iterdir():
+            try:
+                if now - path.stat().st_mtime > max_age_s:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        files = total = 0
+        for path in self.root.iterdir():
+            try:
+                total += path.stat().st_size
+                files += 1
+            except OSError:
+                pass
+        return {"files": files, "bytes": total}
+
+
+class SessionRegistry:
+    """Latest memory report per live session, for process-wide totals on the dashboard."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reports: Dict[str, Dict[str, Any]] = {}
+
+    def update(self, sid: str, report: Dict[str, Any]):
+        with self._lock:
+            self._reports[sid] = report
+
+    def totals(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            for sid in [k for k, r in self._reports.items() if now - r["updated"] > SESSION_STALE_S]:
+                del self._reports[sid]
+            reports = list(self._reports.values())
+        return {
+            "sessions": len(reports),
+            "ram_bytes": sum(r["ram_bytes"] for r in reports),
+            "offloaded_bytes": sum(r["offloaded_bytes"] for r in reports),
+            "over_budget": sum(1 for r in reports if r["ram_bytes"] > r["budget"]),
+        }
+
+
+@st.cache_resource
+def get_offload_store() -> DiskBlobStore:
+    return DiskBlobStore()
+
+
+@st.cache_resource
+def get_session_registry() -> SessionRegistry:
+    return SessionRegistry()
+
+
+def session_id() -> str:
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "local"
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(v, seen) for v in obj)
+    return size
+
+
+def session_get(key: str) -> Any:
+    value = st.session_state.get(key)
+    if isinstance(value, ArtifactRef):
+        st.session_state.mem_lru[key] = time.monotonic()
+        return get_artifact_store().get(value)
+    if isinstance(value, OffloadRef):
+        try:
+            value = pickle.loads(get_offload_store().get(value.digest))
+        except FileNotFoundError:  # expired from the store; the session just lost that artifact
+            value = None
+        st.session_state[key] = value
+        st.session_state.mem_reloaded.add(key)
+    st.session_state.mem_lru[key] = time.monotonic()
+    return value
+
+
+def history_artifact(entry: Dict[str, Any]) -> Optional[bytes]:
+    if "artifact_ref" in entry:
+        return get_offload_store().get(entry["artifact_ref"])
+    if "artifact_b64" in entry:
+        return base64.b64decode(entry["artifact_b64"])
+    return None
 
 
-def palette() -> Dict[str, str]:
-    s = current_style()
-    return s.palette_dark if st.session_state.theme == "dark" else s.palette_light
+def enforce_session_budget(budget: int = SESSION_BUDGET_BYTES) -> Dict[str, Any]:
+    """
+    Measures this session's state, moves large history artifacts to the disk store and, while
+    over budget, offloads the least recently used OFFLOADABLE_KEYS. Keys rehydrated during this
+    run stay in RAM until the next one, so a value that is read every run is not written back
+    to disk and reloaded on each rerun. Runs once at the end of every full script run.
+    """
+    ss = st.session_state
+    store = get_offload_store()
+    for entry in ss.history:
+        if len(entry.get("artifact_b64") or "") >= OFFLOAD_MIN_BYTES:
+            raw = base64.b64decode(entry.pop("artifact_b64"))
+            entry["artifact_ref"] = store.put(raw)
+            entry["artifact_bytes"] = len(raw)
+
+    now = time.monotonic()
+    sizes, lru = ss.mem_sizes, ss.mem_lru
+    per_key: Dict[str, int] = {}
+    offloaded = 0
+    for key in list(ss.keys()):
+        if key in MEMORY_STATE_KEYS:
+            continue
+        value = ss[key]
+        if isinstance(value, OffloadRef):
+            offloaded += value.size
+            continue
+        # Re-measure only new objects or containers whose length changed; a new object
+        # means the key was just written, which counts as a use for the LRU.
+        sig = (id(value), len(value) if isinstance(value, (dict, list)) else None)
+        cached = sizes.get(key)
+        if cached is None or cached[0] != sig:
+            if cached is None or cached[0][0] != sig[0]:
+                lru[key] = now
+            cached = sizes[key] = (sig, deep_sizeof(value))
+        per_key[key] = cached[1]
+
+    ram = sum(per_key.values())
+    evicted = []
+    if ram > budget:
+        candidates = [k for k in OFFLOADABLE_KEYS if per_key.get(k, 0) >= OFFLOAD_MIN_BYTES and k not in ss.mem_reloaded]
+        for key in sorted(candidates, key=lambda k: lru.get(k, 0.0)):
+            if ram <= budget:
+                break
+            size = per_key.pop(key)
+            ss[key] = OffloadRef(store.put(pickle.dumps(ss[key], protocol=pickle.HIGHEST_PROTOCOL)), size)
+            sizes.pop(key, None)
+            ram -= size
+            offloaded += size
+            evicted.append(key)
+    ss.mem_reloaded.clear()
+
+    report = {
+        "updated": time.time(),
+        "ram_bytes": ram,
+        "offloaded_bytes": offloaded,
+        "budget": budget,
+        "evicted": evicted,
+        "top": sorted(per_key.items(), key=lambda kv: -kv[1])[:8],
+    }
+    ss.mem_report = report
+    get_session_registry().update(session_id(), report)
+    return report
 
 
-def style_display_name(style: PainterStyle) -> str:
-    return style.name_zh if st.session_state.lang == "zh-TW" else style.name_en
+# ----------------------------
+# CSS (WOW UI)
+# ----------------------------
+CSS_MINIFY_RE = re.compile(r"\s*([{};,>])\s*|(:)\s+")
 
 
-init_state()
+def minify_css(css: str) -> str:
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css).strip()
+    return CSS_MINIFY_RE.sub(lambda m: m.group(1) or m.group(2), css).replace(";}", "}")
 
 
-# ----------------------------
-# CSS (WOW UI)
-# ----------------------------
-def css_inject():
-    pal = palette()
-    s = current_style()
+@st.cache_resource(max_entries=len(PAINTER_STYLES) * 2)
+def compiled_css(style_key: str, theme: str) -> str:
+    """
+    Stylesheet for one (painter style, theme) pair, built and minified once per process.
+    cache_resource, not lru_cache: a module-level cache is rebuilt with the module on every rerun.
+    """
+    s = STYLE_BY_KEY[style_key]
+    pal = s.palette_dark if theme == "dark" else s.palette_light
     coral = "#FF7F50"
     css = f"""
     <style>
@@ -1718,7 +5764,13 @@ def css_inject():
       a {{ color: var(--wow-accent) !important; }}
     </style>
     """
-    st.markdown(css, unsafe_allow_html=True)
+    return minify_css(css)
+
+
+def css_inject():
+    # Streamlit drops elements a rerun does not emit, so the tag is still sent every run;
+    # the cached string keeps that to a dict lookup and a small payload.
+    st.markdown(compiled_css(current_style().key, st.session_state.theme), unsafe_allow_html=True)
 
 
 def wow_header(title: str, subtitle: Optional[str] = None):
@@ -1791,12 +5843,13 @@ def sidebar_ui() -> str:
 
         page = st.radio(
             "Navigation",
-            options=["dashboard", "form", "pipeline", "spec", "notes", "settings", "history"],
+            options=["dashboard", "form", "pipeline", "spec", "bench", "notes", "settings", "history"],
             format_func=lambda x: {
                 "dashboard": t("nav_dashboard"),
                 "form": t("nav_form"),
                 "pipeline": t("nav_pipeline"),
                 "spec": t("nav_spec"),
+                "bench": t("nav_bench"),
                 "notes": t("nav_notes"),
                 "settings": t("nav_settings"),
                 "history": t("nav_history"),
@@ -1877,7 +5930,7 @@ def page_dashboard():
 
     st.write("")
     st.markdown(f"#### {t('dash_field_stats')}")
-    rep = st.session_state.pdfspec_last_validation
+    rep = session_get("pdfspec_last_validation")
     stats = rep.get("field_stats") if isinstance(rep, dict) else None
     if stats:
         by = stats.get("by_type", {})
@@ -1908,6 +5961,93 @@ def page_dashboard():
             unsafe_allow_html=True,
         )
 
+    st.write("")
+    st.markdown(f"#### {t('dash_memory')}")
+    mem = st.session_state.mem_report
+    totals = get_session_registry().totals()
+
+    def mb(n: int) -> str:
+        return f"{n / (1024 * 1024):.1f} MB"
+
+    m = st.columns(4)
+    with m[0]:
+        st.metric(t("dash_memory_session"), mb(mem["ram_bytes"]) if mem else "—", help=f"{t('dash_memory_budget')}: {mb(SESSION_BUDGET_BYTES)}")
+    with m[1]:
+        st.metric(t("dash_memory_offloaded"), mb(mem["offloaded_bytes"]) if mem else "—")
+    with m[2]:
+        st.metric(t("dash_memory_sessions"), f"{totals['sessions']} · {mb(totals['ram_bytes'])}")
+    with m[3]:
+        disk = get_offload_store().stats()
+        st.metric(t("dash_memory_disk"), f"{disk['files']} · {mb(disk['bytes'])}")
+    shared = get_artifact_store().stats()
+    preview_bytes = sum(get_preview_memo(n).stats()["bytes"] for n in ("pdf_data_uri", "pdf_field_count"))
+    st.caption(
+        f"{t('dash_memory_shared')}: {shared['artifacts']} · {mb(shared['bytes'])} · "
+        f"{shared['refs']} refs · {mb(shared['saved_bytes'])} {t('dash_memory_saved')} · "
+        f"{t('dash_memory_preview')}: {mb(preview_bytes)}"
+    )
+    if mem and mem["top"]:
+        with st.expander(t("dash_memory_top"), expanded=False):
+            st.dataframe(
+                pd.DataFrame([{"key": k, "kb": round(v / 1024, 1)} for k, v in mem["top"]]),
+                use_container_width=True,
+                hide_index=True,
+            )
+            if mem["evicted"]:
+                st.caption(f"{t('dash_memory_evicted')}: {', '.join(mem['evicted'])}")
+
+    st.write("")
+    st.markdown(f"#### {t('dash_metrics')}")
+    endpoint = start_metrics_server()
+    if endpoint["running"]:
+        st.caption(f"{t('dash_metrics_endpoint')}: http://{endpoint['host']}:{endpoint['port']}/metrics")
+    else:
+        st.caption(f"{t('dash_metrics_endpoint')}: {endpoint['error']}")
+    snapshot = get_metrics().snapshot()
+    if snapshot:
+        st.dataframe(pd.DataFrame(snapshot), use_container_width=True, hide_index=True)
+    else:
+        st.caption(t("dash_metrics_empty"))
+
+    st.write("")
+    st.markdown(f"#### {t('dash_traces')}")
+    traces = st.session_state.trace_history
+    if not traces:
+        st.caption(t("dash_no_traces"))
+        return
+    labels = []
+    for tr in traces:
+        spans = tr["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        root = spans[0] if spans else {"name": "?", "startTimeUnixNano": "0", "endTimeUnixNano": "0"}
+        ms = (int(root["endTimeUnixNano"]) - int(root["startTimeUnixNano"])) / 1e6
+        ts = datetime.utcfromtimestamp(int(root["startTimeUnixNano"]) / 1e9).strftime("%H:%M:%S")
+        labels.append(f"{ts} · {root['name']} · {ms:.1f} ms · {len(spans)} spans")
+    pick = st.selectbox(t("dash_trace_pick"), options=list(range(len(traces))), format_func=lambda i: labels[i])
+    rows = otlp_waterfall_rows(traces[pick])
+    df = pd.DataFrame(rows)
+    chart = (
+        alt.Chart(df)
+        .mark_bar()
+        .encode(
+            x=alt.X("start_ms:Q", title="ms"),
+            x2="end_ms:Q",
+            y=alt.Y("span:N", sort=alt.SortField("order"), title=None),
+            color=alt.Color("status:N", scale=alt.Scale(domain=["ok", "error"], range=["#4c78a8", "#e45756"]), legend=None),
+            tooltip=["span", "duration_ms", "attributes"],
+        )
+        .properties(height=max(120, 22 * len(rows)))
+    )
+    st.altair_chart(chart, use_container_width=True)
+    with st.expander(t("dash_trace_spans"), expanded=False):
+        st.dataframe(df.drop(columns=["order"]), use_container_width=True, hide_index=True)
+    st.download_button(
+        t("dash_trace_download"),
+        data=json.dumps(traces[pick], ensure_ascii=False, indent=2).encode("utf-8"),
+        file_name=f"trace_{traces[pick]['resourceSpans'][0]['scopeSpans'][0]['spans'][0]['traceId']}.json",
+        mime="application/json",
+    )
+    st.caption(f"{t('dash_trace_file')}: {TRACE_FILE}")
+
 
 def page_form():
     wow_header(t("nav_form"), t("form_input"))
@@ -1955,27 +6095,128 @@ def page_form():
     with st.expander(t("form_preview"), expanded=True):
         st.text_area("", value=st.session_state.form_content, height=260, label_visibility="collapsed")
 
-    if st.button(t("form_next"), use_container_width=True):
-        set_status("awaiting")
-        st.rerun()
+    fb = st.columns(2)
+    with fb[0]:
+        if st.button(t("form_auto_layout"), use_container_width=True, disabled=not st.session_state.form_content.strip()):
+            spec, report = layout_form_markdown(
+                st.session_state.form_content, page_size=st.session_state.pdfspec_page_size_fallback
+            )
+            st.session_state.pdfspec_text = layout_spec_markdown(spec)
+            st.session_state.layout_last_report = report
+            set_status("done", int(report["elapsed_ms"]))
+            st.rerun()
+    with fb[1]:
+        if st.button(t("form_next"), use_container_width=True):
+            set_status("awaiting")
+            st.rerun()
+    layout_report_caption()
+
+
+def layout_report_caption():
+    rep = st.session_state.layout_last_report
+    if not rep:
+        return
+    st.caption(f"{t('layout_done')}: {rep['fields']} fields · {rep['pages']} page(s) · {rep['elapsed_ms']} ms")
+    if rep["ambiguous"]:
+        st.warning(t("layout_ambiguous") + "\n" + "\n".join(f"- {a}" for a in rep["ambiguous"][:10]))
+
+
+def batch_panel():
+    with st.expander(t("batch_title"), expanded=False):
+        catalog = load_agents_catalog()
+        agent_ids = st.multiselect(
+            t("batch_agents"),
+            options=sorted(catalog.keys()),
+            default=[a for a in BATCH_DEFAULT_AGENTS if a in catalog],
+        )
+        uploads = st.file_uploader(t("batch_upload"), type=["txt", "md"], accept_multiple_files=True, key="batch_uploads")
+        include_form = st.checkbox(t("batch_include_form"), value=not uploads)
+        submissions: List[Tuple[str, str]] = []
+        if include_form and st.session_state.form_content.strip():
+            submissions.append(("form_content", st.session_state.form_content))
+        for up in uploads or []:
+            submissions.append((up.name, up.getvalue().decode("utf-8", errors="replace")))
+        st.caption(f"{len(submissions)} × {len(agent_ids)} = {len(submissions) * len(agent_ids)} requests")
+
+        placeholders = list(dict.fromkeys(
+            name for a in agent_ids for name in template_placeholders((catalog.get(a) or {}).get("user_prompt_template") or "")
+        ))
+        bindings: Dict[str, Optional[str]] = {}
+        if placeholders:
+            edited = st.data_editor(
+                pd.DataFrame(
+                    [{"placeholder": p, "source": default_placeholder_source(p), "value": ""} for p in placeholders]
+                ),
+                column_config={
+                    "placeholder": st.column_config.TextColumn(disabled=True),
+                    "source": st.column_config.SelectboxColumn(options=BATCH_SOURCES, required=True),
+                },
+                hide_index=True,
+                use_container_width=True,
+                key=f"batch_bindings_{hash_text('|'.join(placeholders))}",
+            )
+            st.caption(t("batch_placeholders_help"))
+            for row in edited.to_dict("records"):
+                bindings[row["placeholder"]] = None if row["source"] == "submission" else str(row.get("value") or "")
+
+        b = st.columns(3)
+        with b[0]:
+            if st.button(t("batch_submit"), use_container_width=True, disabled=not (submissions and agent_ids)):
+                st.session_state.batch_jobs = submit_batch_run(agent_ids, submissions, bindings) + st.session_state.batch_jobs
+                st.rerun()
+        with b[1]:
+            if st.button(t("batch_refresh"), use_container_width=True):
+                st.rerun()
+        with b[2]:
+            if submissions and agent_ids:
+                st.download_button(
+                    t("batch_download_jsonl"),
+                    data=batch_requests_to_jsonl(build_batch_requests(agent_ids, submissions, catalog, bindings)).encode("utf-8"),
+                    file_name="batch_requests.jsonl",
+                    mime="application/jsonl",
+                    use_container_width=True,
+                )
+
+        if st.session_state.batch_jobs:
+            st.markdown(f"**{t('batch_jobs')}**")
+            backend = get_batch_backend()
+            rows = []
+            for job in st.session_state.batch_jobs:
+                stat = backend.status(job["id"])
+                if stat.get("status") == "completed" and not job["written_back"]:
+                    write_back_batch_results(job)
+                elapsed = (stat.get("finished_at") or time.time()) - stat.get("created_at", time.time())
+                rows.append({
+                    "job": job["id"],
+                    "provider": job["provider"],
+                    "status": stat.get("status"),
+                    "done": f"{stat.get('completed', 0)}/{job['total']}",
+                    "failed": stat.get("failed", 0),
+                    "elapsed_s": round(elapsed, 1),
+                    "written_back": job["written_back"],
+                })
+            st.dataframe(rows, use_container_width=True, hide_index=True)
 
 
 def page_pipeline():
     wow_header(t("nav_pipeline"), t("pipeline_title"))
     if not st.session_state.form_content.strip():
         st.warning("No form content loaded yet. Go to ‘Form → Dynamic PDF’ first.")
+        batch_panel()
         return
 
-    MODELS = [
-        "gpt-4o-mini",
-        "gpt-4.1-mini",
-        "gemini-2.5-flash",
-        "gemini-2.5-flash-lite",
-        "gemini-3-flash-preview",
-        "anthropic (configured)",
-        "grok-4-fast-reasoning",
-        "grok-3-mini",
-    ]
+    MODELS = list(MODEL_PROVIDERS.keys())
+    router = get_model_router()
+
+    st.session_state.router_hedge_ms = st.number_input(
+        t("pipeline_hedge_ms"), min_value=0, max_value=60000, value=int(st.session_state.router_hedge_ms), step=250
+    )
+    with st.expander(t("pipeline_route_health"), expanded=False):
+        health = router.all_stats()
+        if health:
+            st.dataframe(health, use_container_width=True, hide_index=True)
+        else:
+            st.caption("—")
 
     for idx, step in enumerate(st.session_state.pipeline):
         step_name = step["name"]["zh-TW"] if st.session_state.lang == "zh-TW" else step["name"]["en"]
@@ -1985,12 +6226,72 @@ def page_pipeline():
                 step["model"] = st.selectbox(t("pipeline_model"), options=MODELS, key=f"model_{step['id']}")
                 step["max_tokens"] = st.number_input(t("pipeline_max_tokens"), min_value=256, max_value=200000, value=int(step.get("max_tokens", 12000)), step=256, key=f"max_{step['id']}")
                 step["prompt"] = st.text_area(t("pipeline_prompt"), value=step.get("prompt", ""), height=120, key=f"prompt_{step['id']}")
+                st.checkbox(t("pipeline_autoroute"), value=True, key=f"autoroute_{step['id']}")
+                route = step.get("route")
+                if route:
+                    st.caption(
+                        f"{t('pipeline_served_by')}: {route['model']} ({route['provider']}) · {route['latency_ms']} ms"
+                        + (" · hedged" if route.get("hedged") else "")
+                        + (f" · fallbacks: {route['fallbacks']}" if route.get("fallbacks") else "")
+                    )
+                if step["id"] == "pdf_spec":
+                    step["max_repairs"] = st.number_input(
+                        t("pipeline_max_repairs"), min_value=0, max_value=5,
+                        value=int(step.get("max_repairs", PDF_SPEC_MAX_REPAIRS)), key=f"repairs_{step['id']}",
+                    )
+                    if st.button(t("pipeline_auto_layout"), key=f"layout_{step['id']}", use_container_width=True):
+                        source = (st.session_state.pipeline[idx - 1]["final_output"] if idx else "") or st.session_state.form_content
+                        spec, report = layout_form_markdown(source, page_size=st.session_state.pdfspec_page_size_fallback)
+                        out = layout_spec_markdown(spec)
+                        errors = check_spec_text(out)[1]["errors"]
+                        step["spec_check"] = {"valid": not errors, "repairs": [], "errors": errors}
+                        step["route"] = None
+                        step["generated_output"] = out
+                        step["final_output"] = out
+                        step["status"] = "done"
+                        st.session_state.layout_last_report = report
+                        set_status("awaiting", int(report["elapsed_ms"]))
+                        st.rerun()
+                    if step.get("status") == "done" and not step.get("route"):
+                        layout_report_caption()
+                    check = step.get("spec_check")
+                    if check:
+                        n = len(check.get("repairs") or [])
+                        if check.get("valid"):
+                            st.success(f"{t('pipeline_spec_valid')} ({n} repair(s))")
+                        else:
+                            st.error(f"{t('pipeline_spec_invalid')} ({n} repair(s))\n" + "\n".join(f"- {e}" for e in check.get("errors") or []))
                 b = st.columns(3)
                 with b[0]:
                     if st.button(t("pipeline_run_step"), key=f"run_{step['id']}", use_container_width=True):
                         set_status("running")
                         input_text = st.session_state.form_content if idx == 0 else (st.session_state.pipeline[idx - 1]["final_output"] or st.session_state.form_content)
-                        out, lat = fake_agent_run(step, input_text)
+                        if st.session_state.get(f"autoroute_{step['id']}", True):
+                            try:
+                                out, lat, route = router.run(
+                                    step, input_text, route_preferences(step),
+                                    hedge_after_ms=int(st.session_state.router_hedge_ms) or None,
+                                )
+                            except RuntimeError as e:
+                                step["route"] = None
+                                step["status"] = "failed"
+                                set_status("failed")
+                                st.error(str(e))
+                                st.stop()
+                        else:
+                            out, lat = router.call(step, input_text)
+                            route = {"model": step["model"], "provider": MODEL_PROVIDERS.get(step["model"], "?"),
+                                     "hedged": False, "fallbacks": 0, "attempts": [], "latency_ms": lat}
+                        step["route"] = route
+                        if step["id"] == "pdf_spec":
+                            def repair_call(s: Dict[str, Any], x: str) -> Tuple[str, int]:
+                                if st.session_state.get(f"autoroute_{s['id']}", True):
+                                    return router.run(s, x, route_preferences(s), hedge_after_ms=int(st.session_state.router_hedge_ms) or None)[:2]
+                                return router.call(s, x)
+
+                            out, step["spec_check"] = repair_pdf_spec_output(
+                                step, out, repair_call, int(step.get("max_repairs", PDF_SPEC_MAX_REPAIRS))
+                            )
                         step["generated_output"] = out
                         step["final_output"] = step["final_output"] or out
                         step["status"] = "done"
@@ -2014,6 +6315,9 @@ def page_pipeline():
                     st.markdown("---")
                     st.markdown(step["final_output"])
 
+    st.write("")
+    batch_panel()
+
 
 def page_notes():
     wow_header(t("nav_notes"), t("notes_title"))
@@ -2060,83 +6364,110 @@ def page_history():
     for i, v in enumerate(st.session_state.history):
         with st.expander(f"Version {i+1} — {v.get('ts','?')} — origin:{v.get('origin','?')}"):
             st.json(v, expanded=False)
-            if "artifact_b64" in v:
+            if "artifact_b64" in v or "artifact_ref" in v:
                 try:
-                    raw = base64.b64decode(v["artifact_b64"])
+                    raw = history_artifact(v)
                     st.download_button("Download stored artifact", data=raw, file_name=v.get("artifact_name", f"artifact_{i+1}"), use_container_width=True)
                 except Exception:
                     st.warning("Could not decode stored artifact.")
 
 
-def page_spec():
-    wow_header(t("spec_title"), t("spec_subtitle"))
+@st.fragment
+def spec_controls_fragment():
+    # Options are only read when Validate/Generate/Bulk run, so toggling them reruns just this block.
+    st.session_state.pdf_engine = st.selectbox(
+        t("engine"),
+        options=["fpdf2", "reportlab"],
+        index=0 if st.session_state.pdf_engine == "fpdf2" else 1,
+        format_func=lambda x: t("engine_fpdf2") if x == "fpdf2" else t("engine_reportlab"),
+    )
 
-    left, right = st.columns([1.1, 1])
+    opts = st.columns([1, 1, 1, 1])
+    with opts[0]:
+        st.session_state.pdfspec_strict_mode = st.checkbox(t("spec_strict"), value=bool(st.session_state.pdfspec_strict_mode))
+    with opts[1]:
+        st.session_state.pdfspec_unit_fallback = st.selectbox(
+            t("spec_units"),
+            options=["mm", "pt"],
+            index=0 if st.session_state.pdfspec_unit_fallback == "mm" else 1,
+            format_func=lambda x: t("spec_unit_mm") if x == "mm" else t("spec_unit_pt"),
+        )
+    with opts[2]:
+        st.session_state.pdfspec_page_size_fallback = st.selectbox(
+            t("spec_page_size"),
+            options=["A4", "LETTER"],
+            index=0 if st.session_state.pdfspec_page_size_fallback.upper() == "A4" else 1,
+            format_func=lambda x: t("spec_a4") if x.upper() == "A4" else t("spec_letter"),
+        )
+    with opts[3]:
+        st.session_state.pdf_label_fit = st.selectbox(
+            t("spec_label_fit"),
+            options=LABEL_FIT_MODES,
+            index=LABEL_FIT_MODES.index(st.session_state.pdf_label_fit),
+            format_func=lambda x: t(f"spec_label_fit_{x}"),
+        )
 
-    # -------- Left: editor + controls
-    with left:
-        st.markdown(f"#### {t('spec_source')}")
-        source = st.radio(
-            "",
-            options=["use_last", "paste_new", "load_default"],
-            horizontal=True,
-            format_func=lambda x: {
-                "use_last": t("spec_use_last"),
-                "paste_new": t("spec_paste_new"),
-                "load_default": t("spec_load_default"),
-            }[x],
-            label_visibility="collapsed",
+    flags = st.columns([1.4, 1, 1, 1])
+    with flags[0]:
+        st.session_state.pdf_use_compiled = st.checkbox(t("spec_compiled"), value=bool(st.session_state.pdf_use_compiled))
+    with flags[1]:
+        st.session_state.pdf_flatten = st.checkbox(t("spec_flatten"), value=bool(st.session_state.pdf_flatten))
+    with flags[2]:
+        st.session_state.pdf_appearances = st.checkbox(
+            t("spec_appearances"), value=bool(st.session_state.pdf_appearances), disabled=bool(st.session_state.pdf_flatten)
+        )
+    with flags[3]:
+        st.session_state.pdf_profile = st.checkbox(t("spec_profile"), value=bool(st.session_state.pdf_profile))
+
+    out_cols = st.columns([3, 1.4])
+    with out_cols[0]:
+        st.session_state.pdf_optimize = st.select_slider(
+            t("spec_optimize"),
+            options=OPTIMIZE_LEVELS,
+            value=st.session_state.pdf_optimize,
+            format_func=lambda x: t(f"spec_optimize_{x}"),
+            help=t("spec_optimize_help") + ("" if PDF_REWRITER else " " + t("spec_optimize_no_rewriter")),
+        )
+    with out_cols[1]:
+        st.session_state.pdf_linearize = st.checkbox(
+            t("spec_linearize"),
+            value=bool(st.session_state.pdf_linearize) and PDF_REWRITER is not None,
+            disabled=PDF_REWRITER is None,
+            help=t("spec_linearize_help") if PDF_REWRITER else t("spec_linearize_off"),
         )
 
-        if source == "use_last" and st.session_state.pdfspec_last_valid_text.strip():
-            st.session_state.pdfspec_text = st.session_state.pdfspec_last_valid_text
-        elif source == "load_default":
-            st.session_state.pdfspec_text = load_file_or_default("defaultpdfspec.md", DEFAULT_PDFSPEC_MD)
 
-        # Engine + download format
-        c = st.columns([1, 1])
-        with c[0]:
-            st.session_state.pdf_engine = st.selectbox(
-                t("engine"),
-                options=["fpdf2", "reportlab"],
-                index=0 if st.session_state.pdf_engine == "fpdf2" else 1,
-                format_func=lambda x: t("engine_fpdf2") if x == "fpdf2" else t("engine_reportlab"),
-            )
-        with c[1]:
-            st.session_state.download_format = st.selectbox(
-                t("download_format"),
-                options=["pdf", "py", "js"],
-                index=["pdf", "py", "js"].index(st.session_state.download_format),
-                format_func=lambda x: {"pdf": t("download_pdf"), "py": t("download_py"), "js": t("download_js")}[x],
-            )
+@st.fragment
+def spec_editor_fragment():
+    st.markdown(f"#### {t('spec_source')}")
+    source = st.radio(
+        "",
+        options=["use_last", "paste_new", "load_default"],
+        horizontal=True,
+        format_func=lambda x: {
+            "use_last": t("spec_use_last"),
+            "paste_new": t("spec_paste_new"),
+            "load_default": t("spec_load_default"),
+        }[x],
+        label_visibility="collapsed",
+    )
 
-        opts = st.columns([1, 1, 1])
-        with opts[0]:
-            st.session_state.pdfspec_strict_mode = st.checkbox(t("spec_strict"), value=bool(st.session_state.pdfspec_strict_mode))
-        with opts[1]:
-            st.session_state.pdfspec_unit_fallback = st.selectbox(
-                t("spec_units"),
-                options=["mm", "pt"],
-                index=0 if st.session_state.pdfspec_unit_fallback == "mm" else 1,
-                format_func=lambda x: t("spec_unit_mm") if x == "mm" else t("spec_unit_pt"),
-            )
-        with opts[2]:
-            st.session_state.pdfspec_page_size_fallback = st.selectbox(
-                t("spec_page_size"),
-                options=["A4", "LETTER"],
-                index=0 if st.session_state.pdfspec_page_size_fallback.upper() == "A4" else 1,
-                format_func=lambda x: t("spec_a4") if x.upper() == "A4" else t("spec_letter"),
-            )
+    if source == "use_last" and st.session_state.pdfspec_last_valid_text.strip():
+        st.session_state.pdfspec_text = st.session_state.pdfspec_last_valid_text
+    elif source == "load_default":
+        st.session_state.pdfspec_text = load_file_or_default("defaultpdfspec.md", DEFAULT_PDFSPEC_MD)
 
-        st.markdown(f"#### {t('spec_editor')}")
-        st.session_state.pdfspec_text = st.text_area("", value=st.session_state.pdfspec_text, height=520, label_visibility="collapsed")
+    st.markdown(f"#### {t('spec_editor')}")
+    st.session_state.pdfspec_text = st.text_area("", value=st.session_state.pdfspec_text, height=520, label_visibility="collapsed")
 
-        btns = st.columns([1, 1, 1])
-        with btns[0]:
-            if st.button(t("spec_validate"), use_container_width=True):
+    btns = st.columns([1, 1, 1])
+    with btns[0]:
+        if st.button(t("spec_validate"), use_container_width=True):
+            with start_trace("ui.validate", chars=len(st.session_state.pdfspec_text)):
                 set_status("running")
                 start = time.time()
-                spec_obj, parse_errors = parse_pdfspec(st.session_state.pdfspec_text)
+                parse_stats: Dict[str, Any] = {}
+                spec_obj, parse_errors = parse_pdfspec(st.session_state.pdfspec_text, stats=parse_stats)
                 if parse_errors:
                     report = {"errors": parse_errors, "warnings": [], "normalized": None}
                 else:
@@ -2144,7 +6475,9 @@ def page_spec():
                         spec_obj,
                         unit_fallback=st.session_state.pdfspec_unit_fallback,
                         page_fallback=st.session_state.pdfspec_page_size_fallback,
+                        label_fit=st.session_state.pdf_label_fit,
                     )
+                report["parse"] = parse_stats
                 st.session_state.pdfspec_last_validation = report
                 if report.get("normalized") is not None and not report.get("errors"):
                     st.session_state.pdfspec_last_valid_text = st.session_state.pdfspec_text
@@ -2152,14 +6485,16 @@ def page_spec():
                 set_status("awaiting", int((time.time() - start) * 1000))
                 st.rerun()
 
-        with btns[1]:
-            if st.button(t("spec_generate"), use_container_width=True):
+    with btns[1]:
+        if st.button(t("spec_generate"), use_container_width=True):
+            with start_trace("ui.generate", engine=st.session_state.pdf_engine, chars=len(st.session_state.pdfspec_text)):
                 set_status("running")
                 start = time.time()
 
-                spec_obj, parse_errors = parse_pdfspec(st.session_state.pdfspec_text)
+                parse_stats = {}
+                spec_obj, parse_errors = parse_pdfspec(st.session_state.pdfspec_text, stats=parse_stats)
                 if parse_errors:
-                    st.session_state.pdfspec_last_validation = {"errors": parse_errors, "warnings": [], "normalized": None}
+                    st.session_state.pdfspec_last_validation = {"errors": parse_errors, "warnings": [], "normalized": None, "parse": parse_stats}
                     set_status("failed", int((time.time() - start) * 1000))
                     st.rerun()
 
@@ -2167,7 +6502,9 @@ def page_spec():
                     spec_obj,
                     unit_fallback=st.session_state.pdfspec_unit_fallback,
                     page_fallback=st.session_state.pdfspec_page_size_fallback,
+                    label_fit=st.session_state.pdf_label_fit,
                 )
+                report["parse"] = parse_stats
                 st.session_state.pdfspec_last_validation = report
                 errors = report.get("errors") or []
                 warnings = report.get("warnings") or []
@@ -2179,17 +6516,24 @@ def page_spec():
                 st.session_state.last_spec_norm = spec_norm
 
                 engine = st.session_state.pdf_engine
-                if engine == "reportlab":
-                    pdf_bytes, render_log = generate_pdf_reportlab(spec_norm)
+                render_kwargs = dict(
+                    compiled=st.session_state.pdf_use_compiled,
+                    flatten=st.session_state.pdf_flatten,
+                    appearances=st.session_state.pdf_appearances,
+                    optimize=st.session_state.pdf_optimize,
+                    linearize=st.session_state.pdf_linearize,
+                )
+                if st.session_state.pdf_profile:
+                    pdf_bytes2, render_log, profile = profile_render_spec_pdf(spec_norm, engine, **render_kwargs)
+                    store_profile(profile)
+                    st.session_state.pdf_profile_key = profile["key"]
                 else:
-                    pdf_bytes, render_log = generate_pdf_fpdf2(spec_norm)
+                    pdf_bytes2, render_log = render_spec_pdf(spec_norm, engine, **render_kwargs)
+                    st.session_state.pdf_profile_key = None
 
-                # Improve compatibility
-                pdf_bytes2, changed = set_need_appearances(pdf_bytes)
-                if changed:
-                    render_log.append("postprocess: set /NeedAppearances true")
-
-                st.session_state.pdf_bytes = pdf_bytes2
+                # Sessions hold refs into the shared store instead of their own copy.
+                store = get_artifact_store()
+                st.session_state.pdf_bytes = store.intern(pdf_bytes2, "pdf")
                 st.session_state.pdf_render_log = render_log
                 st.session_state.pdf_generated_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
                 st.session_state.pdf_generated_from = f"spec:{engine}"
@@ -2197,168 +6541,680 @@ def page_spec():
                 st.session_state.pdfspec_last_valid_text = st.session_state.pdfspec_text
 
                 # Build export scripts (always available after a successful validation/generation)
-                st.session_state.artifact_py = build_py_script_reportlab(spec_norm) if engine == "reportlab" else build_py_script_fpdf2(spec_norm)
-                st.session_state.artifact_js = build_js_script_jspdf(spec_norm)
+                py_text = build_py_script_reportlab(spec_norm) if engine == "reportlab" else build_py_script_fpdf2(spec_norm)
+                st.session_state.artifact_py = store.intern(py_text, "py")
+                st.session_state.artifact_js = store.intern(build_js_script_jspdf(spec_norm), "js")
 
                 set_status("done", int((time.time() - start) * 1000))
                 st.rerun()
 
-        with btns[2]:
-            if st.button(t("spec_reset_last_valid"), use_container_width=True):
-                if st.session_state.pdfspec_last_valid_text.strip():
-                    st.session_state.pdfspec_text = st.session_state.pdfspec_last_valid_text
-                    st.rerun()
+    with btns[2]:
+        if st.button(t("spec_reset_last_valid"), use_container_width=True):
+            if st.session_state.pdfspec_last_valid_text.strip():
+                st.session_state.pdfspec_text = st.session_state.pdfspec_last_valid_text
+                st.rerun()
 
-        st.write("")
-        st.markdown(f"#### {t('spec_validation')}")
-        rep = st.session_state.pdfspec_last_validation or {"errors": [], "warnings": []}
-        with st.expander(t("spec_validation"), expanded=True):
-            if rep.get("errors"):
-                st.error("\n".join([f"- {e}" for e in rep["errors"]]))
-            else:
-                st.success("No errors.")
-            if rep.get("warnings"):
-                st.warning("\n".join([f"- {w}" for w in rep["warnings"]]))
-            else:
-                st.info("No warnings.")
+    st.write("")
+    st.markdown(f"#### {t('spec_validation')}")
+    rep = session_get("pdfspec_last_validation") or {"errors": [], "warnings": []}
+    with st.expander(t("spec_validation"), expanded=True):
+        if rep.get("errors"):
+            st.error("\n".join([f"- {e}" for e in rep["errors"]]))
+        else:
+            st.success("No errors.")
+        if rep.get("warnings"):
+            st.warning("\n".join([f"- {w}" for w in rep["warnings"]]))
+        else:
+            st.info("No warnings.")
+        ps = rep.get("parse")
+        if ps:
+            st.caption(f"Parsed {ps.get('bytes', 0):,} bytes of {str(ps.get('format', '?')).upper()} via {ps.get('loader') or '—'} in {ps.get('parse_ms', 0)} ms")
+        ts = rep.get("text_stats")
+        if ts:
+            st.caption(
+                f"Measured {ts['labels']} labels in {ts['ms']} ms · {ts['overflow']} overflow · "
+                f"{ts['wrapped']} wrapped · {ts['shrunk']} shrunk"
+            )
 
-    # -------- Right: preview + download + reconcile
-    with right:
-        st.markdown(f"#### {t('spec_preview')}")
-        if st.session_state.pdf_bytes:
-            st.markdown(pdf_iframe_view(st.session_state.pdf_bytes, height=680), unsafe_allow_html=True)
 
-            b64 = base64.b64encode(st.session_state.pdf_bytes).decode("utf-8")
-            st.markdown(
-                f'<a href="data:application/pdf;base64,{b64}" target="_blank">{t("spec_open_new_tab")}</a>',
-                unsafe_allow_html=True,
+@st.fragment
+def spec_bulk_fragment():
+    with st.expander(t("spec_bulk"), expanded=False):
+        bulk_mode = st.radio(
+            t("spec_bulk"),
+            options=["separate", "merge"],
+            horizontal=True,
+            format_func=lambda x: t("spec_bulk_separate") if x == "separate" else t("spec_bulk_merge"),
+            label_visibility="collapsed",
+        )
+        if st.button(t("spec_bulk_generate"), use_container_width=True):
+            set_status("running")
+            result = render_spec_stream(
+                st.session_state.pdfspec_text,
+                engine=st.session_state.pdf_engine,
+                unit_fallback=st.session_state.pdfspec_unit_fallback,
+                page_fallback=st.session_state.pdfspec_page_size_fallback,
+                merge=(bulk_mode == "merge"),
+                compiled=st.session_state.pdf_use_compiled,
+                flatten=st.session_state.pdf_flatten,
+                appearances=st.session_state.pdf_appearances,
+                label_fit=st.session_state.pdf_label_fit,
+                optimize=st.session_state.pdf_optimize,
+                linearize=st.session_state.pdf_linearize,
+            )
+            old_path = (st.session_state.pdf_bulk_result or {}).get("path")
+            if old_path and old_path != result["path"]:
+                Path(old_path).unlink(missing_ok=True)
+            st.session_state.pdf_bulk_result = result
+            set_status("done" if result["ok"] else "failed", result["elapsed_ms"])
+            st.rerun()
+        bulk = st.session_state.pdf_bulk_result
+        if bulk:
+            st.caption(f"{bulk['ok']}/{len(bulk['rows'])} specs rendered in {bulk['elapsed_ms']} ms")
+            for line in bulk.get("log") or []:
+                st.caption(line)
+            st.dataframe(
+                [dict(r, errors="; ".join(r["errors"])) for r in bulk["rows"]],
+                use_container_width=True,
+                hide_index=True,
             )
+            if bulk["ok"] and Path(bulk["path"]).exists():
+                st.download_button(
+                    t("spec_bulk_download"),
+                    data=Path(bulk["path"]).read_bytes(),
+                    file_name=bulk["file_name"],
+                    mime=bulk["mime"],
+                    use_container_width=True,
+                )
+
+
+def spec_preview_panel():
+    # Outside any fragment: it is only rebuilt on full reruns (a new PDF, a language/theme change).
+    pdf_bytes = session_get("pdf_bytes")
+    st.markdown(pdf_iframe_view(pdf_bytes, height=680), unsafe_allow_html=True)
+    st.markdown(
+        f'<a href="{pdf_data_uri(pdf_bytes)}" target="_blank">{t("spec_open_new_tab")}</a>',
+        unsafe_allow_html=True,
+    )
 
-            # Download artifact based on selection
-            fmt = st.session_state.download_format
-            if fmt == "pdf":
+    st.write("")
+    with st.expander(t("spec_render_log"), expanded=False):
+        st.code("\n".join(st.session_state.pdf_render_log or []) or "—", language="text")
+        profile = st.session_state.pdf_profiles.get(st.session_state.pdf_profile_key or "")
+        if profile:
+            st.markdown(f"**{t('spec_profile_title')}** · `{profile['key'][:12]}` · {profile['engine']} · "
+                        f"{profile['elapsed_ms']} ms · {profile['calls']} calls · peak {profile['peak_kb'] or '—'} KiB")
+            st.code(profile["top_functions"], language="text")
+            if profile["allocations"]:
+                st.dataframe(pd.DataFrame(profile["allocations"]), use_container_width=True, hide_index=True)
+            pc = st.columns(2)
+            with pc[0]:
                 st.download_button(
-                    label=t("download_artifact"),
-                    data=st.session_state.pdf_bytes,
-                    file_name="dynamic_form.pdf",
-                    mime="application/pdf",
+                    t("spec_profile_pstats"),
+                    data=profile["pstats"],
+                    file_name=f"render_{profile['key'][:12]}.pstats",
+                    mime="application/octet-stream",
                     use_container_width=True,
                 )
-            elif fmt == "py":
-                py_text = st.session_state.artifact_py or ""
+            with pc[1]:
                 st.download_button(
-                    label=t("download_artifact"),
-                    data=py_text.encode("utf-8"),
-                    file_name="generate_dynamic_form.py",
-                    mime="text/x-python",
+                    t("spec_profile_allocs"),
+                    data=allocation_summary(profile).encode("utf-8"),
+                    file_name=f"render_{profile['key'][:12]}_allocations.txt",
+                    mime="text/plain",
                     use_container_width=True,
                 )
-                with st.expander("PY preview", expanded=False):
-                    st.code(py_text, language="python")
+
+    # Show extracted field count to validate "editable"
+    st.write("")
+    st.caption(f"Detected AcroForm fields in generated PDF: {pdf_field_count(pdf_bytes)}")
+    render_log = st.session_state.pdf_render_log or []
+    optimized = next((line for line in render_log if line.startswith("optimize:")), None)
+    st.caption(optimized or f"{len(pdf_bytes):,} bytes")
+    linearized = next((line for line in render_log if line.startswith("linearize:")), None)
+    if linearized:
+        st.caption(linearized)
+
+
+@st.fragment
+def spec_downloads_fragment():
+    st.write("")
+    st.session_state.download_format = st.selectbox(
+        t("download_format"),
+        options=["pdf", "py", "js"],
+        index=["pdf", "py", "js"].index(st.session_state.download_format),
+        format_func=lambda x: {"pdf": t("download_pdf"), "py": t("download_py"), "js": t("download_js")}[x],
+    )
+
+    # Download artifact based on selection
+    fmt = st.session_state.download_format
+    if fmt == "pdf":
+        st.download_button(
+            label=t("download_artifact"),
+            data=session_get("pdf_bytes"),
+            file_name="dynamic_form.pdf",
+            mime="application/pdf",
+            use_container_width=True,
+        )
+    elif fmt == "py":
+        py_text = session_get("artifact_py") or ""
+        st.download_button(
+            label=t("download_artifact"),
+            data=py_text.encode("utf-8"),
+            file_name="generate_dynamic_form.py",
+            mime="text/x-python",
+            use_container_width=True,
+        )
+        with st.expander("PY preview", expanded=False):
+            st.code(py_text, language="python")
+    else:
+        js_text = session_get("artifact_js") or ""
+        st.download_button(
+            label=t("download_artifact"),
+            data=js_text.encode("utf-8"),
+            file_name="generate_dynamic_form.js",
+            mime="text/javascript",
+            use_container_width=True,
+        )
+        with st.expander("JS preview", expanded=False):
+            st.code(js_text, language="javascript")
+
+    st.write("")
+    if st.button(t("spec_save_version"), use_container_width=True):
+        # Save current chosen artifact into history as bytes (base64)
+        fmt = st.session_state.download_format
+        if fmt == "pdf":
+            artifact = session_get("pdf_bytes")
+            name = "dynamic_form.pdf"
+        elif fmt == "py":
+            artifact = (session_get("artifact_py") or "").encode("utf-8")
+            name = "generate_dynamic_form.py"
+        else:
+            artifact = (session_get("artifact_js") or "").encode("utf-8")
+            name = "generate_dynamic_form.js"
+
+        snap = {
+            "ts": datetime.utcnow().isoformat() + "Z",
+            "origin": "spec",
+            "engine": st.session_state.pdf_engine,
+            "download_format": fmt,
+            "artifact_name": name,
+            "artifact_b64": base64.b64encode(artifact).decode("utf-8"),
+            "pdf_generated_at": st.session_state.pdf_generated_at,
+        }
+        st.session_state.history.insert(0, snap)
+        st.success("Saved.")
+        st.rerun()
+
+
+@st.fragment
+def spec_reconcile_fragment():
+    st.write("")
+    st.markdown(f"#### {t('spec_upload_pdf')}")
+    up = st.file_uploader(t("spec_upload_pdf"), type=["pdf"], key="upload_modified_pdf")
+    if up is not None:
+        uploaded_bytes = up.read()
+        st.success("Uploaded.")
+        if st.button(t("spec_reconcile"), use_container_width=True):
+            spec_norm = session_get("last_spec_norm")
+            if spec_norm:
+                st.session_state.pdf_last_reconcile = reconcile_pdf_vs_spec(spec_norm, uploaded_bytes)
+                st.rerun()
+            else:
+                st.error("No validated spec available to reconcile against.")
+
+    if st.session_state.pdf_last_reconcile:
+        st.write("")
+        st.markdown(f"#### {t('spec_reconcile_report')}")
+        with st.expander(t("spec_reconcile_report"), expanded=True):
+            st.json(st.session_state.pdf_last_reconcile, expanded=False)
+
+
+@st.fragment
+def spec_fill_fragment():
+    st.write("")
+    with st.expander(t("fill_title"), expanded=False):
+        rec_up = st.file_uploader(t("fill_records"), type=["csv", "json", "jsonl"], key="fill_records_upload")
+        fc = st.columns(3)
+        with fc[0]:
+            fill_flatten = st.checkbox(t("fill_flatten"), value=False)
+        with fc[1]:
+            fill_workers = st.number_input(t("fill_workers"), min_value=1, max_value=32, value=FILL_WORKERS)
+        with fc[2]:
+            fill_name_field = st.text_input(t("fill_name_field"), value="")
+        if rec_up is not None and st.button(t("fill_run"), use_container_width=True):
+            set_status("running")
+            try:
+                result = fill_records_to_zip(
+                    session_get("pdf_bytes"),
+                    iter_fill_records(rec_up.getvalue(), rec_up.name),
+                    flatten=fill_flatten,
+                    workers=int(fill_workers),
+                    name_field=fill_name_field.strip() or None,
+                    appearances=bool(st.session_state.pdf_appearances),
+                )
+            except Exception as e:
+                st.error(f"Fill failed: {e}")
+                set_status("failed")
             else:
-                js_text = st.session_state.artifact_js or ""
+                old_path = (st.session_state.fill_last_result or {}).get("path")
+                if old_path:
+                    Path(old_path).unlink(missing_ok=True)
+                st.session_state.fill_last_result = result
+                set_status("done", int(result["elapsed_s"] * 1000))
+                st.rerun()
+        fr = st.session_state.fill_last_result
+        if fr:
+            st.caption(
+                f"{fr['filled']}/{fr['records']} filled · {fr['failed']} failed · "
+                f"{fr['records_per_s']} records/s · {fr['workers']} worker(s) · {fr['elapsed_s']} s"
+            )
+            if fr["errors"]:
+                st.warning("\n".join(f"- {e}" for e in fr["errors"][:10]))
+            if fr["filled"] and Path(fr["path"]).exists():
                 st.download_button(
-                    label=t("download_artifact"),
-                    data=js_text.encode("utf-8"),
-                    file_name="generate_dynamic_form.js",
-                    mime="text/javascript",
+                    t("fill_download"),
+                    data=Path(fr["path"]).read_bytes(),
+                    file_name="filled_forms.zip",
+                    mime="application/zip",
                     use_container_width=True,
                 )
-                with st.expander("JS preview", expanded=False):
-                    st.code(js_text, language="javascript")
 
-            st.write("")
-            with st.expander(t("spec_render_log"), expanded=False):
-                st.code("\n".join(st.session_state.pdf_render_log or []) or "—", language="text")
 
-            # Show extracted field count to validate "editable"
-            st.write("")
-            try:
-                info = extract_pdf_fields(st.session_state.pdf_bytes)
-                st.caption(f"Detected AcroForm fields in generated PDF: {info.get('raw_count', 0)}")
-            except Exception:
-                st.caption("Detected AcroForm fields in generated PDF: (unavailable)")
+def folder_input_help() -> str:
+    return t("recon_bulk_folder_help").format(root=PDF_FOLDER_ROOT) if PDF_FOLDER_ROOT else t("recon_bulk_folder_off")
 
-            st.write("")
-            st.markdown(f"#### {t('spec_upload_pdf')}")
-            up = st.file_uploader(t("spec_upload_pdf"), type=["pdf"], key="upload_modified_pdf")
-            if up is not None:
-                uploaded_bytes = up.read()
-                st.success("Uploaded.")
-                if st.button(t("spec_reconcile"), use_container_width=True):
-                    spec_norm = st.session_state.last_spec_norm
-                    if spec_norm:
-                        st.session_state.pdf_last_reconcile = reconcile_pdf_vs_spec(spec_norm, uploaded_bytes)
-                        st.rerun()
-                    else:
-                        st.error("No validated spec available to reconcile against.")
 
-            if st.session_state.pdf_last_reconcile:
-                st.write("")
-                st.markdown(f"#### {t('spec_reconcile_report')}")
-                with st.expander(t("spec_reconcile_report"), expanded=True):
-                    st.json(st.session_state.pdf_last_reconcile, expanded=False)
+@st.fragment
+def spec_bulk_reconcile_fragment():
+    st.write("")
+    with st.expander(t("recon_bulk_title"), expanded=False):
+        recon_ups = st.file_uploader(
+            t("recon_bulk_files"), type=["pdf", "zip"], accept_multiple_files=True, key="recon_bulk_upload"
+        )
+        rc = st.columns([2, 1])
+        with rc[0]:
+            recon_folder = st.text_input(
+                t("recon_bulk_folder"), value="", disabled=not PDF_FOLDER_ROOT, help=folder_input_help()
+            )
+        with rc[1]:
+            recon_workers = st.number_input(t("fill_workers"), min_value=1, max_value=32, value=FILL_WORKERS, key="recon_workers")
+        if (recon_ups or recon_folder.strip()) and st.button(t("recon_bulk_run"), use_container_width=True):
+            if not session_get("last_spec_norm"):
+                st.error("No validated spec available to reconcile against.")
+            else:
+                set_status("running")
+                try:
+                    result = reconcile_many(
+                        session_get("last_spec_norm"),
+                        iter_pdf_sources([(u.name, u.getvalue()) for u in recon_ups or []], recon_folder),
+                        workers=int(recon_workers),
+                    )
+                except Exception as e:
+                    st.error(f"Bulk reconcile failed: {e}")
+                    set_status("failed")
+                else:
+                    st.session_state.recon_bulk_result = result
+                    set_status("done", int(result["summary"]["elapsed_s"] * 1000))
+                    st.rerun()
+        rb = st.session_state.recon_bulk_result
+        if rb:
+            sm = rb["summary"]
+            st.caption(
+                f"{sm['ok']}/{sm['files']} read · {sm['clean']} clean · {sm['failed']} failed · "
+                f"{sm['workers']} worker(s) · {sm['elapsed_s']} s"
+            )
+            st.dataframe(
+                [
+                    {
+                        "file": r["file"],
+                        "ok": r["ok"],
+                        "missing": len(r.get("missing_in_pdf") or []),
+                        "extra": len(r.get("extra_in_pdf") or []),
+                        "renames": len(r.get("rename_suggestions") or []),
+                        "error": r.get("error", ""),
+                    }
+                    for r in rb["rows"]
+                ],
+                use_container_width=True,
+                hide_index=True,
+            )
+            dc = st.columns(2)
+            with dc[0]:
+                st.download_button(
+                    t("recon_bulk_csv"), data=reconcile_report_csv(rb), file_name="reconcile_report.csv",
+                    mime="text/csv", use_container_width=True,
+                )
+            with dc[1]:
+                st.download_button(
+                    t("recon_bulk_json"), data=json.dumps(rb, ensure_ascii=False, indent=2).encode("utf-8"),
+                    file_name="reconcile_report.json", mime="application/json", use_container_width=True,
+                )
+
 
-            st.write("")
-            if st.button(t("spec_save_version"), use_container_width=True):
-                # Save current chosen artifact into history as bytes (base64)
-                fmt = st.session_state.download_format
-                if fmt == "pdf":
-                    artifact = st.session_state.pdf_bytes
-                    name = "dynamic_form.pdf"
-                elif fmt == "py":
-                    artifact = (st.session_state.artifact_py or "").encode("utf-8")
-                    name = "generate_dynamic_form.py"
+@st.fragment
+def spec_extract_fragment():
+    st.write("")
+    with st.expander(t("extract_title"), expanded=False):
+        ext_ups = st.file_uploader(
+            t("recon_bulk_files"), type=["pdf", "zip"], accept_multiple_files=True, key="extract_upload"
+        )
+        ec = st.columns([2, 1, 1])
+        with ec[0]:
+            ext_folder = st.text_input(
+                t("recon_bulk_folder"), value="", key="extract_folder", disabled=not PDF_FOLDER_ROOT, help=folder_input_help()
+            )
+        with ec[1]:
+            ext_fmt = st.selectbox(t("extract_format"), options=EXTRACT_FORMATS)
+        with ec[2]:
+            ext_workers = st.number_input(t("fill_workers"), min_value=1, max_value=32, value=FILL_WORKERS, key="extract_workers")
+        if (ext_ups or ext_folder.strip()) and st.button(t("extract_run"), use_container_width=True):
+            if not session_get("last_spec_norm"):
+                st.error("No validated spec available to type the extracted values.")
+            else:
+                set_status("running")
+                try:
+                    result = extract_values_to_table(
+                        session_get("last_spec_norm"),
+                        iter_pdf_sources([(u.name, u.getvalue()) for u in ext_ups or []], ext_folder),
+                        fmt=ext_fmt,
+                        workers=int(ext_workers),
+                    )
+                except Exception as e:
+                    st.error(f"Extraction failed: {e}")
+                    set_status("failed")
                 else:
-                    artifact = (st.session_state.artifact_js or "").encode("utf-8")
-                    name = "generate_dynamic_form.js"
-
-                snap = {
-                    "ts": datetime.utcnow().isoformat() + "Z",
-                    "origin": "spec",
-                    "engine": st.session_state.pdf_engine,
-                    "download_format": fmt,
-                    "artifact_name": name,
-                    "artifact_b64": base64.b64encode(artifact).decode("utf-8"),
-                    "pdf_generated_at": st.session_state.pdf_generated_at,
-                }
-                st.session_state.history.insert(0, snap)
-                st.success("Saved.")
-                st.rerun()
+                    old_path = (st.session_state.extract_last_result or {}).get("path")
+                    if old_path:
+                        Path(old_path).unlink(missing_ok=True)
+                    st.session_state.extract_last_result = result
+                    set_status("done", int(result["elapsed_s"] * 1000))
+                    st.rerun()
+        er = st.session_state.extract_last_result
+        if er:
+            st.caption(f"{er['files']} files · {er['failed']} failed · {er['workers']} worker(s) · {er['elapsed_s']} s")
+            if er["note"]:
+                st.warning(er["note"])
+            st.dataframe(er["preview"], use_container_width=True, hide_index=True)
+            if Path(er["path"]).exists():
+                st.download_button(
+                    t("extract_download"), data=Path(er["path"]).read_bytes(), file_name=er["file_name"],
+                    mime=er["mime"], use_container_width=True,
+                )
+
+
+def page_spec():
+    wow_header(t("spec_title"), t("spec_subtitle"))
+
+    left, right = st.columns([1.1, 1])
+
+    # -------- Left: controls + editor
+    with left:
+        spec_controls_fragment()
+        spec_editor_fragment()
+        spec_bulk_fragment()
+
+    # -------- Right: preview + download + reconcile
+    with right:
+        st.markdown(f"#### {t('spec_preview')}")
+        if st.session_state.pdf_bytes:
+            spec_preview_panel()
+            spec_downloads_fragment()
+            spec_reconcile_fragment()
+            spec_fill_fragment()
+            spec_bulk_reconcile_fragment()
+            spec_extract_fragment()
         else:
             st.info(t("spec_no_pdf"))
 
 
+def bench_corpus_from_text(text: str) -> List[Tuple[str, Dict[str, Any]]]:
+    corpus = []
+    for i, (label, obj, errors) in enumerate(iter_pdfspecs(text), start=1):
+        if errors or obj is None:
+            continue
+        report = validate_pdfspec(
+            obj,
+            unit_fallback=st.session_state.pdfspec_unit_fallback,
+            page_fallback=st.session_state.pdfspec_page_size_fallback,
+        )
+        if report.get("normalized") is not None and not report.get("errors"):
+            corpus.append((f"editor_{i}_{label}", report["normalized"]))
+    return corpus
+
+
+def synthetic_sweep_panel():
+    with st.expander(t("sweep_title"), expanded=False):
+        params = st.session_state.sweep_params
+        base = params["base"]
+        c = st.columns(5)
+        with c[0]:
+            params["seed"] = st.number_input(t("sweep_seed"), min_value=0, value=int(params["seed"]))
+        with c[1]:
+            base["pages"] = st.number_input(t("sweep_pages"), min_value=1, max_value=200, value=int(base["pages"]))
+        with c[2]:
+            base["elements_per_page"] = st.number_input(t("sweep_elements"), min_value=1, max_value=400, value=int(base["elements_per_page"]))
+        with c[3]:
+            base["cjk_ratio"] = st.slider(t("sweep_cjk"), 0.0, 1.0, float(base["cjk_ratio"]), 0.1)
+        with c[4]:
+            base["unit"] = st.selectbox(t("spec_units"), options=["mm", "pt"], index=0 if base["unit"] == "mm" else 1, key="sweep_unit")
+        mix_cols = st.columns(len(SYNTH_FIELD_TYPES) + 1)
+        for i, ftype in enumerate(SYNTH_FIELD_TYPES):
+            with mix_cols[i]:
+                base["type_mix"][ftype] = st.number_input(ftype, min_value=0, max_value=20, value=int(base["type_mix"].get(ftype, 0)), key=f"mix_{ftype}")
+        with mix_cols[-1]:
+            base["option_count"] = st.number_input(t("sweep_options"), min_value=1, max_value=500, value=int(base["option_count"]))
+
+        c = st.columns([1, 2, 1, 1])
+        with c[0]:
+            dimension = st.selectbox(t("sweep_dimension"), options=SWEEP_DIMENSIONS)
+        with c[1]:
+            raw_values = st.text_input(t("sweep_values"), value="0,0.25,0.5,1" if dimension == "cjk_ratio" else "1,5,10,25,50")
+        with c[2]:
+            engine = st.selectbox(t("engine"), options=BENCH_ENGINES, key="sweep_engine")
+        with c[3]:
+            appearances = st.checkbox(t("spec_appearances"), value=False, key="sweep_appearances")
+
+        b = st.columns(2)
+        with b[0]:
+            if st.button(t("sweep_run"), use_container_width=True, disabled=not sum(base["type_mix"].values())):
+                try:
+                    values = [float(v) if dimension == "cjk_ratio" else int(float(v)) for v in raw_values.split(",") if v.strip()]
+                except ValueError:
+                    st.error("Values must be a comma-separated list of numbers.")
+                else:
+                    set_status("running")
+                    start = time.time()
+                    st.session_state.sweep_rows = run_synthetic_sweep(dimension, values, base, engine, int(params["seed"]), appearances)
+                    set_status("done", int((time.time() - start) * 1000))
+                    st.rerun()
+        with b[1]:
+            st.download_button(
+                t("sweep_download_spec"),
+                data=wrap_yaml_block(generate_synthetic_spec(int(params["seed"]), **base)).encode("utf-8"),
+                file_name=f"synthetic_{params['seed']}.md",
+                mime="text/markdown",
+                use_container_width=True,
+            )
+
+        rows = st.session_state.sweep_rows
+        if rows:
+            df = pd.DataFrame(rows)
+            dim = rows[0]["dimension"]
+            for metric, title in (("ms", "time (ms)"), ("peak_kb", "peak memory (KB)")):
+                chart = (
+                    alt.Chart(df)
+                    .mark_line(point=True)
+                    .encode(x=alt.X("value:Q", title=dim), y=alt.Y(f"{metric}:Q", title=title), color="stage:N",
+                            tooltip=["stage", "value", "fields", metric])
+                    .properties(height=240)
+                )
+                st.altair_chart(chart, use_container_width=True)
+            st.download_button(
+                t("sweep_download"), data=df.to_csv(index=False).encode("utf-8"), file_name=f"sweep_{dim}.csv",
+                mime="text/csv", use_container_width=True,
+            )
+
+
+def ttfp_panel():
+    with st.expander(t("ttfp_title"), expanded=False):
+        spec_norm = session_get("last_spec_norm")
+        if not spec_norm:
+            st.info(t("ttfp_need_spec"))
+            return
+        c = st.columns([1, 2, 1])
+        with c[0]:
+            engine = st.selectbox(t("engine"), options=BENCH_ENGINES, key="ttfp_engine")
+        with c[1]:
+            optimize = st.select_slider(
+                t("spec_optimize"), options=OPTIMIZE_LEVELS, value="off", format_func=lambda x: t(f"spec_optimize_{x}"), key="ttfp_optimize"
+            )
+        with c[2]:
+            st.write("")
+            if st.button(t("ttfp_run"), use_container_width=True):
+                set_status("running")
+                start = time.time()
+                st.session_state.ttfp_result = run_ttfp_benchmark(spec_norm, engine, optimize)
+                set_status("done", int((time.time() - start) * 1000))
+                st.rerun()
+        st.caption(t("ttfp_estimate_note"))
+        if PDF_REWRITER is None:
+            st.caption(t("spec_linearize_off"))
+        res = st.session_state.ttfp_result
+        if res:
+            if res["note"]:
+                st.warning(f"{t('ttfp_no_linearizer')}: {res['note']}")
+            if not res["renderer"]:
+                st.caption(t("ttfp_no_poppler"))
+            df = pd.DataFrame(res["rows"])
+            st.dataframe(df, use_container_width=True, hide_index=True)
+            chart = (
+                alt.Chart(df)
+                .mark_bar()
+                .encode(x=alt.X("ttfp_ms:Q", title="estimated time to first page (ms)"), y=alt.Y("variant:N", title=None),
+                        color="variant:N", row=alt.Row("link:N", title=None), tooltip=list(df.columns))
+                .properties(height=60)
+            )
+            st.altair_chart(chart, use_container_width=True)
+
+
+def page_bench():
+    wow_header(t("nav_bench"), t("bench_title"))
+
+    c = st.columns([1, 1, 1, 1])
+    with c[0]:
+        use_defaults = st.checkbox(t("bench_use_defaults"), value=True)
+        use_editor = st.checkbox(t("bench_use_editor"), value=False)
+        use_synth = st.checkbox(t("bench_use_synth"), value=False)
+    with c[1]:
+        engines = st.multiselect(t("engine"), options=BENCH_ENGINES, default=BENCH_ENGINES)
+    with c[2]:
+        repeats = st.number_input(t("bench_repeats"), min_value=1, max_value=50, value=BENCH_REPEATS)
+    with c[3]:
+        tol = st.number_input(t("bench_tolerance"), min_value=0.0, max_value=20.0, value=PARITY_TOLERANCE_PT, step=0.5)
+    baseline_up = st.file_uploader(t("bench_baseline"), type=["json"], key="bench_baseline_upload")
+    if baseline_up is not None:
+        try:
+            st.session_state.bench_baseline = json.loads(baseline_up.getvalue())
+        except Exception as e:
+            st.error(f"Invalid baseline: {e}")
+
+    if st.button(t("bench_run"), use_container_width=True, disabled=not engines):
+        set_status("running")
+        start = time.time()
+        corpus = (default_bench_corpus() if use_defaults else []) + (bench_corpus_from_text(st.session_state.pdfspec_text) if use_editor else [])
+        if use_synth:
+            synth = st.session_state.sweep_params
+            corpus += bench_corpus_from_text(wrap_yaml_block(generate_synthetic_spec(int(synth["seed"]), **synth["base"])))
+        st.session_state.bench_report = run_parity_benchmark(corpus, engines, int(repeats), float(tol))
+        set_status("done", int((time.time() - start) * 1000))
+        st.rerun()
+
+    synthetic_sweep_panel()
+    ttfp_panel()
+
+    rep = st.session_state.bench_report
+    if not rep:
+        return
+    st.caption(f"commit {rep['meta']['commit']} · {rep['meta']['ts']} · {len(rep['specs'])} spec(s)")
+    st.dataframe(
+        [
+            {"spec": row["spec"], "engine": eng, **m}
+            for row in rep["specs"]
+            for eng, m in row["engines"].items()
+        ],
+        use_container_width=True,
+        hide_index=True,
+    )
+    with st.expander(t("bench_parity"), expanded=True):
+        for row in rep["specs"]:
+            for pair, res in row["parity"].items():
+                if res["ok"]:
+                    st.success(f"{row['spec']} · {pair}: OK")
+                else:
+                    st.warning(
+                        f"{row['spec']} · {pair}: {len(res['only_a'])} only in first, {len(res['only_b'])} only in second, "
+                        f"{len(res['issues'])} mismatch(es)"
+                    )
+                    st.json(res, expanded=False)
+    if st.session_state.bench_baseline:
+        flags = flag_regressions(rep, st.session_state.bench_baseline)
+        st.markdown(f"**{t('bench_regressions')}**")
+        if flags:
+            st.error(f"{len(flags)} regression(s) > {int(REGRESSION_THRESHOLD * 100)}% vs baseline {st.session_state.bench_baseline.get('meta', {}).get('commit', '?')}")
+            st.dataframe(flags, use_container_width=True, hide_index=True)
+        else:
+            st.success("—")
+    b = st.columns(2)
+    with b[0]:
+        st.download_button(
+            t("bench_download"), data=json.dumps(rep, ensure_ascii=False, indent=2).encode("utf-8"),
+            file_name=f"bench_{rep['meta']['commit']}.json", mime="application/json", use_container_width=True,
+        )
+    with b[1]:
+        if st.button(t("bench_set_baseline"), use_container_width=True):
+            st.session_state.bench_baseline = rep
+            st.rerun()
+
+
 # ----------------------------
 # Render app
 # ----------------------------
-css_inject()
-page = sidebar_ui()
-
-st.markdown(
-    f"""
-    <div class="wow-card">
-      <h1 style="margin-bottom: 0.2rem;">{t('app_title')}</h1>
-      <div class="wow-subtle">{t('tagline')}</div>
-    </div>
-    """,
-    unsafe_allow_html=True,
-)
-st.write("")
-
-if page == "dashboard":
-    page_dashboard()
-elif page == "form":
-    page_form()
-elif page == "pipeline":
-    page_pipeline()
-elif page == "spec":
-    page_spec()
-elif page == "notes":
-    page_notes()
-elif page == "settings":
-    page_settings()
-elif page == "history":
-    page_history()
-else:
-    page_dashboard()
+# Pool workers re-import this file as "__mp_main__" only to reach their worker functions.
+if __name__ != "__mp_main__":
+    css_inject()
+    start_metrics_server()
+    page = sidebar_ui()
+
+    st.markdown(
+        f"""
+        <div class="wow-card">
+          <h1 style="margin-bottom: 0.2rem;">{t('app_title')}</h1>
+          <div class="wow-subtle">{t('tagline')}</div>
+        </div>
+        """,
+        unsafe_allow_html=True,
+    )
+    st.write("")
+
+    if page == "dashboard":
+        page_dashboard()
+    elif page == "form":
+        page_form()
+    elif page == "pipeline":
+        page_pipeline()
+    elif page == "spec":
+        page_spec()
+    elif page == "bench":
+        page_bench()
+    elif page == "notes":
+        page_notes()
+    elif page == "settings":
+        page_settings()
+    elif page == "history":
+        page_history()
+    else:
+        page_dashboard()
+
+    # Runs after the page so this run's writes are measured; st.rerun() skips it until the next run.
+    enforce_session_budget()
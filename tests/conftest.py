@@ -0,0 +1,24 @@
+import os
+import types
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def load_app():
+    """
+    Executes app.py above the "Render app" banner (everything there is import-safe) into a
+    fresh module, the way Streamlit builds a new module for each session's script run.
+    """
+    src = open(APP_PATH, encoding="utf-8").read()
+    src = src[: src.index("# ----------------------------\n# Render app")]
+    mod = types.ModuleType("app_under_test")
+    mod.__file__ = APP_PATH
+    exec(compile(src, APP_PATH, "exec"), mod.__dict__)
+    return mod
+
+
+@pytest.fixture(scope="session")
+def app():
+    return load_app()
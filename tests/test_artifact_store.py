@@ -0,0 +1,41 @@
+import gc
+import time
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def spec(app):
+    spec, _ = app.layout_form_markdown("# T\nName: ____\n- [ ] Agree")
+    return spec
+
+
+def test_same_spec_renders_to_same_bytes(app, spec):
+    # Creation dates have one-second resolution: render again after it has moved on.
+    first = {engine: app.render_spec_pdf(spec, engine)[0] for engine in ("fpdf2", "reportlab")}
+    time.sleep(1.1)
+    for engine, pdf in first.items():
+        assert app.render_spec_pdf(spec, engine)[0] == pdf, engine
+
+
+def test_two_renders_intern_to_one_entry(app, spec):
+    store = app.SharedArtifactStore()
+    a = store.intern(app.render_spec_pdf(spec, "reportlab")[0], "pdf")
+    b = store.intern(app.render_spec_pdf(spec, "reportlab")[0], "pdf")
+    assert a.digest == b.digest
+    stats = store.stats()
+    assert (stats["artifacts"], stats["refs"], stats["deduped"]) == (1, 2, 1)
+    assert stats["saved_bytes"] == a.size
+
+
+def test_entry_is_freed_with_its_last_ref(app):
+    store = app.SharedArtifactStore()
+    a = store.intern(b"pdf bytes", "pdf")
+    b = store.intern(b"pdf bytes", "pdf")
+    del a
+    gc.collect()
+    assert store.stats()["refs"] == 1
+    assert store.get(b) == b"pdf bytes"
+    del b
+    gc.collect()
+    assert store.stats() == {"artifacts": 0, "refs": 0, "bytes": 0, "saved_bytes": 0, "deduped": 1}
@@ -0,0 +1,47 @@
+import time
+
+
+def request(i):
+    return {"custom_id": f"sub{i}::agent", "body": {"model": "m", "max_tokens": 10,
+                                                   "messages": [{"role": "user", "content": f"text {i}"}]}}
+
+
+def wait_done(sim, job_id):
+    for _ in range(200):
+        if sim.status(job_id)["status"] == "completed":
+            return
+        time.sleep(0.01)
+    raise AssertionError("batch job did not finish")
+
+
+def test_uncollected_jobs_survive_cap_and_ttl(app, monkeypatch):
+    monkeypatch.setattr(app, "BATCH_MAX_JOBS", 2)
+    monkeypatch.setattr(app, "BATCH_JOB_TTL_S", 0)
+    sim = app.LocalBatchSimulator(workers=1, call_fn=lambda step, text: (text.upper(), 1))
+    first = sim.submit("OpenAI", [request(0)])
+    wait_done(sim, first)
+    for i in range(1, 4):
+        wait_done(sim, sim.submit("OpenAI", [request(i)]))
+    assert sim.status(first)["status"] == "completed"
+    assert sim.results(first)[0]["response"]["output"] == "TEXT 0"
+
+
+def test_collected_jobs_are_pruned(app, monkeypatch):
+    monkeypatch.setattr(app, "BATCH_MAX_JOBS", 2)
+    sim = app.LocalBatchSimulator(workers=1, call_fn=lambda step, text: (text, 1))
+    jobs = []
+    for i in range(3):
+        jobs.append(sim.submit("OpenAI", [request(i)]))
+        wait_done(sim, jobs[-1])
+        sim.mark_collected(jobs[-1])
+    sim.submit("OpenAI", [request(9)])
+    assert sim.status(jobs[0])["status"] == "unknown"
+    assert sim.status(jobs[2])["status"] == "completed"
+
+
+def test_running_job_cannot_be_marked_collected(app):
+    sim = app.LocalBatchSimulator(workers=1, call_fn=lambda step, text: (time.sleep(0.2), (text, 1))[1])
+    job = sim.submit("OpenAI", [request(0)])
+    sim.mark_collected(job)
+    assert sim.status(job)["collected"] is False
+    wait_done(sim, job)
@@ -0,0 +1,35 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def form_pdf(app):
+    spec, _ = app.layout_form_markdown("# T\nName: ____\nAge: ____\n- [ ] Agree")
+    pdf, _ = app.render_spec_pdf(spec, "reportlab")
+    return pdf
+
+
+def test_extracts_fields_from_bytes_and_path(app, form_pdf, tmp_path):
+    path = tmp_path / "form.pdf"
+    path.write_bytes(form_pdf)
+    from_bytes = app.extract_pdf_fields(form_pdf)
+    from_path = app.extract_pdf_fields(path)
+    assert from_bytes == from_path
+    assert {"Name", "Age"} <= set(from_bytes["names"])
+    assert from_bytes["raw_count"] == len(from_bytes["fields"])
+
+
+def test_result_is_a_copy_of_the_cache_entry(app, form_pdf):
+    first = app.extract_pdf_fields(form_pdf)
+    first["names"].clear()
+    first["fields"]["Name"]["v"] = "tampered"
+    second = app.extract_pdf_fields(form_pdf)
+    assert second["names"] and second["fields"]["Name"]["v"] != "tampered"
+
+
+def test_empty_file_is_rejected(app, tmp_path):
+    path = tmp_path / "empty.pdf"
+    path.write_bytes(b"")
+    with pytest.raises(ValueError, match="empty"):
+        app.extract_pdf_fields(path)
+    with pytest.raises(ValueError, match="empty"):
+        app.extract_pdf_fields(b"")
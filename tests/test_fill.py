@@ -0,0 +1,41 @@
+import io
+import zipfile
+
+import pytest
+from pypdf import PdfReader
+
+
+@pytest.fixture(scope="module")
+def template(app):
+    spec, _ = app.layout_form_markdown("# T\nName: ____\nCity: ____\n- [ ] Agree")
+    pdf, _ = app.render_spec_pdf(spec, "reportlab")
+    return pdf
+
+
+def filled_docs(app, template, records, **kw):
+    res = app.fill_records_to_zip(template, iter(records), workers=1, name_field="Name", **kw)
+    with zipfile.ZipFile(res["path"]) as zf:
+        docs = {n: PdfReader(io.BytesIO(zf.read(n))) for n in sorted(zf.namelist())}
+    return res, docs
+
+
+def test_fill_writes_one_pdf_per_record_with_values(app, template):
+    res, docs = filled_docs(app, template, [{"Name": "Ada", "City": "London", "Agree": "yes"}, {"Name": "Lin", "City": "Taipei"}])
+    assert (res["records"], res["filled"], res["failed"]) == (2, 2, 0)
+    values = [{k: f.get("/V") for k, f in d.get_fields().items()} for d in docs.values()]
+    assert values[0]["Name"] == "Ada" and values[0]["City"] == "London"
+    assert values[0]["Agree"] not in (None, "/Off")
+    assert values[1]["City"] == "Taipei" and values[1]["Agree"] in (None, "/Off")
+
+
+def test_flatten_removes_the_form(app, template):
+    _, docs = filled_docs(app, template, [{"Name": "Ada", "City": "London"}], flatten=True)
+    reader = next(iter(docs.values()))
+    assert not reader.get_fields()
+    assert "Ada" in reader.pages[0].extract_text()
+
+
+def test_unknown_columns_are_ignored(app, template):
+    res, docs = filled_docs(app, template, [{"Name": "Ada", "Nope": "x"}])
+    assert res["filled"] == 1
+    assert "Nope" not in next(iter(docs.values())).get_fields()
@@ -0,0 +1,39 @@
+import pytest
+
+LONG = "A very long label that certainly needs to wrap onto several lines here"
+
+
+def spec(*elements):
+    return {"document": {"unit": "mm", "page_size": "A4", "orientation": "portrait", "margin": {"right": 10}},
+            "pages": [{"elements": list(elements)}]}
+
+
+def field(x, y):
+    return {"type": "field", "id": f"f{x}_{y}", "field_type": "text", "x": x, "y": y, "w": 60, "h": 8}
+
+
+@pytest.mark.parametrize("next_y, collides", [(26, True), (80, False)])
+def test_wrapped_label_checked_against_element_below(app, next_y, collides):
+    s = spec({"type": "label", "text": LONG, "x": 10, "y": 20, "fit": "wrap"}, field(50, 17),
+             {"type": "label", "text": "Next", "x": 10, "y": next_y})
+    warnings = []
+    stats = app.fit_labels(s, None, warnings)
+    assert stats["wrapped"] == 1
+    assert len(s["pages"][0]["elements"][0]["lines"]) > 1
+    assert stats["overflow"] == int(collides)
+    assert any("into the element below" in w for w in warnings) is collides
+
+
+def test_invalid_size_is_a_warning(app):
+    s = spec({"type": "label", "text": "Hi", "x": 10, "y": 20, "size": "big"})
+    warnings = []
+    app.fit_labels(s, None, warnings)
+    assert warnings == ["Page 1 label 1: invalid size 'big', using 11."]
+    assert "size" not in s["pages"][0]["elements"][0]
+
+
+def test_fit_labels_is_traced(app):
+    with app.start_trace("test") as trace:
+        app.fit_labels(spec({"type": "label", "text": LONG, "x": 10, "y": 20, "fit": "wrap"}, field(50, 17)), None, [])
+    spans = [sp for sp in trace["spans"] if sp.name == "spec.measure_labels"]
+    assert len(spans) == 1 and spans[0].attributes["wrapped"] == 1
@@ -0,0 +1,22 @@
+import pytest
+
+
+@pytest.mark.parametrize("lines", [20, 21])
+def test_heading_kept_with_next_row_leaves_no_empty_page(app, lines):
+    md = "\n".join(["# T"] + [f"Line {i}: ____" for i in range(lines)] + ["## Section B", "Name: ____"])
+    spec, report = app.layout_form_markdown(md)
+    counts = [len(p["elements"]) for p in spec["pages"]]
+    assert 0 not in counts
+    assert report["pages"] == len(spec["pages"]) == 2
+    last = spec["pages"][-1]["elements"]
+    assert last[0]["text"] == "Section B"
+    assert last[0]["y"] == pytest.approx(app.LAYOUT_MARGIN_MM + 2.0)
+    assert [p["number"] for p in spec["pages"]] == [1, 2]
+
+
+def test_only_blanks_and_colons_become_text_fields(app):
+    items, _ = app.parse_form_markdown("Full name: ____\nDate of birth:\nPlease print clearly\nSign below")
+    fields = [it["label"] for it in items if it["kind"] == "field"]
+    notes = [it["text"] for it in items if it["kind"] == "note"]
+    assert fields == ["Full name", "Date of birth"]
+    assert notes == ["Please print clearly", "Sign below"]
@@ -0,0 +1,35 @@
+import socket
+import urllib.request
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_step_latency_is_labelled_by_agent(app):
+    router = app.ModelRouter()
+    router.run({"id": "ingest_normalize", "model": "m1", "max_tokens": 5}, "hello", ["m1"],
+               call_fn=lambda step, text: ("out", 1), hedge_after_ms=None)
+    rows = [r for r in app.get_metrics().snapshot() if r["metric"] == "agent_step_seconds"]
+    assert any("agent=ingest_normalize" in r["labels"] and "model=m1" in r["labels"] for r in rows)
+    tokens = [r for r in app.get_metrics().snapshot() if r["metric"] == "agent_tokens_total" and "model=m1" in r["labels"]]
+    assert {"direction=input, model=m1", "direction=output, model=m1"} <= {r["labels"] for r in tokens}
+
+
+def test_failed_bind_is_retried_on_the_next_run(app):
+    port = free_port()
+    blocker = socket.socket()
+    blocker.bind(("127.0.0.1", port))
+    blocker.listen()
+    try:
+        first = app.start_metrics_server(port=port, host="127.0.0.1")
+    finally:
+        blocker.close()
+    assert first["running"] is False and first["error"]
+    second = app.start_metrics_server(port=port, host="127.0.0.1")
+    assert second["running"] is True
+    assert app.start_metrics_server(port=port, host="127.0.0.1")["running"] is True  # cached listener reused
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as resp:
+        assert resp.status == 200 and b"wow_" in resp.read()
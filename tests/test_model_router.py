@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+
+def make_call(behaviour):
+    """behaviour: model -> "ok" | "fail" | seconds to stall before answering."""
+    calls = []
+
+    def call(step, text):
+        calls.append(step["model"])
+        how = behaviour.get(step["model"], "ok")
+        if how == "fail":
+            raise RuntimeError(f"{step['model']} down")
+        if isinstance(how, (int, float)):
+            time.sleep(how)
+        return f"{step['model']}:{text}", 1
+
+    return call, calls
+
+
+STEP = {"id": "pdf_spec", "model": "a", "max_tokens": 10}
+
+
+def test_failover_to_next_route(app):
+    router = app.ModelRouter()
+    call, calls = make_call({"a": "fail"})
+    out, _, route = router.run(STEP, "x", ["a", "b", "c"], call_fn=call, hedge_after_ms=None)
+    assert out == "b:x"
+    assert route["model"] == "b" and route["fallbacks"] == 1
+    assert [a["ok"] for a in route["attempts"]] == [False, True]
+    assert router.stats("a")["error_rate"] == 1.0
+
+
+def test_all_routes_failing_raises(app):
+    router = app.ModelRouter()
+    call, _ = make_call({"a": "fail", "b": "fail"})
+    with pytest.raises(RuntimeError, match="All routes failed"):
+        router.run(STEP, "x", ["a", "b"], call_fn=call, hedge_after_ms=None)
+
+
+def test_stalled_route_is_hedged(app):
+    router = app.ModelRouter()
+    release = threading.Event()
+
+    def call(step, text):
+        if step["model"] == "a":
+            release.wait(5)
+        return step["model"], 1
+
+    try:
+        out, _, route = router.run(STEP, "x", ["a", "b"], call_fn=call, hedge_after_ms=50)
+    finally:
+        release.set()
+    assert out == "b"
+    assert route["hedged"] is True
+
+
+def test_ui_model_is_tried_first_even_when_unhealthy(app):
+    router = app.ModelRouter()
+    for _ in range(5):
+        router.record("a", 10, ok=False)
+    router.record("c", 10, ok=True)
+    call, calls = make_call({})
+    out, _, route = router.run(STEP, "x", ["a", "b", "c"], call_fn=call, hedge_after_ms=None)
+    assert calls == ["a"] and route["model"] == "a"
+
+
+def test_fallbacks_are_ranked_by_health(app):
+    router = app.ModelRouter()
+    router.record("c", 10, ok=True)  # measured and fast beats "b" with no samples
+    call, calls = make_call({"a": "fail"})
+    router.run(STEP, "x", ["a", "b", "c"], call_fn=call, hedge_after_ms=None)
+    assert calls == ["a", "c"]
@@ -0,0 +1,59 @@
+import os
+import stat
+
+import pytest
+
+
+def test_roundtrip_and_private_dir(app, tmp_path):
+    store = app.DiskBlobStore(tmp_path / "blobs")
+    digest = store.put(b"payload")
+    assert store.get(digest) == b"payload"
+    assert stat.S_IMODE(os.stat(store.root).st_mode) == 0o700
+
+
+def test_tampered_blob_is_dropped(app, tmp_path):
+    store = app.DiskBlobStore(tmp_path / "blobs")
+    digest = store.put(b"payload")
+    (store.root / digest).write_bytes(b"not the payload")
+    with pytest.raises(FileNotFoundError):
+        store.get(digest)
+    assert not (store.root / digest).exists()
+
+
+def test_put_repairs_a_planted_blob(app, tmp_path):
+    store = app.DiskBlobStore(tmp_path / "blobs")
+    digest = store.put(b"payload")
+    (store.root / digest).write_bytes(b"planted")
+    assert store.put(b"payload") == digest
+    assert store.get(digest) == b"payload"
+
+
+def test_rejects_non_digest_keys(app, tmp_path):
+    store = app.DiskBlobStore(tmp_path / "blobs")
+    with pytest.raises(ValueError):
+        store.get("../etc/passwd")
+
+
+def test_permissive_dir_is_locked_down(app, tmp_path):
+    root = tmp_path / "blobs"
+    root.mkdir(mode=0o777)
+    os.chmod(root, 0o777)
+    assert app.DiskBlobStore(root).root == root
+    assert stat.S_IMODE(os.stat(root).st_mode) == 0o700
+
+
+def test_symlinked_dir_falls_back_to_mkdtemp(app, tmp_path):
+    target = tmp_path / "elsewhere"
+    target.mkdir()
+    link = tmp_path / "blobs"
+    link.symlink_to(target)
+    store = app.DiskBlobStore(link)
+    assert store.root not in (link, target)
+    assert stat.S_IMODE(os.stat(store.root).st_mode) == 0o700
+
+
+def test_foreign_owned_dir_falls_back_to_mkdtemp(app, tmp_path, monkeypatch):
+    root = tmp_path / "blobs"
+    root.mkdir(mode=0o700)
+    monkeypatch.setattr(app.os, "getuid", lambda: os.stat(root).st_uid + 1)
+    assert app.DiskBlobStore(root).root != root
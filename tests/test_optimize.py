@@ -0,0 +1,45 @@
+import pytest
+
+FORM = "# T\nName: ____\nAge: ____\nEmail: ____\n- [ ] Agree\n- [x] Subscribe\nNotes: ____"
+
+
+@pytest.fixture(scope="module")
+def spec(app):
+    spec, _ = app.layout_form_markdown(FORM)
+    return spec
+
+
+@pytest.mark.parametrize("level", ["fast", "balanced", "max"])
+def test_fields_survive_every_optimize_level(app, spec, level):
+    plain = app.extract_pdf_fields(app.render_spec_pdf(spec, "reportlab")[0])
+    pdf, log = app.render_spec_pdf(spec, "reportlab", optimize=level)
+    assert any(line.startswith(f"optimize: {level}") for line in log)
+    optimized = app.extract_pdf_fields(pdf)
+    assert optimized["raw_count"] == plain["raw_count"] >= 6
+    assert optimized["fields"] == plain["fields"]
+
+
+def test_optimize_never_grows_the_file(app, spec):
+    pdf = app.render_spec_pdf(spec, "reportlab")[0]
+    out, report = app.optimize_pdf_bytes(pdf, "max")
+    assert len(out) <= len(pdf) and report["after"] == len(out)
+
+
+def test_linearize_round_trip(app, spec):
+    pdf, log = app.render_spec_pdf(spec, "reportlab", optimize="balanced", linearize=True)
+    info = app.linearization_info(pdf)
+    if app.pikepdf is None and not app.QPDF_BIN:
+        assert any(line.startswith("linearize: skipped") for line in log)
+        assert pdf == app.render_spec_pdf(spec, "reportlab", optimize="balanced")[0]
+        assert not info["linearized"]
+    else:
+        assert info["linearized"], info["problems"]
+        assert info["first_page_bytes"] and info["first_page_bytes"] <= len(pdf)
+    assert app.extract_pdf_fields(pdf)["raw_count"] >= 6
+
+
+def test_linearization_info_flags_a_stale_length(app):
+    head = b"%PDF-1.7\n1 0 obj\n<< /Linearized 1 /L 99 /O 3 /E 40 /N 1 /T 80 /H [ 200 20 ] >>\nendobj\n"
+    info = app.linearization_info(head)
+    assert not info["linearized"]
+    assert any("/L 99" in p for p in info["problems"])
@@ -0,0 +1,25 @@
+from conftest import load_app
+
+
+def test_css_and_i18n_survive_a_rerun(app):
+    # A rerun re-executes the script into a new module; only process-wide caches carry over.
+    rerun = load_app()
+    assert rerun.I18N_TABLES is app.I18N_TABLES
+    assert rerun.compiled_css("monet", "dark") is app.compiled_css("monet", "dark")
+    assert app.I18N_TABLES["zh-TW"]["spec_label_fit"] == "標籤溢出處理"
+    assert app.I18N_TABLES["zh-TW"].keys() >= app.I18N_TABLES["en"].keys()
+
+
+def test_preview_memo_hits_after_a_rerun(app):
+    spec, _ = app.layout_form_markdown("# T\nName: ____")
+    pdf, _ = app.render_spec_pdf(spec, "reportlab")
+    uri = app.pdf_data_uri(pdf)
+    count = app.pdf_field_count(pdf)
+    memo = app.get_preview_memo("pdf_data_uri")
+    hits = memo.stats()["hits"]
+
+    rerun = load_app()
+    assert rerun.get_preview_memo("pdf_data_uri") is memo
+    assert rerun.pdf_data_uri(pdf) is uri
+    assert rerun.pdf_field_count(pdf) == count
+    assert memo.stats()["hits"] == hits + 1
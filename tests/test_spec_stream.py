@@ -0,0 +1,80 @@
+import io
+import os
+import stat
+import zipfile
+
+import yaml
+from pypdf import PdfReader
+
+
+def spec_yaml(app, md):
+    spec, _ = app.layout_form_markdown(md)
+    return yaml.safe_dump(spec, allow_unicode=True, sort_keys=False)
+
+
+def stream(app, *mds):
+    return "".join("---\n" + spec_yaml(app, md) for md in mds)
+
+
+def test_stream_is_split_per_document(app):
+    text = stream(app, "# A\nName: ____", "# B\nCity: ____") + "---\n[unclosed\n"
+    specs = list(app.iter_pdfspecs(text))
+    assert len(specs) == 3
+    assert [obj is not None for _, obj, _ in specs] == [True, True, False]
+    assert specs[2][2]
+
+
+def test_size_limit_applies_per_document(app, monkeypatch):
+    one = spec_yaml(app, "# A\nName: ____")
+    monkeypatch.setattr(app, "MAX_SPEC_BYTES", len(one) + 100)
+    specs = list(app.iter_pdfspecs("---\n" + one + "---\n" + one + "---\n" + one))
+    assert len(specs) == 3 and all(obj is not None for _, obj, _ in specs)
+
+
+def test_separate_mode_writes_one_pdf_per_spec(app):
+    res = app.render_spec_stream(stream(app, "# A\nName: ____", "# B\nCity: ____"), "reportlab", "mm", "A4")
+    try:
+        assert res["ok"] == 2
+        with zipfile.ZipFile(res["path"]) as zf:
+            assert len(zf.namelist()) == 2
+    finally:
+        os.unlink(res["path"])
+
+
+def test_merge_mode_keeps_field_names_unique(app):
+    res = app.render_spec_stream(stream(app, "# A\nName: ____", "# B\nName: ____\nCity: ____"), "reportlab", "mm", "A4", merge=True)
+    try:
+        assert res["ok"] == 2
+        reader = PdfReader(res["path"])
+        assert len(reader.pages) == 2
+        assert sorted(reader.get_fields()) == ["City", "Name", "Name__2"]
+        assert any("metadata come from spec 1" in line for line in res["log"])
+    finally:
+        os.unlink(res["path"])
+
+
+def test_outputs_live_in_private_swept_dir(app):
+    res = app.render_spec_stream(stream(app, "# A\nName: ____"), "fpdf2", "mm", "A4")
+    try:
+        root = os.path.dirname(res["path"])
+        assert root == str(app.get_output_dir())
+        assert stat.S_IMODE(os.stat(root).st_mode) == 0o700
+    finally:
+        os.unlink(res["path"])
+
+
+def test_render_failure_is_isolated(app, monkeypatch):
+    real = app.render_spec_pdf
+
+    def flaky(spec_norm, engine, **kw):
+        if spec_norm["document"]["title"] == "B":
+            raise RuntimeError("boom")
+        return real(spec_norm, engine, **kw)
+
+    monkeypatch.setattr(app, "render_spec_pdf", flaky)
+    res = app.render_spec_stream(stream(app, "# A\nName: ____", "# B\nCity: ____"), "reportlab", "mm", "A4")
+    try:
+        assert [r["ok"] for r in res["rows"]] == [True, False]
+        assert res["rows"][1]["errors"] == ["Render failed: boom"]
+    finally:
+        os.unlink(res["path"])
@@ -0,0 +1,33 @@
+import threading
+import tracemalloc
+
+from conftest import load_app
+
+
+def test_concurrent_sessions_share_tracemalloc(app):
+    # Two script runs = two module instances, like two Streamlit sessions in one process.
+    sessions = [app, load_app()]
+    spec, _ = app.layout_form_markdown("# T\nName: ____\nAge: ____")
+    errors = []
+
+    def work(mod, fn):
+        try:
+            for _ in range(4):
+                fn(mod)
+        except Exception as e:  # RuntimeError("the tracemalloc module must be tracing ...")
+            errors.append(e)
+
+    jobs = [
+        (sessions[0], lambda m: m.profile_render_spec_pdf(spec, "reportlab")),
+        (sessions[1], lambda m: m.profile_render_spec_pdf(spec, "fpdf2")),
+        (sessions[1], lambda m: m.bench_engine(spec, "fpdf2", 1)),
+        (sessions[1], lambda m: m.profile_spec_stages(m.wrap_yaml_block(spec), "reportlab")),
+    ]
+    threads = [threading.Thread(target=work, args=job) for job in jobs]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert errors == []
+    assert sessions[0].get_tracemalloc_lock() is sessions[1].get_tracemalloc_lock()
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,48 @@
+import json
+import threading
+
+import pytest
+
+
+def test_page_spans_nest_under_the_render(app):
+    spec, _ = app.layout_form_markdown("# T\nName: ____")
+    with app.start_trace("t") as trace:
+        app.render_spec_pdf(spec, "reportlab")
+    by_id = {sp.span_id: sp for sp in trace["spans"]}
+    pages = [sp for sp in trace["spans"] if sp.name == "render.page"]
+    assert len(pages) == 1 and pages[0].status == "OK"
+    assert by_id[pages[0].parent_id].name == "render.reportlab"
+
+
+@pytest.mark.parametrize("engine", ["fpdf2", "reportlab"])
+def test_failing_page_span_is_error_and_closed_in_place(app, monkeypatch, engine):
+    spec, _ = app.layout_form_markdown("# T\nName: ____")
+
+    def boom(*a, **kw):
+        raise RuntimeError("page failed")
+
+    monkeypatch.setattr(app, "sanitize_to_latin1", boom)
+    monkeypatch.setattr(app, "choose_font_family_for_text", boom)
+    with app.start_trace("t") as trace:
+        with pytest.raises(RuntimeError):
+            app.render_spec_pdf(spec, engine)
+        # The page span is already finished and no longer the active one.
+        assert app._ACTIVE_SPAN.get().name == "t"
+    page = next(sp for sp in trace["spans"] if sp.name == "render.page")
+    assert page.status == "ERROR" and page.end_ns
+
+
+def test_trace_file_rotates_without_losing_backups(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "TRACE_FILE_MAX_BYTES", 2048)
+    path = tmp_path / "spans.jsonl"
+    line = {"pad": "x" * 500}
+    threads = [threading.Thread(target=lambda: [app.export_trace(line, path) for _ in range(10)]) for _ in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert files == ["spans.jsonl", "spans.jsonl.1", "spans.jsonl.2", "spans.jsonl.3"]
+    for p in tmp_path.iterdir():
+        assert p.stat().st_size <= 2048
+        assert all(json.loads(x) == line for x in p.read_text().splitlines())